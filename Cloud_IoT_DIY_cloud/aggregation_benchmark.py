@@ -0,0 +1,289 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+'''
+# helper script to generate synthetic telemetry and measure how telemetry aggregation scales
+# NOTE: it's expected that:
+# - telemetry is generated in the exact key layout of the IoT Rule (see telemetry_key in cloud_iot_diy_cloud_stack.py)
+# - Memory datasource is used for "pure" aggregation cost and LocalFolder for the cost with real I/O
+#
+# Example (10 devices, 2 days, one message every 18 seconds):
+'''
+python3 aggregation_benchmark.py --devices 10 --days 2 --interval 18 --fields "temperature|C|float,humidity|%|float,state|na|str"
+'''
+from typing import Dict, List, Tuple, Iterator, Callable
+from datetime import datetime, timezone, timedelta
+from contextlib import contextmanager
+from pathlib import Path
+from importlib import import_module
+import sys
+import re
+import json
+import time
+import random
+import asyncio
+import tempfile
+import argparse
+import logging
+logging.basicConfig(level=logging.WARNING, stream=sys.stderr, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_top_logger = logging.getLogger(__name__)
+if not _top_logger.hasHandlers():
+    _top_logger.addHandler(logging.StreamHandler(stream=sys.stderr))
+
+#-------------------------
+sys.path.insert(1, str(Path(__file__).parent / "src"))
+from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
+from _objects_datasource.Memory import Memory
+from scheduled_telemetry_aggregation.lambda_code import aggregate_telemetry_to_annual_history, telemetry_key_grouping_components
+
+# the same key as used by the IoT Rule
+DEFAULT_TELEMETRY_KEY = "${topic(1)}/${topic(2)}/${topic(6)}/${topic(7)}/${parse_time('yyyy',timestamp())}/${parse_time('MM',timestamp())}/${parse_time('dd',timestamp())}/${timestamp()}"
+DEFAULT_FIELDS = "temperature|C|float,humidity|%|float,pressure|hPa|int,state|na|str"
+# IoT Rule SQL function patterns to strftime
+TIME_PATTERNS = {"yyyy": "%Y", "MM": "%m", "dd": "%d", "HH": "%H", "mm": "%M"}
+
+
+def render_telemetry_key(telemetry_key:str, topic:str, ts:int)->str:
+    ''' telemetry object key for the message of the topic received at ts (epoch ms) '''
+    topic_parts = topic.split("/")
+    dt = datetime.fromtimestamp(ts/1000, tz=timezone.utc)
+    key = re.sub(r"\$\{topic\((\d+)\)\}", lambda m: topic_parts[int(m.group(1))-1], telemetry_key)
+    key = re.sub(r"\$\{parse_time\('(\w+)',\s*timestamp\(\)\)\}", lambda m: dt.strftime(TIME_PATTERNS[m.group(1)]), key)
+    return key.replace("${timestamp()}", str(ts))
+
+
+def field_value(field:str, rnd:random.Random):
+    ''' random value of the field by naming convention "<endpoint name>|<data units>|<value type>" (as firmware sends strings) '''
+    match field.split("|")[-1]:
+        case "float":
+            return f"{rnd.uniform(-20, 40):.2f}"
+        case "int":
+            return str(rnd.randint(900, 1100))
+        case _:
+            return rnd.choice(["on", "off", "idle"])
+
+
+def iter_synthetic_telemetry(telemetry_key:str, devices:int, days:int, interval_s:float, fields:List[str],
+                             start:datetime=None, seed:int=None)->Iterator[Tuple[str, dict]]:
+    ''' (key, message) of every synthetic message: devices x days with one message every interval_s seconds '''
+    rnd = random.Random(seed)
+    start = start or (datetime.now(tz=timezone.utc) - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    start_ms = int(start.timestamp()*1000)
+    topics = [f"dt/diyiot/bench/location{i%4:02d}/diy/BenchThing/bench{i:05d}" for i in range(devices)]
+    for step in range(int(days*24*60*60/interval_s)):
+        for i, topic in enumerate(topics):
+            # devices are not synchronized (every device has own offset)
+            ts = start_ms + int(step*interval_s*1000) + i
+            yield render_telemetry_key(telemetry_key, topic, ts), {
+                "mqtt_timestamp": ts, "mqtt_topic": topic, **{f: field_value(f, rnd) for f in fields}
+            }
+
+
+class PhaseTimer:
+    ''' wall time of the Datasource calls by phase (list, fetch, write, delete)
+        NOTE that groups are aggregated concurrently so phase time is the time when at least one call of the phase is in progress
+        (and "busy" time is the time when any Datasource call is in progress)
+    '''
+    PHASES = {
+        "list": ["iter_keys", "list_objects", "list_prefixes"],
+        "fetch": ["get_objects", "get_blob", "iter_blob"],
+        "write": ["put_object", "put_object_from_iter"],
+        "delete": ["remove_objects", "remove_object"],
+    }
+
+    def __init__(self) -> None:
+        self.phases:Dict[str, float] = {k: 0.0 for k in self.PHASES}
+        self.busy:float = 0.0
+        # phase -> [number of calls in progress, start of the in progress period]
+        self._active:Dict[str, list] = {k: [0, 0.0] for k in [*self.PHASES, None]}
+
+    def _enter(self, phase:str):
+        now = time.perf_counter()
+        for k in [phase, None]:
+            if self._active[k][0] == 0:
+                self._active[k][1] = now
+            self._active[k][0] += 1
+
+    def _exit(self, phase:str):
+        now = time.perf_counter()
+        for k in [phase, None]:
+            self._active[k][0] -= 1
+            if self._active[k][0] == 0:
+                if k is None:
+                    self.busy += now - self._active[k][1]
+                else:
+                    self.phases[k] += now - self._active[k][1]
+
+    @contextmanager
+    def measure(self, phase:str):
+        self._enter(phase)
+        try:
+            yield
+        finally:
+            self._exit(phase)
+
+    def _timed(self, phase:str, method:Callable)->Callable:
+        timer = self
+        if asyncio.iscoroutinefunction(method):
+            async def timed_async(*args, **kwargs):
+                with timer.measure(phase):
+                    return await method(*args, **kwargs)
+            return timed_async
+        def timed(*args, **kwargs):
+            with timer.measure(phase):
+                res = method(*args, **kwargs)
+            if not isinstance(res, Iterator):
+                return res
+            # lazy listing and streaming reads are measured while consumed
+            def timed_iter():
+                it = iter(res)
+                while True:
+                    with timer.measure(phase):
+                        v = next(it, StopIteration)
+                    if v is StopIteration:
+                        return
+                    yield v
+            return timed_iter()
+        return timed
+
+    def instrument(self, datasource:ObjectsDatasource)->ObjectsDatasource:
+        ''' measure calls of the Datasource instance (methods are replaced on the instance only) '''
+        for phase, methods in self.PHASES.items():
+            for name in methods:
+                setattr(datasource, name, self._timed(phase, getattr(datasource, name)))
+        return datasource
+
+
+def peak_rss_mb()->float:
+    ''' peak resident set size of the process (None if not available on the platform) '''
+    try:
+        resource = import_module("resource")
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # NOTE that maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(maxrss/(1024*1024) if sys.platform == "darwin" else maxrss/1024, 1)
+
+
+def create_datasources(datasource_type:str, folder:Path=None, latency:float=0.0)->Tuple[ObjectsDatasource, ObjectsDatasource]:
+    ''' telemetry and history datasources of the benchmark '''
+    if datasource_type == "memory":
+        return tuple(
+            ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": f"benchmark_{v}", "latency": latency})
+            for v in ["telemetry", "history"]
+        )
+    folder = Path(folder or tempfile.mkdtemp(prefix="aggregation_benchmark_"))
+    for v in ["telemetry", "history"]:
+        (folder / v).mkdir(parents=True, exist_ok=True)
+    return tuple(
+        ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.LocalFolder, config={"folder_path": folder / v})
+        for v in ["telemetry", "history"]
+    )
+
+
+def run_benchmark(
+        devices:int=10,
+        days:int=1,
+        interval_s:float=18,
+        fields:List[str]=None,
+        telemetry_key:str=DEFAULT_TELEMETRY_KEY,
+        datasource_type:str="memory",
+        folder:Path=None,
+        latency:float=0.0,
+        seed:int=None,
+        **kwargs
+    )->dict:
+    '''
+        generate synthetic telemetry, aggregate it and return the report
+        kwargs are options of aggregate_telemetry_to_annual_history (like max_concurrent_groups or chunk_size)
+    '''
+    fields = fields or DEFAULT_FIELDS.split(",")
+    telemetry_ds, history_ds = create_datasources(datasource_type, folder, latency)
+    # generate (NOT measured)
+    generate_start = time.perf_counter()
+    objects, telemetry_bytes = 0, 0
+    for key, message in iter_synthetic_telemetry(telemetry_key, devices, days, interval_s, fields, seed=seed):
+        blob = json.dumps(message)
+        telemetry_ds.put_object(key, blob)
+        objects += 1
+        telemetry_bytes += len(blob)
+    generate_s = time.perf_counter() - generate_start
+
+    # aggregate (every Datasource call is measured)
+    timer = PhaseTimer()
+    timer.instrument(telemetry_ds)
+    timer.instrument(history_ds)
+    handler_loop = asyncio.new_event_loop()
+    aggregate_start = time.perf_counter()
+    try:
+        result = handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+            telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(telemetry_key), **kwargs
+        ))
+    finally:
+        handler_loop.close()
+    aggregate_s = time.perf_counter() - aggregate_start
+    # merge is everything but the Datasource calls (decode, sort, merge and encode)
+    # NOTE that streamed writes (like merged segments) include producing the streamed records
+    phases = {k: round(v, 3) for k, v in timer.phases.items()}
+    phases["merge"] = round(max(aggregate_s - timer.busy, 0.0), 3)
+
+    report = {
+        "devices": devices,
+        "days": days,
+        "objects": objects,
+        "telemetry_bytes": telemetry_bytes,
+        "datasource": datasource_type,
+        "generate_s": round(generate_s, 3),
+        "aggregate_s": round(aggregate_s, 3),
+        "objects_per_s": round(objects/aggregate_s, 1) if aggregate_s > 0 else None,
+        "bytes_per_s": round(telemetry_bytes/aggregate_s, 1) if aggregate_s > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "phases_s": phases,
+        "result": result,
+    }
+    if datasource_type == "memory":
+        Memory.clear()
+    return report
+
+
+def parse_arguments():
+    ''' this is required ONLY if command line is used '''
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic telemetry and benchmark telemetry aggregation",
+        usage=''' python3 aggregation_benchmark.py --devices 10 --days 2 {'--datasource local'}'''
+    )
+    parser.add_argument("--devices", "-n", dest="devices", type=int, default=10, help="Number of devices")
+    parser.add_argument("--days", "-m", dest="days", type=int, default=1, help="Number of days of telemetry of every device")
+    parser.add_argument("--interval", "-i", dest="interval_s", type=float, default=18, help="Seconds between messages of one device")
+    parser.add_argument("--fields", "-f", dest="fields", default=DEFAULT_FIELDS, help="Comma separated telemetry fields '<name>|<units>|<float|int|str>'")
+    parser.add_argument("--telemetry_key", "-k", dest="telemetry_key", default=DEFAULT_TELEMETRY_KEY, help="Telemetry key format of the IoT Rule")
+    parser.add_argument("--datasource", "-d", dest="datasource_type", choices=["memory", "local"], default="memory", help="Datasource for telemetry and history")
+    parser.add_argument("--folder", dest="folder", default=None, help="Folder for local datasource (temporary folder by default)")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.0, help="Simulated latency (seconds) of every request of memory datasource")
+    parser.add_argument("--seed", dest="seed", type=int, default=None, help="Seed for the generated values")
+    parser.add_argument("--max_concurrent_groups", dest="max_concurrent_groups", type=int, default=8, help="Groups (device-year) aggregated concurrently")
+    parser.add_argument("--verbose", "-v", dest="verbose", action="store_true", help="Log aggregation messages (like objects not found)")
+    parser.add_argument("--chunk_size", dest="chunk_size", type=int, default=100, help="Telemetry objects of one group in memory at once")
+    return parser.parse_args()
+
+
+if __name__=="__main__":
+
+    my_args = parse_arguments()
+    _top_logger.debug(my_args)
+    # NOTE that aggregation logs every not existing object (like rollups of the first aggregation) as an error
+    logging.getLogger().setLevel(logging.INFO if my_args.verbose else logging.CRITICAL)
+    report = run_benchmark(
+        devices=my_args.devices,
+        days=my_args.days,
+        interval_s=my_args.interval_s,
+        fields=[v.strip() for v in my_args.fields.split(",") if len(v.strip()) > 0],
+        telemetry_key=my_args.telemetry_key,
+        datasource_type=my_args.datasource_type,
+        folder=my_args.folder,
+        latency=my_args.latency,
+        seed=my_args.seed,
+        max_concurrent_groups=my_args.max_concurrent_groups,
+        chunk_size=my_args.chunk_size,
+    )
+    print(json.dumps(report, indent=2))
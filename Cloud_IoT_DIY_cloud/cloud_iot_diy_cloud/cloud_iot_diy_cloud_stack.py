@@ -334,6 +334,16 @@ class CloudIoTDiyCloudStack(Stack):
             authorization_scopes=self.client_scopes,    # for now all scopes for any method
             operation_name="get_device_historical",
         )
+        # /telemetry - telemetry of multiple devices (like all devices of the dashboard) in one request
+        # request body is { "devices": [{"device_id", "values", "format"}], "from", "to", "points" }
+        # see implementation in Cloud_IoT_DIY_cloud/src/api_ui_telemetry_post/lambda_code.py
+        uiapi_telemetry = uiapi_root.add_resource("telemetry")
+        uiapi_telemetry.add_method("POST", 
+            aws_apigateway.LambdaIntegration(self.lambda_api_ui_telemetry_post),
+            authorizer=self.cognito_authorizer,
+            authorization_scopes=self.client_scopes,    # for now all scopes for any method
+            operation_name="post_devices_telemetry",
+        )
         #
         # *DEVICES COMMANDS*
         # /devices/{device_id}/command
@@ -437,7 +447,7 @@ class CloudIoTDiyCloudStack(Stack):
         # --------------------
         # We need to have some schedule for
         # - start data aggregation daily
-        # -
+        # - compact telemetry to hourly bundles every hour
         #############################################################
         _top_logger.info(f"Define events (schedules)")
         self.scheduled_aggregation_target = aws_events_targets.LambdaFunction(
@@ -458,6 +468,25 @@ class CloudIoTDiyCloudStack(Stack):
             event_pattern=None,
             event_bus=None, cross_stack_scope=None
         )
+        self.scheduled_compaction_target = aws_events_targets.LambdaFunction(
+            self.lambda_scheduled_telemetry_compaction,
+            event=None, dead_letter_queue=None, max_event_age=Duration.minutes(50), retry_attempts=None
+        )
+        self.scheduled_compaction_event = aws_events.Rule(
+            self, f"TelemetryCompactionHourlyEvent{self.cnstrct_id}",
+            rule_name=f"TelemetryCompactionHourly{self.cnstrct_id}",
+            description=f"Trigger Telemetry compaction to hourly bundles for {self.mqtt_app_name}",
+            enabled=True,
+            # NOTE that daily aggregation runs at 04:01 so compaction is scheduled in the middle of the hour
+            schedule=aws_events.Schedule.cron(
+                year="*", month="*", day="*",
+                hour="*", minute="31"
+                ),
+            targets=[ self.scheduled_compaction_target ],
+            # *NOTE* AWS CDK defaults are in use !
+            event_pattern=None,
+            event_bus=None, cross_stack_scope=None
+        )
         #############################################################
         # ***** IoT *****
         self._iot()
@@ -604,6 +633,8 @@ class CloudIoTDiyCloudStack(Stack):
         # we have multiple Lambda Layers to make common code available for multiple functions
         # - nosql_datasource - abstraction layer for DynamoDb or other NoSQL database
         # - objects_datasource - abstraction layer for S3 Bucket or other objects storage
+        # - aws_clients - process-wide registry of boto3 clients (used by all other layers)
+        # - telemetry_history - layout of historical data (segments and manifests) shared by aggregation and readers
         # For every layer we'll expect to have
         # - source code located in src folder but with '_' prefix
         # - packaged deployment zip in the deploy_lambda folder with '_' prefix
@@ -611,6 +642,15 @@ class CloudIoTDiyCloudStack(Stack):
         #   use lbuild.py to build and pack all lambdas
         #   layer MUST have __init__.py file
         #############################################################
+        # aws_clients Lambda Layer
+        l_name = "aws_clients"
+        self.layer_aws_clients = aws_lambda.LayerVersion(
+            self, f"Layer{l_name}{self.cnstrct_id}",
+            layer_version_name=f"{l_name}{self.cnstrct_id}",
+            description=f"Shared boto3 clients registry {l_name}",
+            code=aws_lambda.Code.from_asset(CloudIoTDiyCloudStack.depl_package_for(f"_{l_name}")),
+            compatible_architectures=[aws_lambda.Architecture.ARM_64,aws_lambda.Architecture.X86_64],
+        )
         # nosql_datasource Lambda Layer
         l_name = "nosql_datasource"
         self.layer_nosql_datasource = aws_lambda.LayerVersion(
@@ -638,6 +678,15 @@ class CloudIoTDiyCloudStack(Stack):
             code=aws_lambda.Code.from_asset(CloudIoTDiyCloudStack.depl_package_for(f"_{l_name}")),
             compatible_architectures=[aws_lambda.Architecture.ARM_64,aws_lambda.Architecture.X86_64],
         )
+        # telemetry_history Lambda Layer
+        l_name = "telemetry_history"
+        self.layer_telemetry_history = aws_lambda.LayerVersion(
+            self, f"Layer{l_name}{self.cnstrct_id}",
+            layer_version_name=f"{l_name}{self.cnstrct_id}",
+            description=f"Historical data layout {l_name}",
+            code=aws_lambda.Code.from_asset(CloudIoTDiyCloudStack.depl_package_for(f"_{l_name}")),
+            compatible_architectures=[aws_lambda.Architecture.ARM_64,aws_lambda.Architecture.X86_64],
+        )
         # api_handlers_common Lambda Layer
         l_name = "api_handlers_common"
         self.layer_api_handlers_common = aws_lambda.LayerVersion(
@@ -710,7 +759,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_objects_datasource ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_objects_datasource ],
                     "tracing": None,
                     "environment": {
                         "dashboard_key": self.dashboard_key
@@ -735,7 +784,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_objects_datasource ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_objects_datasource ],
                     "tracing": None,
                     "environment": {
                         "dashboard_key": self.dashboard_key
@@ -760,7 +809,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_objects_datasource ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_objects_datasource ],
                     "tracing": None,
                     "environment": {
                         "dashboard_key": self.dashboard_key
@@ -785,7 +834,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_objects_datasource ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_objects_datasource ],
                     "tracing": None,
                     "environment": {
                         "dashboard_key": self.dashboard_key
@@ -840,7 +889,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(10),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_devices_registry ], # self.layer_api_handlers_common, 
+                    "layers": [ self.layer_aws_clients, self.layer_devices_registry ], # self.layer_api_handlers_common, 
                     "tracing": None,
                     "environment": {
                         "service_bucket": self.service_s3_bucket_name,
@@ -884,7 +933,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_devices_registry ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_devices_registry ],
                     "tracing": None,
                     "environment": {}
                 }
@@ -915,7 +964,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_devices_registry ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_devices_registry ],
                     "tracing": None,
                     "environment": { }
                 }
@@ -946,7 +995,8 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_objects_datasource, self.layer_devices_registry ],
+                    # telemetry history layer is required to read hourly bundles of telemetry
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_objects_datasource, self.layer_devices_registry, self.layer_telemetry_history ],
                     "tracing": None,
                     "environment": {
                         "telemetry_topic": telemetry_topics_lambda,
@@ -971,6 +1021,46 @@ class CloudIoTDiyCloudStack(Stack):
         self.export_data[self.lambda_api_ui_devices_deviceid_telemetry_get.function_arn] = self.lambda_api_ui_devices_deviceid_telemetry_get.function_name
         self.export_data["log_groups"]["lambda"].append(self.lambda_api_ui_devices_deviceid_telemetry_get.function_name) # type: ignore
         #------------------------------------------------------------
+        # Lambda serving batch telemetry data (multiple devices) on UI API
+        f_name = "api_ui_telemetry_post"
+        self.lambda_api_ui_telemetry_post = aws_lambda.Function(
+            self, f"Lambda{f_name}{self.cnstrct_id}", **{
+                **default_lambda_props,
+                **{
+                    "code": aws_lambda.Code.from_asset(CloudIoTDiyCloudStack.depl_package_for(f_name)),
+                    "description": "lambda for POST batch telemetry data (multiple devices) endpoint on UI REST API",
+                    "function_name": f"{self.cnstrct_id}-{f_name}",
+                    "handler": "lambda_code.lambda_handler",
+                    "log_retention": aws_logs.RetentionDays.ONE_WEEK,
+                    "timeout": Duration.seconds(29),
+                    "architecture": aws_lambda.Architecture.ARM_64,
+                    # telemetry of all devices of the batch is collected (and cached) by one invocation
+                    "memory_size": 512,
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_objects_datasource, self.layer_devices_registry, self.layer_telemetry_history ],
+                    "tracing": None,
+                    "environment": {
+                        "telemetry_topic": telemetry_topics_lambda,
+                        "telemetry_ingest_rule_prefix": self.telemetry_ingest_rule_prefix,
+                        # *NOTE* this key format MUST be the same as key for IoT Rule !
+                        "telemetry_key": self.telemetry_key,
+                    }
+                }
+            }
+        )
+        # grant this lambda required permissions
+        self.telemetry_s3.grant_read(self.lambda_api_ui_telemetry_post)
+        # Allow access to IoT Registry
+        self.lambda_api_ui_telemetry_post.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                effect=aws_iam.Effect.ALLOW,
+                actions=["iot:DescribeThing", "iot:DescribeThingGroup"],
+                resources=[f"arn:aws:iot:us-east-1:{self.proj_account}:*"]
+            )
+        )
+        # store some data for stack output
+        self.export_data[self.lambda_api_ui_telemetry_post.function_arn] = self.lambda_api_ui_telemetry_post.function_name
+        self.export_data["log_groups"]["lambda"].append(self.lambda_api_ui_telemetry_post.function_name) # type: ignore
+        #------------------------------------------------------------
         # Lambda serving get historical data on UI API
         f_name = "api_ui_devices_deviceid_historical_get"
         self.lambda_api_ui_devices_deviceid_historical_get = aws_lambda.Function(
@@ -985,7 +1075,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_objects_datasource, self.layer_devices_registry ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_objects_datasource, self.layer_devices_registry, self.layer_telemetry_history ],
                     "tracing": None,
                     "environment": {
                         "telemetry_topic": telemetry_topics_lambda,
@@ -998,6 +1088,14 @@ class CloudIoTDiyCloudStack(Stack):
         )
         # grant this lambda required permissions
         self.historical_s3.grant_read(self.lambda_api_ui_devices_deviceid_historical_get)
+        # Allow access to IoT Registry (history key prefix depends on device attributes)
+        self.lambda_api_ui_devices_deviceid_historical_get.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                effect=aws_iam.Effect.ALLOW,
+                actions=["iot:DescribeThing", "iot:DescribeThingGroup"],
+                resources=[f"arn:aws:iot:us-east-1:{self.proj_account}:*"]
+            )
+        )
         self.lambda_api_ui_devices_deviceid_historical_get.add_to_role_policy(
             aws_iam.PolicyStatement(
                 effect=aws_iam.Effect.ALLOW,
@@ -1023,7 +1121,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_devices_registry ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_devices_registry ],
                     "tracing": None,
                     "environment": {
                         "control_plane_name": self.control_plane_name,
@@ -1056,7 +1154,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": [ self.layer_api_handlers_common, self.layer_nosql_datasource ],
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_nosql_datasource ],
                     "tracing": None,
                     "environment": {
                         "control_plane_name": self.control_plane_name,
@@ -1073,6 +1171,39 @@ class CloudIoTDiyCloudStack(Stack):
         #------------------------------------------------------------
         # Lambda performing once a day aggregation of telemetry to historical
         f_name = "scheduled_telemetry_aggregation"
+        # aggregation run is distributed between this number of worker invocations (1 - no workers)
+        aggregation_workers = 4
+        # workers use the same code (lambda_handler runs in worker mode for "worker" event)
+        self.lambda_scheduled_telemetry_aggregation_worker = aws_lambda.Function(
+            self, f"{self.cnstrct_id}Lambda{f_name}_worker", **{
+                **default_lambda_props,
+                **{
+                    "code": aws_lambda.Code.from_asset(CloudIoTDiyCloudStack.depl_package_for(f_name)),
+                    "description": "worker of on schedule aggregation of telemetry data",
+                    "function_name": f"{self.cnstrct_id}-{f_name}_worker",
+                    "handler": "lambda_code.lambda_handler",
+                    "log_retention": aws_logs.RetentionDays.ONE_WEEK,
+                    "timeout": Duration.seconds(898),
+                    "architecture": aws_lambda.Architecture.X86_64,
+                    "memory_size": 1024,
+                    "layers": [ self.layer_aws_clients, self.layer_objects_datasource, self.layer_telemetry_history ],
+                    "tracing": None,
+                    "environment": {
+                        "telemetry_bucket": self.telemetry_s3_bucket_name,
+                        "historical_bucket": self.historical_s3_bucket_name,
+                        # *NOTE* this key format MUST be the same as key for IoT Rule !
+                        "telemetry_key": self.telemetry_key
+                    }
+                }
+            }
+        )
+        # grant this lambda required permissions
+        self.telemetry_s3.grant_read_write(self.lambda_scheduled_telemetry_aggregation_worker)
+        self.historical_s3.grant_read_write(self.lambda_scheduled_telemetry_aggregation_worker)
+        # store some data for stack output
+        self.export_data[self.lambda_scheduled_telemetry_aggregation_worker.function_arn] = self.lambda_scheduled_telemetry_aggregation_worker.function_name
+        self.export_data["log_groups"]["lambda"].append(self.lambda_scheduled_telemetry_aggregation_worker.function_name) # type: ignore
+        # coordinator
         self.lambda_scheduled_telemetry_aggregation = aws_lambda.Function(
             self, f"{self.cnstrct_id}Lambda{f_name}", **{
                 **default_lambda_props,
@@ -1085,7 +1216,9 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(898),
                     "architecture": aws_lambda.Architecture.X86_64,
                     "memory_size": 1024,
-                    "layers": [ self.layer_objects_datasource ],    # aggregation function needs this datasource to work with S3 buckets
+                    # aggregation runs never overlap (continuation invocations are queued until the current run completes)
+                    "reserved_concurrent_executions": 1,
+                    "layers": [ self.layer_aws_clients, self.layer_objects_datasource, self.layer_telemetry_history ],    # aggregation function needs this datasource to work with S3 buckets
                     "tracing": None,
                     "environment": {
                         # "service_bucket": self.service_s3_bucket_name,
@@ -1094,18 +1227,61 @@ class CloudIoTDiyCloudStack(Stack):
                         # "state_table": self.state_table_name,
                         # "things_group_name": self.group_name,
                         # *NOTE* this key format MUST be the same as key for IoT Rule !
-                        "telemetry_key": self.telemetry_key
+                        "telemetry_key": self.telemetry_key,
+                        "aggregation_worker_function": self.lambda_scheduled_telemetry_aggregation_worker.function_name,
+                        "aggregation_workers": str(aggregation_workers),
                     }
                 }
             }
         )
         # grant this lambda required permissions
+        self.lambda_scheduled_telemetry_aggregation_worker.grant_invoke(self.lambda_scheduled_telemetry_aggregation)
         self.telemetry_s3.grant_read_write(self.lambda_scheduled_telemetry_aggregation)
         self.historical_s3.grant_read_write(self.lambda_scheduled_telemetry_aggregation)
+        # Allow to continue the run by invoking itself (ARN is assembled to avoid circular dependency with the role)
+        self.lambda_scheduled_telemetry_aggregation.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                effect=aws_iam.Effect.ALLOW,
+                actions=["lambda:InvokeFunction"],
+                resources=[f"arn:aws:lambda:{self.region}:{self.account}:function:{self.cnstrct_id}-{f_name}"]
+            )
+        )
         # store some data for stack output
         self.export_data[self.lambda_scheduled_telemetry_aggregation.function_arn] = self.lambda_scheduled_telemetry_aggregation.function_name
         self.export_data["log_groups"]["lambda"].append(self.lambda_scheduled_telemetry_aggregation.function_name) # type: ignore
         #------------------------------------------------------------
+        # Lambda performing hourly compaction of telemetry (one object per message) to hourly bundles
+        f_name = "scheduled_telemetry_compaction"
+        self.lambda_scheduled_telemetry_compaction = aws_lambda.Function(
+            self, f"{self.cnstrct_id}Lambda{f_name}", **{
+                **default_lambda_props,
+                **{
+                    "code": aws_lambda.Code.from_asset(CloudIoTDiyCloudStack.depl_package_for(f_name)),
+                    "description": "on schedule compaction of telemetry data to hourly bundles",
+                    "function_name": f"{self.cnstrct_id}-{f_name}",
+                    "handler": "lambda_code.lambda_handler",
+                    "log_retention": aws_logs.RetentionDays.ONE_WEEK,
+                    "timeout": Duration.seconds(600),
+                    "architecture": aws_lambda.Architecture.X86_64,
+                    "memory_size": 512,
+                    # compaction runs never overlap
+                    "reserved_concurrent_executions": 1,
+                    "layers": [ self.layer_aws_clients, self.layer_objects_datasource, self.layer_telemetry_history ],
+                    "tracing": None,
+                    "environment": {
+                        "telemetry_bucket": self.telemetry_s3_bucket_name,
+                        # *NOTE* this key format MUST be the same as key for IoT Rule !
+                        "telemetry_key": self.telemetry_key
+                    }
+                }
+            }
+        )
+        # grant this lambda required permissions
+        self.telemetry_s3.grant_read_write(self.lambda_scheduled_telemetry_compaction)
+        # store some data for stack output
+        self.export_data[self.lambda_scheduled_telemetry_compaction.function_arn] = self.lambda_scheduled_telemetry_compaction.function_name
+        self.export_data["log_groups"]["lambda"].append(self.lambda_scheduled_telemetry_compaction.function_name) # type: ignore
+        #------------------------------------------------------------
         # Lambda serving get /devices/{deviceid}/updates/{update_id} on MTLS API
         f_name = "api_mtls_devices_deviceid_update_updateid_get"
         self.lambda_api_mtls_devices_deviceid_update_get = aws_lambda.Function(
@@ -1120,7 +1296,7 @@ class CloudIoTDiyCloudStack(Stack):
                     "timeout": Duration.seconds(29),
                     "architecture": aws_lambda.Architecture.ARM_64,
                     "memory_size": 256,
-                    "layers": None,
+                    "layers": [ self.layer_aws_clients, self.layer_api_handlers_common, self.layer_objects_datasource ],
                     "tracing": None,
                     "environment": {
                         "service_bucket": self.service_s3_bucket_name,
@@ -0,0 +1,87 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Downsampling of the chart data to the target number of points (like points=N query parameter) '''
+#! Largest-Triangle-Three-Buckets (LTTB) keeps the visual shape of the series (peaks and drops are preserved)
+#! (S. Steinarsson, "Downsampling Time Series for Visual Representation", MSc thesis, 2013)
+#! Every numeric attribute of the response objects is downsampled separately and objects selected
+#! for any attribute are returned (in the original order, objects are never modified)
+
+from typing import Union, List
+import math
+import logging
+_top_logger = logging.getLogger(__name__)
+
+MIN_POINTS = 3  # the first, the last and at least one point between
+
+
+def lttb_indices(xs:List[float], ys:List[float], threshold:int)->List[int]:
+    ''' positions of the points selected by LTTB (xs MUST be in ascending order)
+        the first and the last points are always selected
+    '''
+    n = len(xs)
+    if threshold >= n:
+        return list(range(n))
+    if threshold < MIN_POINTS:
+        return [0, n-1][:max(threshold, 0)]
+    # the first and the last points are buckets of their own
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # average point of the next bucket is the third vertex of the triangle
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(xs[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(ys[avg_start:avg_end]) / (avg_end - avg_start)
+        # point of the current bucket with the largest triangle (selected point of the previous bucket is the first vertex)
+        best, best_area = -1, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
+def _numeric(v)->Union[float, None]:
+    if isinstance(v, bool) or not isinstance(v, (int, float)) or not math.isfinite(v):
+        return None
+    return float(v)
+
+
+def downsample_objects(objects:List[dict], points:Union[int, None], label:str="label")->List[dict]:
+    ''' up to points objects (per numeric attribute) selected by LTTB
+        objects - chart objects in the label order (like {"label": <timestamp>, "value": <value>})
+        labels are used as x values when all of them are numbers (including numeric strings), positions otherwise
+        every numeric attribute gets points/<number of numeric attributes> points so no more than points objects are returned
+        NOTE that only the attributes with the most values (up to points/MIN_POINTS) are used when there are too many of them
+    '''
+    if points is None or len(objects) <= points:
+        return objects
+    points = max(points, MIN_POINTS)
+    try:
+        xs = [float(v.get(label)) for v in objects]
+        if not all(math.isfinite(v) for v in xs):
+            raise ValueError("labels are not finite numbers")
+    except Exception:
+        xs = [float(i) for i in range(len(objects))]
+    fields = sorted({k for v in objects for k, value in v.items() if k != label and _numeric(value) is not None})
+    if len(fields) == 0:
+        # nothing to keep the shape of so objects are selected evenly
+        return [objects[round(i * (len(objects) - 1) / (points - 1))] for i in range(points)]
+    field_positions = {field: [i for i, v in enumerate(objects) if _numeric(v.get(field)) is not None] for field in fields}
+    if len(fields) > points // MIN_POINTS:
+        # selected objects have all attributes so the primary attributes (with the most values) keep the shape
+        fields = sorted(fields, key=lambda v: (-len(field_positions[v]), v))[:points // MIN_POINTS]
+    field_points = points // len(fields)
+    selected = set()
+    for field in fields:
+        positions = field_positions[field]
+        ys = [_numeric(objects[i][field]) for i in positions]
+        selected.update(positions[j] for j in lttb_indices([xs[i] for i in positions], ys, field_points))
+    _top_logger.debug(f"downsample_objects: {len(selected)} of {len(objects)} objects selected for {len(fields)} attributes")
+    return [objects[i] for i in sorted(selected)]
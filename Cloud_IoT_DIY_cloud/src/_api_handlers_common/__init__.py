@@ -4,7 +4,7 @@ MIT License
 '''
 from functools import wraps
 import uuid
-from typing import Union
+from typing import Union, List, Tuple
 import json
 
 import logging
@@ -38,6 +38,55 @@ def decode_data_value_by_name(v:Union[str,None], name:str):
         _top_logger.error("decode_data_value_by_name: FAIL to convert value {v} for name {name} with exception {e}")
         return v
 
+def telemetry_objects(
+        keyed_records:List[Tuple[str, Union[dict, None]]],
+        attributes:Union[str, List[str], None],
+        label:str,
+    )->List[Tuple[str, dict]]:
+    ''' transform (raw key, record) pairs to telemetry objects. Internal logic is 
+            around "label" (what value to use for "label" key)
+            around attributes - if str we'll return just that attribute value for key "value", if None - return all
+        return list of tuples (raw key, telemetry object) in the raw keys order
+    '''
+    # attrs should always be a list even when attributes is str or None
+    attrs = [attributes] if isinstance(attributes,str) else (attributes or []).copy()
+    # transform collected objects
+    result = []
+    for raw_key, data_obj in keyed_records:
+        if not isinstance(data_obj, dict):
+            # objects failed to collect are returned as None by the datasource
+            continue
+        _top_logger.debug(f"telemetry_objects: object {json.dumps(data_obj)[:15]}...")
+        elem = {
+            "label": data_obj.get(label,"")
+        }
+        if isinstance(attributes,str):
+            # simple scenario
+            elem["value"] = decode_data_value_by_name(data_obj.get(attributes, None), attributes)
+            result.append((raw_key, elem))
+            continue
+        elif attributes is None:
+            # when attributes not provided all data_obj fields except 'label' will be added
+            attrs.extend([k for k in data_obj.keys() if k!=label])
+            attrs = list(set(attrs))
+        elem = {
+            **{k:decode_data_value_by_name(v,k) for k,v in data_obj.items()},
+            **elem
+        }
+        result.append((raw_key, elem))
+    # finally - update all elements by adding None for not-available attributes
+    # and converting label to string
+    if isinstance(attributes, str):
+        result = [ (k, {"label":str(v["label"]), "value":v["value"]}) for k, v in result]
+    else:
+        result = [
+            (k, {
+                **{a:None for a in attrs},
+                **v
+            }) for k, v in result
+        ]
+    return result
+
 def header_values(event:dict, header_name:str)->list:
     ''' parse header for list of values for header_name with check on lower case'''
     h_values = None
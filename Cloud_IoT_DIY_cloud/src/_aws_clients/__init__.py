@@ -0,0 +1,91 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Process-wide registry of boto3 clients shared by all Datasources/Registries '''
+#! NOTE that boto3 clients are thread-safe so one client (and its connections pool) can be used by everyone
+#! in the process. For Lambda this means that "hot start" invocations reuse established TCP/TLS connections
+
+from dataclasses import dataclass, asdict, replace
+from importlib import import_module
+from threading import RLock
+from typing import Union, Dict, Tuple, Any
+import os
+import logging
+_top_logger = logging.getLogger(__name__)
+
+@dataclass(eq=True, frozen=True)
+class AwsClientConfig:
+    max_pool_connections:int=10     # - size of urllib3 connections pool (MUST be >= number of concurrent requests)
+    tcp_keepalive:bool=True         # - keep idle connections alive between ("hot start") invocations
+    connect_timeout:float=5.0       # - seconds
+    read_timeout:float=60.0         # - seconds
+    retries_mode:str="standard"     # - "legacy"|"standard"|"adaptive"
+    max_attempts:int=3              # - including the first attempt
+
+
+class AwsClients:
+    '''
+        Lazily created boto3 clients keyed by (service, region, config)
+        - clients are created on first request and reused by all following requests
+        - default config can be tuned with configure() (for example at Lambda module load)
+    '''
+    # dynamically loaded modules
+    _boto3 = None
+    _botocore_config = None
+
+    _clients:Dict[Tuple[str, Union[str, None], AwsClientConfig], Any] = {}
+    _lock = RLock()     # boto3 default session is NOT thread-safe so clients are created under lock
+    _default_config:AwsClientConfig = AwsClientConfig()
+
+    @staticmethod
+    def configure(**defaults):
+        ''' change default config for clients created after this call (see AwsClientConfig) '''
+        with AwsClients._lock:
+            AwsClients._default_config = replace(AwsClients._default_config, **defaults)
+
+    @staticmethod
+    def client(service:str, region:str=None, config:Union[dict, AwsClientConfig]=None):
+        ''' get (or create) the client of the service
+            config - (optional) dict with values overriding default config (or AwsClientConfig)
+        '''
+        if isinstance(config, dict):
+            client_config = replace(AwsClients._default_config, **config)
+        else:
+            client_config = config or AwsClients._default_config
+        # region is resolved the same way boto3 does it so "None" and explicit default region share the client
+        region = region or os.environ.get("AWS_REGION", None) or os.environ.get("AWS_DEFAULT_REGION", None)
+        client_key = (service, region, client_config)
+        client = AwsClients._clients.get(client_key, None)
+        if client is not None:
+            return client
+        with AwsClients._lock:
+            if client_key not in AwsClients._clients:
+                AwsClients._clients[client_key] = AwsClients._create(service, region, client_config)
+            return AwsClients._clients[client_key]
+
+    @staticmethod
+    def _create(service:str, region:Union[str, None], client_config:AwsClientConfig):
+        try:
+            if AwsClients._boto3 is None:
+                AwsClients._boto3 = import_module("boto3")
+                AwsClients._botocore_config = import_module("botocore.config")
+            params = asdict(client_config)
+            botocore_config = AwsClients._botocore_config.Config(
+                max_pool_connections=params["max_pool_connections"],
+                tcp_keepalive=params["tcp_keepalive"],
+                connect_timeout=params["connect_timeout"],
+                read_timeout=params["read_timeout"],
+                retries={"mode": params["retries_mode"], "max_attempts": params["max_attempts"]},
+            )
+            _top_logger.debug(f"AwsClients: create {service} client for region {region} with {client_config}")
+            return AwsClients._boto3.client(service, region_name=region, config=botocore_config)
+        except Exception as e:
+            _top_logger.error(f"AwsClients: FAIL to create {service} client with exception {e}")
+            raise e
+
+    @staticmethod
+    def clear():
+        ''' forget all clients (new clients will be created on the next request) '''
+        with AwsClients._lock:
+            AwsClients._clients.clear()
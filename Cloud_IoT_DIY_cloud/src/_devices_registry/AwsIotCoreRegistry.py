@@ -26,8 +26,8 @@ class AwsIotCoreRegistry(DevicesRegistry):
     # SOME CONSTANTS
     DELIMITER = "/"
 
-    # dynamically loaded boto3 module
-    _boto3 = None
+    # dynamically loaded registry of shared boto3 clients (aws_clients layer)
+    _aws_clients = None
 
     # Basic client
     _s3_client = None  # NOTE that boto3 clients are thread-safe
@@ -61,8 +61,9 @@ class AwsIotCoreRegistry(DevicesRegistry):
             _top_logger.error("Layer-AwsIotCoreRegistry: config should be a dict and has required values. Failed with exception {e}")
             raise ValueError
         try:
-            self._boto3 = import_module("boto3")
-            self._iot_client = self._boto3.client("iot") # NOTE that boto3 clients are thread-safe
+            if AwsIotCoreRegistry._aws_clients is None:
+                AwsIotCoreRegistry._aws_clients = import_module("_aws_clients")
+            self._iot_client = AwsIotCoreRegistry._aws_clients.AwsClients.client("iot") # NOTE that boto3 clients are thread-safe
         except Exception as e:
             _top_logger.error(f"FAIL to init AwsIotCoreRegistry registry with exception {e}")
             raise e
@@ -5,9 +5,9 @@ MIT License
 NoSqlDatasource implementation with DynamoDb '''
 from _nosql_datasource import NoSqlDatasource
 import json
-import boto3
 from boto3.dynamodb.conditions import Key, Attr
 from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from _aws_clients import AwsClients
 import decimal
 from copy import deepcopy
 from dataclasses import dataclass
@@ -60,8 +60,9 @@ class DynamoDb(NoSqlDatasource):
     _MAX_NUMBER_OF_RESPONSE_PAGES_ASSEMBLED = 30
     # _AWS_DYNAMODB_TYPE = "table"
     # _table+s3_WITH_DYNAMODB_TYPE = "table_s3"
-    _ddb_client = boto3.client("dynamodb")
-    _s3_client = boto3.client("s3")
+    # clients are shared with other Datasources in the process (see aws_clients layer)
+    _ddb_client = AwsClients.client("dynamodb")
+    _s3_client = AwsClients.client("s3")
     
 
     def __init__(self, config: dict):
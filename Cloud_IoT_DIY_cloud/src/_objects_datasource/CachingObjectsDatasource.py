@@ -0,0 +1,255 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Read-through caching decorator for any ObjectsDatasource implementation '''
+#! NOTE that cache lives in the process memory - for Lambda it's available for all "hot start" invocations of the container
+
+from typing import Union, Dict, List, ByteString, Tuple, Iterator, Iterable
+from dataclasses import dataclass
+from collections import OrderedDict
+from pathlib import Path
+from threading import RLock
+import hashlib
+import uuid
+import asyncio
+import json
+import time
+import logging
+_top_logger = logging.getLogger(__name__)
+
+from . import ObjectsDatasource
+
+@dataclass(eq=True, frozen=True)
+class CachingObjectsDatasourceConfig:
+    max_cache_size:int=32*1024*1024     # - max total size (bytes) of blobs kept in memory
+    max_object_size:int=4*1024*1024     # - larger blobs are never cached
+    spill_folder:str=None               # - (optional) folder (like /tmp/objects_cache) for blobs evicted from memory
+    max_spill_size:int=256*1024*1024    # - max total size (bytes) of blobs in spill_folder
+    ttl:float=0.0                       # - seconds cached blob is served without revalidation (0 - always revalidate)
+    prefix_ttl:Dict[str,float]=None     # - ttl for specific key prefixes (the longest matching prefix wins)
+
+
+@dataclass
+class _CacheEntry:
+    size:int
+    etag:str
+    validated_at:float
+    blob:ByteString=None        # None when blob is spilled to the spill_folder
+
+
+class CachingObjectsDatasource(ObjectsDatasource):
+    '''
+        ObjectsDatasource decorator with size-bounded LRU cache of blobs
+        - cached blobs are revalidated with conditional get (etag) when ttl expired
+          so unchanged objects cost "304 Not Modified" instead of full transfer
+        - blobs evicted from memory can be spilled to the local folder (if configured)
+        - all writes/removes go through the cache (cached blobs are invalidated)
+    '''
+
+    def __init__(self, datasource:ObjectsDatasource, config:dict=None):
+        '''  '''
+        # Verify that the config contains a dictionary object with required parameters
+        try:
+            self._config = CachingObjectsDatasourceConfig(**(config or {}))
+        except Exception as e:
+            _top_logger.error(f"Layer-CachingObjectsDatasource: config should be a dict and has required values. Failed with exception {e}")
+            raise ValueError
+        if not isinstance(datasource, ObjectsDatasource):
+            raise ValueError("Layer-CachingObjectsDatasource: datasource MUST be an ObjectsDatasource implementation")
+        self._ds:ObjectsDatasource = datasource
+        # the longest prefixes first
+        self._prefix_ttl:List[Tuple[str,float]] = sorted((self._config.prefix_ttl or {}).items(), key=lambda v: len(v[0]), reverse=True)
+        self._entries:OrderedDict[str,_CacheEntry] = OrderedDict()   # in LRU order (the most recently used at the end)
+        self._memory_size:int = 0
+        self._spill_size:int = 0
+        self._spill_path:Path = None
+        self._spill_token:str = uuid.uuid4().hex     # spill folder can be shared by multiple caches
+        if isinstance(self._config.spill_folder, str):
+            self._spill_path = Path(self._config.spill_folder)
+            self._spill_path.mkdir(parents=True, exist_ok=True)
+        self._lock = RLock()    # cache can be used from multiple threads (see get_objects)
+        self.stats:Dict[str,int] = {
+            "hits": 0,          # served from cache without any request
+            "revalidated": 0,   # served from cache after "not modified" response
+            "misses": 0,        # collected from the datasource
+            "evictions": 0,     # removed from the cache (memory or spill folder)
+            "spills": 0,        # moved from memory to the spill folder
+        }
+
+    #-----------------------------------------------------------------
+    # cache internals
+    def _ttl_for(self, key:str)->float:
+        for prefix, ttl in self._prefix_ttl:
+            if key.startswith(prefix):
+                return ttl
+        return self._config.ttl
+
+    def _spill_file(self, key:str)->Path:
+        return self._spill_path / hashlib.sha1(f"{self._spill_token}/{key}".encode("utf-8")).hexdigest()
+
+    def _drop(self, key:str):
+        ''' remove the key from the cache (if cached) '''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        if entry.blob is None:
+            self._spill_size -= entry.size
+            self._spill_file(key).unlink(missing_ok=True)
+        else:
+            self._memory_size -= entry.size
+
+    def _enforce_limits(self):
+        ''' evict the least recently used blobs from memory (spill if possible) and from the spill folder '''
+        for key in list(self._entries.keys()):
+            if self._memory_size <= self._config.max_cache_size:
+                break
+            entry = self._entries[key]
+            if entry.blob is None:
+                continue
+            if self._spill_path is not None and entry.size <= self._config.max_spill_size:
+                try:
+                    self._spill_file(key).write_bytes(entry.blob)
+                    entry.blob = None
+                    self._memory_size -= entry.size
+                    self._spill_size += entry.size
+                    self.stats["spills"] += 1
+                    continue
+                except Exception as e:
+                    _top_logger.warning(f"CachingObjectsDatasource: FAIL to spill {key} with exception {e}")
+            self._drop(key)
+            self.stats["evictions"] += 1
+        for key in list(self._entries.keys()):
+            if self._spill_size <= self._config.max_spill_size:
+                break
+            if self._entries[key].blob is None:
+                self._drop(key)
+                self.stats["evictions"] += 1
+
+    def _cached_blob(self, key:str, entry:_CacheEntry)->Union[ByteString, None]:
+        if entry.blob is not None:
+            return entry.blob
+        try:
+            return self._spill_file(key).read_bytes()
+        except Exception as e:
+            _top_logger.warning(f"CachingObjectsDatasource: FAIL to read spilled {key} with exception {e}")
+            self._drop(key)
+        return None
+
+    def _store(self, key:str, blob:ByteString, etag:str):
+        self._drop(key)
+        if blob is None or len(blob) > self._config.max_object_size:
+            return
+        self._entries[key] = _CacheEntry(size=len(blob), etag=etag, validated_at=time.monotonic(), blob=blob)
+        self._memory_size += len(blob)
+        self._enforce_limits()
+
+    def invalidate(self, key:str=None):
+        ''' remove the key (or all keys if not provided) from the cache '''
+        with self._lock:
+            for k in ([key] if isinstance(key, str) else list(self._entries.keys())):
+                self._drop(k)
+
+    #-----------------------------------------------------------------
+    # cached reads
+    def get_blob(self, key:str)->ByteString:
+        ''' get the blob from the cache or from the Datasource '''
+        etag = None
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                cached_blob = self._cached_blob(key, entry)
+                if cached_blob is not None:
+                    self._entries.move_to_end(key)
+                    if time.monotonic() - entry.validated_at < self._ttl_for(key):
+                        self.stats["hits"] += 1
+                        return cached_blob
+                    etag = entry.etag
+        # NOTE that request to the Datasource is done without lock
+        try:
+            blob, new_etag = self._ds.get_blob_if_changed(key, etag)
+        except Exception as e:
+            # object is not available (like removed) so cached blob is dropped and the Datasource get_blob
+            # gives the result of the failed read (None or exception depending from the Datasource)
+            _top_logger.warning(f"CachingObjectsDatasource: FAIL to collect {key} with exception {e}")
+            with self._lock:
+                self.stats["misses"] += 1
+                self._drop(key)
+            return self._ds.get_blob(key)
+        with self._lock:
+            if blob is None and isinstance(etag, str):
+                # not modified
+                self.stats["revalidated"] += 1
+                entry = self._entries.get(key, None)
+                if entry is not None:
+                    entry.validated_at = time.monotonic()
+                return cached_blob
+            self.stats["misses"] += 1
+            self._store(key, blob, new_etag)
+        return blob
+
+    def get_blob_if_changed(self, key:str, etag:str=None)->Tuple[Union[ByteString, None], Union[str, None]]:
+        ''' conditional get is not cached - just forwarded to the Datasource '''
+        return self._ds.get_blob_if_changed(key, etag)
+
+    def _get_one_object(self, key:str, encoding:str, format:str)->Union[ByteString, str, Dict, List, None]:
+        ''' get and decode one object. Any failure is isolated to this key (None will be returned) '''
+        try:
+            res = self.get_blob(key)
+            if isinstance(encoding, str):
+                res = res.decode(encoding)
+                match format:
+                    case "json":
+                        res = json.loads(res)
+            return res
+        except Exception as e:
+            _top_logger.error(f"CachingObjectsDatasource: FAIL to get object {key} with exception {e}")
+        return None
+
+    async def get_objects(self, filter:str, keys:List[str], encoding:str="utf8", format:str="json")->List[Union[ByteString, str, Dict, List]]:
+        ''' get all objects from the cache or from the Datasource (results are in the same order as keys) '''
+        loop = asyncio.get_running_loop()
+        obj_load_tasks = [
+            loop.run_in_executor(None, self._get_one_object, v, encoding, format)
+            for v in (keys if isinstance(keys, list) else self.list_objects(filter=filter))
+        ]
+        return await asyncio.gather(*obj_load_tasks)
+
+    #-----------------------------------------------------------------
+    # not cached operations (writes invalidate cached blobs)
+    def list_objects(self, prefix:str=None, filter:str=None)->List[str]:
+        return self._ds.list_objects(prefix=prefix, filter=filter)
+
+    def iter_keys(self, prefix:str=None, filter:str=None, start_after:str=None, page_size:int=None)->Iterator[str]:
+        return self._ds.iter_keys(prefix=prefix, filter=filter, start_after=start_after, page_size=page_size)
+
+    def list_prefixes(self, prefix:str=None)->List[str]:
+        return self._ds.list_prefixes(prefix=prefix)
+
+    def iter_blob(self, key:str, chunk_size:int=None, byte_range:Tuple[int,Union[int,None]]=None)->Iterator[ByteString]:
+        return self._ds.iter_blob(key, chunk_size=chunk_size, byte_range=byte_range)
+
+    def put_object(self, key:str, obj:Union[str, ByteString], encoding:str="utf-8", metadata:dict=None)->bool:
+        self.invalidate(key)
+        return self._ds.put_object(key, obj, encoding, metadata)
+
+    def put_object_from_iter(self, key:str, chunks:Iterable[Union[str, ByteString]], encoding:str="utf-8", metadata:dict=None)->bool:
+        self.invalidate(key)
+        return self._ds.put_object_from_iter(key, chunks, encoding, metadata)
+
+    def remove_object(self, key:str)->bool:
+        self.invalidate(key)
+        return self._ds.remove_object(key)
+
+    async def remove_objects(self, filter:str=None, keys:List[str]=None)->List[bool]:
+        obj_keys = keys if isinstance(keys, list) else self.list_objects(filter=filter)
+        for k in obj_keys:
+            self.invalidate(k)
+        return await self._ds.remove_objects(keys=obj_keys)
+
+    def query_objects(self, meta_data_query:dict)->List[str]:
+        return self._ds.query_objects(meta_data_query)
+
+    @property
+    def metadata_index(self):
+        return self._ds.metadata_index
@@ -6,27 +6,29 @@ ANoSqlDatasource implementation with file '''
 #! NOTE that LocalFolder depends on aiofiles for effective multi-files handling!
 
 from dataclasses import dataclass
-from pathlib import Path
-from typing import Union, Dict, List, ByteString
+from pathlib import Path, PurePosixPath
+from typing import Union, Dict, List, ByteString, Tuple, Iterator, Iterable
 import json
+import os
 import asyncio
 from importlib import import_module
 
 import logging
 _top_logger = logging.getLogger(__name__)
-from . import ObjectsDatasource
+from . import ObjectsDatasource, MetadataIndex
+from .ObjectsCodec import ObjectsCodec, iter_decoded, iter_range, iter_split
 
 async def read_the_file(file_path:Path, encoding:str=None, format:str=None)->Union[ByteString, str, Dict, List]:
     ''' async non-blocking file read '''
     try:
         if encoding is None:
             ''' just read file as binary '''
-            async with LocalFolder._aiofiles.open(file_path, mode="rb") as handle:
+            async with LocalFolder._aiofiles().open(file_path, mode="rb") as handle:
                 # read the contents of the file
                 data = await handle.read()
             return data
         else:
-            async with LocalFolder._aiofiles.open(file_path, mode="r", encoding=encoding) as handle:
+            async with LocalFolder._aiofiles().open(file_path, mode="r", encoding=encoding) as handle:
                 # read the contents of the file with encoding
                 data = await handle.read()
             if format is None:
@@ -41,19 +43,28 @@ async def read_the_file(file_path:Path, encoding:str=None, format:str=None)->Uni
 @dataclass(eq=True, frozen=True)
 class LocalFolderConfig:
     folder_path:Path        # - the path to the local folder serving as Datasource
+    codec:str=None          # - (optional) "gzip" or "zstd" to compress stored objects (detected by the file content on read)
+    metadata_index:bool=False   # - maintain metadata index on writes/removes (required for query_objects)
 
 class LocalFolder(ObjectsDatasource):
     ''' 
         ObjectsDatasource implementation with local folders
     '''
     _aiofiles_module = None    # we'll load this modules dynamically if/when needed
+    _aiofiles_os_module = None
 
     @staticmethod
-    def _aiofiles(self):
+    def _aiofiles():
         if LocalFolder._aiofiles_module is None:
             LocalFolder._aiofiles_module = import_module("aiofiles")
         return LocalFolder._aiofiles_module
 
+    @staticmethod
+    def _aiofiles_os():
+        if LocalFolder._aiofiles_os_module is None:
+            LocalFolder._aiofiles_os_module = import_module("aiofiles.os")
+        return LocalFolder._aiofiles_os_module
+
     def __init__(self, config:dict):
         '''  '''
         # Verify that the config contains a dictionary object with required parameters
@@ -64,17 +75,62 @@ class LocalFolder(ObjectsDatasource):
             raise ValueError
 
         self._path:Path = Path(self._config.folder_path)
+        self._codec = ObjectsCodec.create(self._config.codec)
+        self._index = MetadataIndex(self, self.INDEX_PREFIX) if self._config.metadata_index else None
 
     def list_objects(self, prefix:str=None, filter:str=None)->List[str]:
-        ''' list all objects in the Datasource '''
-        if isinstance(filter, str):
-            glob_filter = f"**/{filter}"
-        elif isinstance(prefix, str):
-            glob_filter = f"**/{prefix}*"
-        else:
-            glob_filter = "**/*"
-        result = [str(v).replace(f"{str(self._path)}","") for v in self._path.glob(glob_filter) if v.is_file()]
-        return [v[1:] if v.startswith("/") else v for v in result]
+        ''' list all objects in the Datasource 
+            NOTE that filter is a glob-style pattern matched from the right (like "2023/*/*/*")
+        '''
+        return list(self.iter_keys(prefix=prefix, filter=filter))
+
+    @staticmethod
+    def _is_temporary(name:str)->bool:
+        ''' temporary files of put_object_from_iter are not Datasource objects '''
+        return name.startswith(".") and name.endswith(".tmp")
+
+    def _iter_folder(self, folder:Path, rel_folder:str, prefix:str, start_after:str)->Iterator[str]:
+        ''' recursive walk over the folder in lexicographical order of keys (like S3 does) '''
+        try:
+            with os.scandir(folder) as it:
+                # folder name is a part of the key so it's compared as name with delimiter
+                entries = sorted([(v.name + ("/" if v.is_dir() else ""), v) for v in it], key=lambda v: v[0])
+        except FileNotFoundError:
+            return
+        for name, entry in entries:
+            rel_key = rel_folder + name
+            if entry.is_dir():
+                # there is no reason to walk into the folder if all keys inside are out of prefix
+                # or not after start_after
+                if not (rel_key.startswith(prefix) or prefix.startswith(rel_key)) or rel_key < start_after[:len(rel_key)]:
+                    continue
+                yield from self._iter_folder(Path(entry.path), rel_key, prefix, start_after)
+            elif rel_key.startswith(prefix) and rel_key > start_after and not LocalFolder._is_temporary(name):
+                yield rel_key
+
+    def iter_keys(self, prefix:str=None, filter:str=None, start_after:str=None, page_size:int=None)->Iterator[str]:
+        ''' lazy list of objects in the Datasource (keys are yielded in lexicographical order)
+            start_after - (optional) only keys after this key will be listed (for resumable listing)
+            NOTE that page_size is ignored as there is no paging for local folders
+        '''
+        for key in self._iter_folder(self._path, "", prefix or "", start_after or ""):
+            if self._is_hidden(key, prefix) or (isinstance(filter, str) and not PurePosixPath(key).match(filter)):
+                continue
+            yield key
+
+    def list_prefixes(self, prefix:str=None)->List[str]:
+        ''' list "sub-folders" of the prefix (common prefixes up to the next "/", including "/") '''
+        prefix = prefix or ""
+        rel_folder, _, name_prefix = prefix.rpartition("/")
+        rel_folder = f"{rel_folder}/" if len(rel_folder)>0 else ""
+        try:
+            with os.scandir(self._path / Path(rel_folder)) as it:
+                return sorted([
+                    f"{rel_folder}{v.name}/" for v in it
+                        if v.is_dir() and v.name.startswith(name_prefix) and not self._is_hidden(f"{rel_folder}{v.name}/", prefix)
+                ])
+        except FileNotFoundError:
+            return []
 
     def get_blob(self, key:str)->ByteString:
         ''' get the blob from the Datasource '''
@@ -82,59 +138,174 @@ class LocalFolder(ObjectsDatasource):
         result = None
         try:
             with open(file_path, "rb") as f:
-                result = f.read()
+                result = self._decode_blob(key, f.read())
         except Exception as e:
             _top_logger.error(f"Fail to collect blob with exception {e}")
             raise e
         return result
 
+    def get_blob_if_changed(self, key:str, etag:str=None)->Tuple[Union[ByteString, None], Union[str, None]]:
+        ''' conditional get of the blob from the Datasource (etag is built from file modification time and size)
+            return tuple (blob, etag) where blob is None if the object's etag is the same as provided (not modified)
+        '''
+        file_path = self._path / Path(key)
+        try:
+            file_stat = file_path.stat()
+            file_etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"'
+            if file_etag == etag:
+                return None, etag
+            with open(file_path, "rb") as f:
+                return self._decode_blob(key, f.read()), file_etag
+        except Exception as e:
+            _top_logger.error(f"Fail to collect blob with exception {e}")
+            raise e
+
+    def iter_blob(self, key:str, chunk_size:int=None, byte_range:Tuple[int,Union[int,None]]=None)->Iterator[ByteString]:
+        ''' iterate over the blob from the Datasource by chunks 
+            byte_range is a tuple (first_byte, last_byte) with INCLUSIVE last_byte (like HTTP Range header)
+            NOTE that byte_range of compressed object is applied to decompressed data
+        '''
+        chunk_size = chunk_size or self.STREAM_CHUNK_SIZE
+        if self._codec is None:
+            yield from self._iter_file(key, chunk_size, byte_range)
+            return
+        chunks = iter_split(iter_decoded(self._iter_file(key, chunk_size), self._read_codec(key), detect=True), chunk_size)
+        if isinstance(byte_range, tuple):
+            chunks = iter_range(chunks, byte_range[0], byte_range[1])
+        yield from chunks
+
+    def _iter_file(self, key:str, chunk_size:int, byte_range:Tuple[int,Union[int,None]]=None)->Iterator[ByteString]:
+        ''' iterate over the stored file by chunks '''
+        file_path = self._path / Path(key)
+        first_byte, last_byte = byte_range if isinstance(byte_range, tuple) else (0, None)
+        try:
+            with open(file_path, "rb") as f:
+                f.seek(first_byte)
+                to_read = None if last_byte is None else last_byte - first_byte + 1
+                while to_read is None or to_read > 0:
+                    chunk = f.read(chunk_size if to_read is None else min(chunk_size, to_read))
+                    if len(chunk)==0:
+                        break
+                    if to_read is not None:
+                        to_read -= len(chunk)
+                    yield chunk
+        except Exception as e:
+            _top_logger.error(f"Fail to stream blob {key} with exception {e}")
+            raise e
+
+    async def _read_one_object(self, key:str, encoding:str=None, format:str=None)->Union[ByteString, str, Dict, List]:
+        ''' async non-blocking read of (possibly compressed) object '''
+        blob = await read_the_file(self._path / Path(key))
+        try:
+            res = self._decode_blob(key, blob)
+            if res is not None and isinstance(encoding, str):
+                res = res.decode(encoding)
+                if format is not None:
+                    res = json.loads(res)
+            return res
+        except Exception as e:
+            _top_logger.warning(f"Fail to decode {key} with exception {e}")
+        return None
+
     async def get_objects(self, filter:str, keys:List[str], encoding:str="utf8", format:str="json")->List[Union[ByteString, str, Dict, List]]:
         ''' get all objects from the Datasource '''
         obj_load_tasks = [
             # asyncio.create_task(read_the_file(self._path / Path(v), encoding, format)) 
-            read_the_file(self._path / Path(v), encoding, format)
+            read_the_file(self._path / Path(v), encoding, format) if self._codec is None else self._read_one_object(v, encoding, format)
             for v in (keys if isinstance(keys, list) else self.list_objects(filter))
         ]
         results = await asyncio.gather(*obj_load_tasks)
         return results
 
-    def put_object(self, key:str, obj:Union[str, ByteString], encoding:str="utf-8")->bool:
+    def put_object(self, key:str, obj:Union[str, ByteString], encoding:str="utf-8", metadata:dict=None)->bool:
         ''' add the object to the Datasource (replace if exists) '''
         file_path = self._path / Path(key)
         file_subfolders = file_path.parent
         file_subfolders.mkdir(parents=True, exist_ok=True)
+        obj_is_text = not isinstance(obj, ByteString)
+        blob = obj.encode(encoding=encoding) if obj_is_text else obj
+        codec = self._write_codec(key)
         try:
-            with open(file_path, f"w{'b' if isinstance(obj, ByteString) else ''}") as f:
-                f.write(obj)
+            with open(file_path, "wb") as f:
+                f.write(blob if codec is None else codec.compress(blob))
         except Exception as e:
             _top_logger.error(f"Fail to write object with exception {e}")
             return False
+        self._index_put(key, len(blob), obj_is_text, metadata)
+        return True
+
+    def put_object_from_iter(self, key:str, chunks:Iterable[Union[str, ByteString]], encoding:str="utf-8", metadata:dict=None)->bool:
+        ''' add the object to the Datasource (replace if exists) from the chunks iterator
+            NOTE that chunks are written to the temporary file which replaces the object when all chunks written
+            so the current object can be read while the new one is written
+        '''
+        file_path = self._path / Path(key)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = file_path.with_name(f".{file_path.name}.{os.getpid()}.tmp")
+        codec = self._write_codec(key)
+        size = 0     # size of the object (before compression) for the metadata index
+
+        def encoded_chunks()->Iterator[ByteString]:
+            nonlocal size
+            for v in chunks:
+                chunk = v if isinstance(v, ByteString) else v.encode(encoding=encoding)
+                size += len(chunk)
+                yield chunk
+
+        chunks_iter = encoded_chunks() if codec is None else codec.iter_compress(encoded_chunks())
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks_iter:
+                    f.write(chunk)
+            os.replace(tmp_path, file_path)
+        except Exception as e:
+            _top_logger.error(f"Fail to write object {key} with exception {e}")
+            tmp_path.unlink(missing_ok=True)
+            return False
+        self._index_put(key, size, None, metadata)
         return True
 
+    def _remove_empty_folders(self, folder:Path):
+        ''' we'll try to remove empty folder and its parents (if any) up to the Datasource folder '''
+        while self._path in folder.parents:
+            try:
+                folder.rmdir()
+            except Exception as e:
+                _top_logger.debug(f"Was not able to remove folder {folder} with exception {e}")
+                break
+            folder = folder.parent
+
     def remove_object(self, key:str)->bool:
         ''' remove (delete) the object from the Datasource '''
         file_path = self._path / Path(key)
-        file_subfolders = file_path.parent
         try:
             file_path.unlink()
         except Exception as e:
             _top_logger.error(f"Fail to remove object {key} with exception {e}")
             return False
-        # we'll try to remove empty parent folder if any
-        while file_path.parent:
-            file_path = file_path.parent
-            try:
-                file_path.rmdir()
-            except Exception as e:
-                _top_logger.debug(f"Was not able to remove folder {file_path} with exception {e}")
-                break
+        self._remove_empty_folders(file_path.parent)
+        self._index_remove([key])
         return True
 
+    async def _remove_one_file(self, key:str)->bool:
+        ''' async non-blocking file remove '''
+        try:
+            await LocalFolder._aiofiles_os().remove(self._path / Path(key))
+        except Exception as e:
+            _top_logger.error(f"Fail to remove object {key} with exception {e}")
+            return False
+        return True
 
-    def remove_objects(self, filter:str)->List[bool]:
-        ''' remove/delete multiple objects from the Datasource '''
-        raise RuntimeError("NOT IMPLEMENTED")
+    async def remove_objects(self, filter:str=None, keys:List[str]=None)->List[bool]:
+        ''' remove/delete multiple objects from the Datasource (files are removed concurrently) '''
+        obj_keys = keys if isinstance(keys, list) else self.list_objects(filter=filter)
+        results = await asyncio.gather(*[self._remove_one_file(v) for v in obj_keys])
+        # cleanup of empty folders is done after all files removed (deepest folders first)
+        for v in sorted({(self._path / Path(k)).parent for k in obj_keys}, key=lambda p: len(p.parts), reverse=True):
+            self._remove_empty_folders(v)
+        self._index_remove([k for k, v in zip(obj_keys, results) if v])
+        return results
 
     def query_objects(self, meta_data_query:dict)->List[str]:
-        ''' query objects by metadata in the Datasource '''
-        raise RuntimeError("NOT IMPLEMENTED")
+        ''' query objects by metadata in the Datasource (requires metadata_index in config) '''
+        return self._query_index(meta_data_query)
@@ -0,0 +1,364 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+ObjectsDatasource implementation in the process memory (for benchmarks, local load tests and unit tests) '''
+#! NOTE that objects are stored in the class level stores (by store_name)
+#! so multiple Datasources (like telemetry and history) in one process can share the same store
+
+from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from pathlib import PurePosixPath
+from threading import RLock
+from typing import Union, Dict, List, ByteString, Tuple, Iterator, Iterable
+import asyncio
+import random
+import time
+import json
+import logging
+_top_logger = logging.getLogger(__name__)
+
+from . import ObjectsDatasource, MetadataIndex
+from .ObjectsCodec import ObjectsCodec, iter_split
+
+@dataclass(eq=True, frozen=True)
+class MemoryConfig:
+    store_name:str="default"    # - name of the shared in-memory store
+    key_prefix:str=""           # - the "path" to the "folder" serving as Datasource (like for S3Bucket)
+    latency:float=0.0           # - simulated latency (seconds) of every request
+    bandwidth:float=None        # - simulated bandwidth (bytes per second) of one request (None - unlimited)
+    failure_rate:float=0.0      # - probability (0..1) of simulated request failure
+    seed:int=None               # - seed for failures generator (for deterministic runs)
+    max_concurrency:int=32      # - max number of requests in-flight for async methods (like for S3Bucket)
+    codec:str=None              # - (optional) "gzip" or "zstd" to compress stored objects
+    metadata_index:bool=False   # - maintain metadata index on writes/removes (required for query_objects)
+
+
+class _MemoryStore:
+    ''' objects of one store with lazily sorted keys (for listings in lexicographical order) '''
+    def __init__(self) -> None:
+        self.objects:Dict[str, Tuple[bytes, Union[str, None], str]] = {}    # key -> (blob, content encoding, etag)
+        self.version:int = 0
+        self.lock = RLock()
+        self._sorted_keys:List[str] = None
+
+    def sorted_keys(self)->List[str]:
+        with self.lock:
+            if self._sorted_keys is None:
+                self._sorted_keys = sorted(self.objects.keys())
+            return self._sorted_keys
+
+    def put(self, key:str, blob:bytes, content_encoding:str=None):
+        with self.lock:
+            self.version += 1
+            if key not in self.objects:
+                self._sorted_keys = None
+            self.objects[key] = (blob, content_encoding, f'"{self.version:x}"')
+
+    def remove(self, key:str)->bool:
+        with self.lock:
+            if self.objects.pop(key, None) is None:
+                return False
+            self._sorted_keys = None
+            return True
+
+
+class Memory(ObjectsDatasource):
+    '''
+        ObjectsDatasource implementation with objects in the process memory
+        - optional simulated per-request latency, bandwidth and failures
+          (so logic can be benchmarked separately from real I/O)
+        - failures are handled like in S3Bucket (logged and reported as None/False results)
+    '''
+    # SOME CONSTANTS
+    DELIMITER = "/"
+    MAX_DELETE_BATCH = 1000     # max number of keys in one simulated delete request (like S3 DeleteObjects)
+
+    # all stores in the process (by store_name)
+    _stores:Dict[str, _MemoryStore] = {}
+    _stores_lock = RLock()
+
+    @staticmethod
+    def clear(store_name:str=None):
+        ''' remove all objects from the store (or all stores if store_name is not provided) '''
+        with Memory._stores_lock:
+            if isinstance(store_name, str):
+                Memory._stores.pop(store_name, None)
+            else:
+                Memory._stores.clear()
+
+    def __init__(self, config:dict):
+        '''  '''
+        # Verify that the config contains a dictionary object with required parameters
+        try:
+            self._config = MemoryConfig(**(config or {}))
+        except Exception as e:
+            _top_logger.error(f"Layer-Memory: config should be a dict and has required values. Failed with exception {e}")
+            raise ValueError
+        with Memory._stores_lock:
+            self._store:_MemoryStore = Memory._stores.setdefault(self._config.store_name, _MemoryStore())
+        self._prefix:str = self._config.key_prefix
+        self._codec = ObjectsCodec.create(self._config.codec)
+        self._index = MetadataIndex(self, self.INDEX_PREFIX) if self._config.metadata_index else None
+        self._random = random.Random(self._config.seed)
+        self.stats:Dict[str,int] = {
+            "requests": 0,      # all simulated requests
+            "failures": 0,      # simulated failures
+            "bytes_in": 0,      # stored bytes written
+            "bytes_out": 0,     # stored bytes read
+        }
+
+    #-----------------------------------------------------------------
+    # simulation of the remote storage
+    def _request_delay(self, size:int=0)->float:
+        ''' account the request and return simulated delay. Raise ConnectionError for simulated failure '''
+        self.stats["requests"] += 1
+        if self._config.failure_rate > 0 and self._random.random() < self._config.failure_rate:
+            self.stats["failures"] += 1
+            raise ConnectionError("Memory: simulated request failure")
+        return self._config.latency + (size / self._config.bandwidth if self._config.bandwidth else 0.0)
+
+    def _request(self, size:int=0):
+        ''' simulate blocking request '''
+        delay = self._request_delay(size)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def _async_request(self, in_flight:asyncio.Semaphore, size:int=0):
+        ''' simulate non-blocking request (in_flight limits number of concurrent requests) '''
+        async with in_flight:
+            delay = self._request_delay(size)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def _store_key(self, key:str)->str:
+        ''' full store key for the Datasource key '''
+        return f"{self._prefix}{self.DELIMITER if len(self._prefix)>0 else ''}{key}"
+
+    def _ds_key(self, store_key:str)->str:
+        ''' Datasource key for the full store key '''
+        return store_key[len(self._prefix)+len(self.DELIMITER):] if len(self._prefix)>0 else store_key
+
+    def _stored(self, key:str)->Tuple[bytes, Union[str, None], str]:
+        res = self._store.objects.get(self._store_key(key), None)
+        if res is None:
+            raise KeyError(f"Object {key} does not exist")
+        return res
+
+    def _encoded(self, key:str, obj:Union[str, ByteString], encoding:str)->Tuple[bytes, Union[ObjectsCodec, None], int]:
+        ''' stored blob, codec and size of the object (before compression) '''
+        blob = bytes(obj) if isinstance(obj, ByteString) else obj.encode(encoding=encoding)
+        codec = self._write_codec(key)
+        return (blob if codec is None else codec.compress(blob)), codec, len(blob)
+
+    #-----------------------------------------------------------------
+    # ObjectsDatasource implementation
+    def list_objects(self, prefix:str=None, filter:str=None)->List[str]:
+        ''' list all objects in the Datasource
+            NOTE that filter is a glob-style pattern matched from the right (like "2023/*/*/*")
+        '''
+        return list(self.iter_keys(prefix=prefix, filter=filter))
+
+    def iter_keys(self, prefix:str=None, filter:str=None, start_after:str=None, page_size:int=None)->Iterator[str]:
+        ''' lazy list of objects in the Datasource (keys are yielded in lexicographical order)
+            start_after - (optional) only keys after this key will be listed (for resumable listing)
+            NOTE that every page_size keys are simulated as one request (default is 1000 like for S3)
+        '''
+        store_prefix = self._store_key(prefix or "")
+        keys = self._store.sorted_keys()
+        pos = bisect_left(keys, store_prefix)
+        if isinstance(start_after, str):
+            pos = max(pos, bisect_right(keys, self._store_key(start_after)))
+        page_size = page_size or 1000
+        while True:
+            try:
+                self._request()
+            except Exception as e:
+                _top_logger.error(f"FAIL to collect objects list from store {self._config.store_name} with exception {e}")
+                return
+            page = keys[pos:pos+page_size]
+            for v in page:
+                if not v.startswith(store_prefix):
+                    return
+                key = self._ds_key(v)
+                if self._is_hidden(key, prefix) or (isinstance(filter, str) and not PurePosixPath(key).match(filter)):
+                    continue
+                yield key
+            if len(page) < page_size:
+                return
+            pos += page_size
+
+    def list_prefixes(self, prefix:str=None)->List[str]:
+        ''' list "sub-folders" of the prefix (common prefixes up to the next DELIMITER, including DELIMITER) '''
+        store_prefix = self._store_key(prefix or "")
+        try:
+            self._request()
+        except Exception as e:
+            _top_logger.error(f"FAIL to collect prefixes list from store {self._config.store_name} with exception {e}")
+            return []
+        keys = self._store.sorted_keys()
+        res = []
+        pos = bisect_left(keys, store_prefix)
+        while pos < len(keys) and keys[pos].startswith(store_prefix):
+            delimiter_pos = keys[pos].find(self.DELIMITER, len(store_prefix))
+            if delimiter_pos < 0:
+                pos += 1
+                continue
+            common_prefix = keys[pos][:delimiter_pos+1]
+            if not self._is_hidden(self._ds_key(common_prefix), prefix):
+                res.append(self._ds_key(common_prefix))
+            # skip all keys with the same common prefix
+            pos = bisect_right(keys, common_prefix + "\U0010ffff", lo=pos)
+        return res
+
+    def get_blob(self, key:str)->ByteString:
+        ''' get the blob from the Datasource '''
+        result = None
+        try:
+            blob, content_encoding, _ = self._stored(key)
+            self._request(len(blob))
+            self.stats["bytes_out"] += len(blob)
+            result = self._decode_blob(key, blob, content_encoding)
+        except Exception as e:
+            _top_logger.error(f"FAIL to collect blob {key} from store {self._config.store_name} with exception {e}")
+            result = None
+        return result
+
+    def get_blob_if_changed(self, key:str, etag:str=None)->Tuple[Union[ByteString, None], Union[str, None]]:
+        ''' conditional get of the blob from the Datasource
+            return tuple (blob, etag) where blob is None if the object's etag is the same as provided (not modified)
+        '''
+        try:
+            blob, content_encoding, stored_etag = self._stored(key)
+            if stored_etag == etag:
+                self._request()
+                return None, etag
+            self._request(len(blob))
+            self.stats["bytes_out"] += len(blob)
+            return self._decode_blob(key, blob, content_encoding), stored_etag
+        except Exception as e:
+            _top_logger.error(f"FAIL to collect blob {key} from store {self._config.store_name} with exception {e}")
+            raise e
+
+    def iter_blob(self, key:str, chunk_size:int=None, byte_range:Tuple[int,Union[int,None]]=None)->Iterator[ByteString]:
+        ''' iterate over the blob from the Datasource by chunks
+            byte_range is a tuple (first_byte, last_byte) with INCLUSIVE last_byte (like HTTP Range header)
+            NOTE that byte_range of compressed object is applied to decompressed data
+        '''
+        chunk_size = chunk_size or self.STREAM_CHUNK_SIZE
+        try:
+            blob, content_encoding, _ = self._stored(key)
+            codec = self._read_codec(key, content_encoding)
+            if codec is not None or not isinstance(byte_range, tuple):
+                self._request(len(blob))
+                self.stats["bytes_out"] += len(blob)
+                blob = self._decode_blob(key, blob, content_encoding)
+            if isinstance(byte_range, tuple):
+                blob = blob[byte_range[0]:(None if byte_range[1] is None else byte_range[1]+1)]
+                if codec is None:
+                    self._request(len(blob))
+                    self.stats["bytes_out"] += len(blob)
+        except Exception as e:
+            _top_logger.error(f"FAIL to stream blob {key} from store {self._config.store_name} with exception {e}")
+            raise e
+        yield from iter_split([blob], chunk_size)
+
+    async def _get_one_object(self, key:str, encoding:str, format:str, in_flight:asyncio.Semaphore)->Union[ByteString, str, Dict, List, None]:
+        ''' get and decode one object. Any failure is isolated to this key (None will be returned) '''
+        try:
+            blob, content_encoding, _ = self._stored(key)
+            await self._async_request(in_flight, len(blob))
+            self.stats["bytes_out"] += len(blob)
+            res = self._decode_blob(key, blob, content_encoding)
+            if isinstance(encoding, str):
+                res = res.decode(encoding)
+                match format:
+                    case "json":
+                        res = json.loads(res)
+            return res
+        except Exception as e:
+            _top_logger.error(f"FAIL to get object {key} with exception {e}")
+        return None
+
+    async def get_objects(self, filter:str, keys:List[str], encoding:str="utf8", format:str="json")->List[Union[ByteString, str, Dict, List]]:
+        ''' get all objects from the Datasource
+            NOTE that results are in the same order as keys and None is returned for the keys failed to collect
+        '''
+        in_flight = asyncio.Semaphore(self._config.max_concurrency)
+        obj_load_tasks = [
+            self._get_one_object(v, encoding, format, in_flight)
+            for v in (keys if isinstance(keys, list) else self.list_objects(filter=filter))
+        ]
+        return await asyncio.gather(*obj_load_tasks)
+
+    def put_object(self, key:str, obj:Union[str, ByteString], encoding:str="utf-8", metadata:dict=None)->bool:
+        ''' add the object to the Datasource (replace if exists) '''
+        try:
+            blob, codec, size = self._encoded(key, obj, encoding)
+            self._request(len(blob))
+            self.stats["bytes_in"] += len(blob)
+            self._store.put(self._store_key(key), blob, None if codec is None else codec.name)
+        except Exception as e:
+            _top_logger.error(f"FAIL to put object {key} to store {self._config.store_name} with exception {e}")
+            return False
+        self._index_put(key, size, not isinstance(obj, ByteString), metadata)
+        return True
+
+    def put_object_from_iter(self, key:str, chunks:Iterable[Union[str, ByteString]], encoding:str="utf-8", metadata:dict=None)->bool:
+        ''' add the object to the Datasource (replace if exists) from the chunks iterator
+            NOTE that the object is stored in memory anyway so chunks are just joined
+        '''
+        try:
+            blob, codec, size = self._encoded(
+                key, b"".join(v if isinstance(v, ByteString) else v.encode(encoding=encoding) for v in chunks), encoding
+            )
+            self._request(len(blob))
+            self.stats["bytes_in"] += len(blob)
+            self._store.put(self._store_key(key), blob, None if codec is None else codec.name)
+        except Exception as e:
+            _top_logger.error(f"FAIL to put object {key} to store {self._config.store_name} with exception {e}")
+            return False
+        self._index_put(key, size, None, metadata)
+        return True
+
+    def remove_object(self, key:str)->bool:
+        ''' remove (delete) the object from the Datasource '''
+        try:
+            self._request()
+            if not self._store.remove(self._store_key(key)):
+                raise KeyError(f"Object {key} does not exist")
+        except Exception as e:
+            _top_logger.error(f"FAIL to remove object {key} from store {self._config.store_name} with exception {e}")
+            return False
+        self._index_remove([key])
+        return True
+
+    async def _remove_batch(self, keys:List[str], in_flight:asyncio.Semaphore)->List[bool]:
+        ''' remove up to MAX_DELETE_BATCH objects with one simulated request (like S3 DeleteObjects) '''
+        try:
+            await self._async_request(in_flight)
+        except Exception as e:
+            _top_logger.error(f"FAIL to remove {len(keys)} objects from store {self._config.store_name} with exception {e}")
+            return [False]*len(keys)
+        results = [self._store.remove(self._store_key(v)) for v in keys]
+        if not all(results):
+            _top_logger.error(f"FAIL to remove {results.count(False)} objects from store {self._config.store_name} as they do not exist")
+        return results
+
+    async def remove_objects(self, filter:str=None, keys:List[str]=None)->List[bool]:
+        ''' remove/delete multiple objects from the Datasource
+            NOTE that objects are removed in batches of MAX_DELETE_BATCH keys (one simulated request per batch like S3Bucket)
+        '''
+        obj_keys = keys if isinstance(keys, list) else self.list_objects(filter=filter)
+        in_flight = asyncio.Semaphore(self._config.max_concurrency)
+        batch_results = await asyncio.gather(*[
+            self._remove_batch(obj_keys[i:i+self.MAX_DELETE_BATCH], in_flight)
+            for i in range(0, len(obj_keys), self.MAX_DELETE_BATCH)
+        ])
+        results = [x for l in batch_results for x in l]
+        self._index_remove([k for k, v in zip(obj_keys, results) if v])
+        return results
+
+    def query_objects(self, meta_data_query:dict)->List[str]:
+        ''' query objects by metadata in the Datasource (requires metadata_index in config) '''
+        return self._query_index(meta_data_query)
@@ -0,0 +1,316 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Metadata index of the objects (used by ObjectsDatasource implementations for query_objects) '''
+#! NOTE that index is stored in the same Datasource under the reserved prefix (see ObjectsDatasource.INDEX_PREFIX)
+#! as immutable segments. Every segment is sorted by key, the newest segment wins for the same key.
+#! Segments are never modified so multiple writers (like concurrent Lambdas) can't corrupt the index
+
+from dataclasses import dataclass
+from contextlib import contextmanager
+from bisect import bisect_left
+from pathlib import PurePosixPath
+from threading import RLock
+from typing import Union, Dict, List, Tuple, Iterator, Any, Callable
+from concurrent.futures import ThreadPoolExecutor
+import mimetypes
+import time
+import uuid
+import json
+import logging
+_top_logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MetadataEntry:
+    key:str
+    size:int=None
+    timestamp:int=None          # epoch milliseconds
+    content_type:str=None
+    tags:Dict[str,str]=None
+    deleted:bool=False          # tombstone of removed object
+
+
+def timestamp_from_key(key:str)->Union[int, None]:
+    ''' timestamp (epoch ms) encoded as the last part of the key (like telemetry keys) or None '''
+    name = PurePosixPath(key).name.split(".")[0]
+    return int(name) if name.isdigit() and len(name) >= 10 else None
+
+
+def make_entry(key:str, size:int=None, obj_is_text:bool=None, metadata:dict=None)->MetadataEntry:
+    ''' metadata entry of the written object (metadata provided by writer takes precedence) '''
+    metadata = metadata or {}
+    content_type = metadata.get("content_type", None) or mimetypes.guess_type(key)[0]
+    if content_type is None and obj_is_text is not None:
+        content_type = "text/plain" if obj_is_text else "application/octet-stream"
+    timestamp = metadata.get("timestamp", None) or timestamp_from_key(key) or int(time.time()*1000)
+    return MetadataEntry(
+        key=key, size=size, timestamp=timestamp, content_type=content_type,
+        tags={k: str(v) for k, v in metadata["tags"].items()} if isinstance(metadata.get("tags", None), dict) else None
+    )
+
+
+class _Segment:
+    ''' one loaded segment (columns are in the keys order) '''
+    VERSION = 1
+
+    def __init__(self, entries:List[MetadataEntry]=None, serialized:dict=None) -> None:
+        if isinstance(serialized, dict):
+            if serialized.get("v", None) != self.VERSION:
+                raise ValueError(f"Segment version {serialized.get('v', None)} is not supported")
+            self.keys:List[str] = serialized["keys"]
+            self.sizes:List[int] = serialized["size"]
+            self.timestamps:List[int] = serialized["ts"]
+            ct_values = serialized["ct_values"]
+            self.content_types:List[str] = [None if v is None else ct_values[v] for v in serialized["ct"]]
+            self.tags:List[Dict[str,str]] = serialized["tags"]
+            self.deleted = set(serialized["del"])
+            return
+        entries = sorted(entries or [], key=lambda v: v.key)
+        self.keys = [v.key for v in entries]
+        self.sizes = [v.size for v in entries]
+        self.timestamps = [v.timestamp for v in entries]
+        self.content_types = [v.content_type for v in entries]
+        self.tags = [v.tags for v in entries]
+        self.deleted = {i for i, v in enumerate(entries) if v.deleted}
+
+    def serialize(self)->dict:
+        ''' compact columnar representation (content types are dictionary-encoded, tombstones are sparse) '''
+        ct_values = sorted({v for v in self.content_types if v is not None})
+        ct_index = {v: i for i, v in enumerate(ct_values)}
+        return {
+            "v": self.VERSION,
+            "keys": self.keys,
+            "size": self.sizes,
+            "ts": self.timestamps,
+            "ct_values": ct_values,
+            "ct": [None if v is None else ct_index[v] for v in self.content_types],
+            "tags": self.tags,
+            "del": sorted(self.deleted),
+        }
+
+    def entry(self, i:int)->MetadataEntry:
+        return MetadataEntry(
+            key=self.keys[i], size=self.sizes[i], timestamp=self.timestamps[i],
+            content_type=self.content_types[i], tags=self.tags[i], deleted=i in self.deleted
+        )
+
+    def iter_positions(self, prefix:str=None)->Iterator[int]:
+        ''' positions of the keys with the prefix (keys are sorted so we can start from the first match) '''
+        pos = bisect_left(self.keys, prefix) if isinstance(prefix, str) else 0
+        while pos < len(self.keys) and (prefix is None or self.keys[pos].startswith(prefix)):
+            yield pos
+            pos += 1
+
+
+class MetadataIndex:
+    '''
+        Sidecar index of objects metadata (key -> size, timestamp, content type, user tags)
+        - changes are buffered and stored as a new segment by flush() (or when FLUSH_THRESHOLD entries are buffered)
+          so writers MUST call flush() when done (like at the end of the invocation) or use batch()
+        - segments are merged into one when there are more than MAX_SEGMENTS
+        - query is answered from segments and buffered entries only (objects are never collected)
+    '''
+    # index is compacted when number of segments exceeds this value
+    MAX_SEGMENTS = 16
+    # buffered entries are stored as a segment when there are this many of them
+    FLUSH_THRESHOLD = 1000
+    # supported operators of query predicates
+    OPERATORS:Dict[str, Callable[[Any, Any], bool]] = {
+        "eq": lambda v, q: v == q,
+        "ne": lambda v, q: v != q,
+        "in": lambda v, q: v in q,
+        "gt": lambda v, q: v is not None and v > q,
+        "gte": lambda v, q: v is not None and v >= q,
+        "lt": lambda v, q: v is not None and v < q,
+        "lte": lambda v, q: v is not None and v <= q,
+        "prefix": lambda v, q: isinstance(v, str) and v.startswith(q),
+    }
+
+    def __init__(self, datasource, prefix:str) -> None:
+        self._ds = datasource
+        self._prefix:str = prefix
+        self._pending:Dict[str, MetadataEntry] = {}
+        self._batch_depth:int = 0
+        self._lock = RLock()
+        # segments are immutable so loaded segments can be reused (for example by "hot start" Lambda invocations)
+        self._segments:Dict[str, _Segment] = {}
+        # number of segments known (listed or written since) so flush doesn't list segments every time
+        self._known_segments:int = None
+
+    #-----------------------------------------------------------------
+    # index maintenance
+    def add(self, entry:MetadataEntry):
+        ''' add (or replace) the entry in the index '''
+        with self._lock:
+            self._pending[entry.key] = entry
+            if self._batch_depth == 0 and len(self._pending) >= self.FLUSH_THRESHOLD:
+                self.flush()
+
+    def remove(self, keys:List[str]):
+        ''' add tombstones for the removed objects '''
+        with self._lock:
+            for k in keys:
+                self._pending[k] = MetadataEntry(key=k, deleted=True)
+            if self._batch_depth == 0 and len(self._pending) >= self.FLUSH_THRESHOLD:
+                self.flush()
+
+    @contextmanager
+    def batch(self):
+        ''' all changes done within the context are stored as one segment '''
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.flush()
+
+    def flush(self)->bool:
+        ''' store buffered entries as a new segment '''
+        with self._lock:
+            if len(self._pending) == 0:
+                return True
+            segment = _Segment(entries=list(self._pending.values()))
+            # segment keys are ordered by the time of write (newer segment wins)
+            segment_key = f"{self._prefix}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+            if not self._ds.put_object(segment_key, json.dumps(segment.serialize(), separators=(",", ":"))):
+                _top_logger.error(f"MetadataIndex: FAIL to store segment with {len(self._pending)} entries")
+                return False
+            self._pending.clear()
+            self._segments[segment_key] = segment
+            if self._known_segments is not None:
+                self._known_segments += 1
+        # NOTE that segments are listed only when the index can need compaction (segments of other writers are not known)
+        if (self._known_segments is None or self._known_segments > self.MAX_SEGMENTS) and len(self._segment_keys()) > self.MAX_SEGMENTS:
+            self.compact()
+        return True
+
+    def compact(self)->bool:
+        ''' merge all segments into one (tombstones are dropped) '''
+        segment_keys = self._segment_keys()
+        if len(segment_keys) < 2:
+            return True
+        merged = [v for v in self._merged_entries(segment_keys, {}) if not v.deleted]
+        # merged segment has the "time" of the newest merged segment
+        # so segments written during compaction are still newer
+        compacted_key = f"{segment_keys[-1].rsplit('-', 1)[0]}-{uuid.uuid4().hex[:8]}.json"
+        segment = _Segment(entries=merged)
+        if not self._ds.put_object(compacted_key, json.dumps(segment.serialize(), separators=(",", ":"))):
+            _top_logger.error(f"MetadataIndex: FAIL to store compacted segment with {len(merged)} entries")
+            return False
+        self._segments[compacted_key] = segment
+        for k in segment_keys:
+            self._ds.remove_object(k)
+            self._segments.pop(k, None)
+        self._known_segments = 1
+        return True
+
+    def reindex(self, prefix:str=None)->int:
+        ''' add existing objects (written bypassing the index, like by IoT rules) to the index
+            NOTE that only keys are listed (objects are not collected) so size is not known
+        '''
+        count = 0
+        with self.batch():
+            for key in self._ds.iter_keys(prefix=prefix):
+                self._pending[key] = make_entry(key)
+                count += 1
+        return count
+
+    #-----------------------------------------------------------------
+    # index query
+    def _segment_keys(self)->List[str]:
+        ''' all segments (the oldest first) '''
+        segment_keys = sorted(self._ds.iter_keys(prefix=self._prefix))
+        self._known_segments = len(segment_keys)
+        return segment_keys
+
+    def _get_segment(self, segment_key:str)->Union[dict, None]:
+        ''' serialized segment (None when segment is not available, like removed by compaction) '''
+        try:
+            return self._ds.get_object(segment_key)
+        except Exception as e:
+            _top_logger.warning(f"MetadataIndex: FAIL to collect segment {segment_key} with exception {e}")
+        return None
+
+    def _load_segments(self, segment_keys:List[str])->List[str]:
+        ''' collect segments not loaded yet (concurrently)
+            return keys of the segments available (in the same order)
+            NOTE that segments can be removed by compaction of another writer after the listing
+                 so segments are listed again once (compacted segment replaces removed ones) and segments
+                 still not available are skipped
+        '''
+        for attempt in range(2):
+            to_load = [v for v in segment_keys if v not in self._segments]
+            if len(to_load) > 0:
+                # NOTE that query can be called from the async code so threads are used instead of event loop
+                with ThreadPoolExecutor(max_workers=min(len(to_load), self.MAX_SEGMENTS), thread_name_prefix="MetadataIndex") as executor:
+                    loaded = list(executor.map(self._get_segment, to_load))
+                for k, v in zip(to_load, loaded):
+                    if v is not None:
+                        self._segments[k] = _Segment(serialized=v)
+            if all(k in self._segments for k in segment_keys):
+                break
+            if attempt == 0:
+                segment_keys = self._segment_keys()
+        missing = [k for k in segment_keys if k not in self._segments]
+        if len(missing) > 0:
+            _top_logger.error(f"MetadataIndex: {len(missing)} segments are not available and skipped")
+            segment_keys = [k for k in segment_keys if k in self._segments]
+        # forget segments removed by compaction
+        for k in set(self._segments.keys()) - set(segment_keys):
+            self._segments.pop(k, None)
+        return segment_keys
+
+    def _merged_entries(self, segment_keys:List[str], pending:Dict[str, MetadataEntry], prefix:str=None)->List[MetadataEntry]:
+        ''' actual entries (the newest entry for every key) in the keys order '''
+        segment_keys = self._load_segments(segment_keys)
+        seen:Dict[str, MetadataEntry] = {k: v for k, v in pending.items() if prefix is None or k.startswith(prefix)}
+        for segment_key in reversed(segment_keys):
+            segment = self._segments[segment_key]
+            for i in segment.iter_positions(prefix):
+                if segment.keys[i] not in seen:
+                    seen[segment.keys[i]] = segment.entry(i)
+        return [seen[k] for k in sorted(seen.keys())]
+
+    @staticmethod
+    def _predicates(meta_data_query:dict)->Tuple[Union[str, None], List[Tuple[str, Callable[[Any, Any], bool], Any]]]:
+        ''' parse the query to the key prefix and list of (field, operator, value) '''
+        prefix = None
+        predicates = []
+        for field, condition in (meta_data_query or {}).items():
+            if field == "prefix":
+                prefix = condition
+                continue
+            if field not in ["key", "size", "timestamp", "content_type"] and not field.startswith("tags."):
+                raise ValueError(f"Query field {field} is not supported")
+            for op, value in (condition.items() if isinstance(condition, dict) else [("eq", condition)]):
+                if op not in MetadataIndex.OPERATORS:
+                    raise ValueError(f"Query operator {op} is not supported")
+                predicates.append((field, MetadataIndex.OPERATORS[op], value))
+        return prefix, predicates
+
+    @staticmethod
+    def _field_value(entry:MetadataEntry, field:str)->Any:
+        if field.startswith("tags."):
+            return (entry.tags or {}).get(field[len("tags."):], None)
+        return getattr(entry, field)
+
+    def query(self, meta_data_query:dict)->List[str]:
+        ''' keys of objects matching ALL predicates of the query (in the keys order)
+            query is a dict of field -> value (equality) or field -> {operator: value}
+            - fields: prefix (key prefix), key, size, timestamp, content_type, tags.<tag name>
+            - operators: eq, ne, in, gt, gte, lt, lte, prefix
+            for example {"prefix": "dt/diyiot/", "timestamp": {"gte": 1683599820600}, "tags.thing_type": "X"}
+        '''
+        prefix, predicates = self._predicates(meta_data_query)
+        with self._lock:
+            pending = dict(self._pending)
+        return [
+            v.key for v in self._merged_entries(self._segment_keys(), pending, prefix)
+                if not v.deleted and all(op(self._field_value(v, field), value) for field, op, value in predicates)
+        ]
+
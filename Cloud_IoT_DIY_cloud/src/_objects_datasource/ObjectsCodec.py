@@ -0,0 +1,235 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Compression codecs for stored objects (used by ObjectsDatasource implementations) '''
+#! NOTE that zstd codec depends on zstandard module which is NOT a part of Lambda runtime!
+#! This is a responsibility of consuming service to install it if zstd is in use
+
+from abc import ABC, abstractmethod
+from importlib import import_module
+from typing import Union, Dict, ByteString, Iterator, Iterable
+from enum import Enum
+import zlib
+import logging
+_top_logger = logging.getLogger(__name__)
+
+class ObjectsCodecType(Enum):
+    gzip="gzip"
+    zstd="zstd"
+
+
+class ObjectsCodec(ABC):
+    '''
+        Compression codec for the stored objects
+        - name is the same as HTTP Content-Encoding value (so it can be stored as S3 object metadata)
+        - suffix is the key suffix for the objects always stored with this codec (like history.json.gz)
+        - magic is the first bytes of the compressed object (used when there is no metadata, like for local files)
+    '''
+    name:str = None
+    suffix:str = None
+    magic:bytes = None
+
+    @abstractmethod
+    def compress(self, data:ByteString)->bytes:
+        ''' compress the whole blob '''
+
+    @abstractmethod
+    def decompress(self, data:ByteString)->bytes:
+        ''' decompress the whole blob '''
+
+    @abstractmethod
+    def iter_compress(self, chunks:Iterable[ByteString])->Iterator[bytes]:
+        ''' compress stream of chunks (without loading the whole blob into memory) '''
+
+    @abstractmethod
+    def iter_decompress(self, chunks:Iterable[ByteString])->Iterator[bytes]:
+        ''' decompress stream of chunks (without loading the whole blob into memory) '''
+
+    # codecs are stateless so we'll create every codec only once
+    _codecs:Dict[str, "ObjectsCodec"] = {}
+
+    @staticmethod
+    def create(name:Union[str, ObjectsCodecType, None])->Union["ObjectsCodec", None]:
+        ''' get the codec by name (or None if name is None) '''
+        if name is None:
+            return None
+        name = name if isinstance(name, str) else name.value
+        if name not in ObjectsCodec._codecs:
+            if name not in CODEC_CLASSES:
+                raise ValueError(f"Codec {name} is not supported")
+            ObjectsCodec._codecs[name] = CODEC_CLASSES[name]()
+        return ObjectsCodec._codecs[name]
+
+    @staticmethod
+    def for_key(key:str)->Union["ObjectsCodec", None]:
+        ''' get the codec by the key suffix (or None if the key has no known suffix) '''
+        for name, codec_class in CODEC_CLASSES.items():
+            if key.endswith(codec_class.suffix):
+                return ObjectsCodec.create(name)
+        return None
+
+    @staticmethod
+    def for_content_encoding(content_encoding:str)->Union["ObjectsCodec", None]:
+        ''' get the codec by the Content-Encoding value (or None if encoding is not known or identity) '''
+        if not isinstance(content_encoding, str):
+            return None
+        # Content-Encoding can be a list of encodings - we support only one
+        content_encoding = content_encoding.strip().lower()
+        return ObjectsCodec.create(content_encoding) if content_encoding in CODEC_CLASSES else None
+
+    @staticmethod
+    def detect(head:ByteString)->Union["ObjectsCodec", None]:
+        ''' get the codec by the first bytes of the blob (or None if the blob is not compressed) '''
+        for name, codec_class in CODEC_CLASSES.items():
+            if bytes(head[:len(codec_class.magic)]) == codec_class.magic:
+                return ObjectsCodec.create(name)
+        return None
+
+
+class GzipCodec(ObjectsCodec):
+    ''' gzip codec (zlib from the standard library) '''
+    name = ObjectsCodecType.gzip.value
+    suffix = ".gz"
+    magic = b"\x1f\x8b"
+    # compression level 6 is the default of gzip utility - good balance for json payloads
+    LEVEL = 6
+    # zlib wbits for gzip container
+    WBITS = 16 + zlib.MAX_WBITS
+
+    def compress(self, data:ByteString)->bytes:
+        compressor = zlib.compressobj(self.LEVEL, zlib.DEFLATED, self.WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data:ByteString)->bytes:
+        return zlib.decompress(data, self.WBITS)
+
+    def iter_compress(self, chunks:Iterable[ByteString])->Iterator[bytes]:
+        compressor = zlib.compressobj(self.LEVEL, zlib.DEFLATED, self.WBITS)
+        for chunk in chunks:
+            res = compressor.compress(chunk)
+            if len(res)>0:
+                yield res
+        yield compressor.flush()
+
+    def iter_decompress(self, chunks:Iterable[ByteString])->Iterator[bytes]:
+        decompressor = zlib.decompressobj(self.WBITS)
+        for chunk in chunks:
+            res = decompressor.decompress(chunk)
+            if len(res)>0:
+                yield res
+        res = decompressor.flush()
+        if len(res)>0:
+            yield res
+        if not decompressor.eof:
+            raise ValueError("Unexpected end of gzip stream")
+
+
+class ZstdCodec(ObjectsCodec):
+    ''' zstd codec (requires zstandard module) '''
+    name = ObjectsCodecType.zstd.value
+    suffix = ".zst"
+    magic = b"\x28\xb5\x2f\xfd"
+    LEVEL = 3
+
+    # dynamically loaded zstandard module
+    _zstd = None
+
+    def __init__(self) -> None:
+        if ZstdCodec._zstd is None:
+            try:
+                ZstdCodec._zstd = import_module("zstandard")
+            except Exception as e:
+                _top_logger.error(f"ZstdCodec requires zstandard module. Failed with exception {e}")
+                raise e
+
+    def compress(self, data:ByteString)->bytes:
+        # content size is written into the frame so decompress can allocate output at once
+        return self._zstd.ZstdCompressor(level=self.LEVEL).compress(data)
+
+    def decompress(self, data:ByteString)->bytes:
+        # frames written by iter_compress have no content size so we'll always use streaming decompression
+        return b"".join(self.iter_decompress([data]))
+
+    def iter_compress(self, chunks:Iterable[ByteString])->Iterator[bytes]:
+        compressor = self._zstd.ZstdCompressor(level=self.LEVEL).compressobj()
+        for chunk in chunks:
+            res = compressor.compress(chunk)
+            if len(res)>0:
+                yield res
+        yield compressor.flush()
+
+    def iter_decompress(self, chunks:Iterable[ByteString])->Iterator[bytes]:
+        decompressor = self._zstd.ZstdDecompressor().decompressobj()
+        for chunk in chunks:
+            res = decompressor.decompress(chunk)
+            if len(res)>0:
+                yield res
+
+
+CODEC_CLASSES:Dict[str, type] = {
+    ObjectsCodecType.gzip.value: GzipCodec,
+    ObjectsCodecType.zstd.value: ZstdCodec,
+}
+
+
+def iter_range(chunks:Iterable[ByteString], first_byte:int, last_byte:int=None)->Iterator[ByteString]:
+    ''' select the byte range (last_byte is INCLUSIVE, None - up to the end) from the stream of chunks
+        used for ranged reads of compressed objects (range is always applied to decompressed data)
+    '''
+    pos = 0
+    for chunk in chunks:
+        chunk_start, chunk_end = pos, pos + len(chunk)
+        pos = chunk_end
+        if chunk_end <= first_byte:
+            continue
+        if last_byte is not None and chunk_start > last_byte:
+            break
+        yield chunk[max(first_byte-chunk_start, 0):(len(chunk) if last_byte is None else min(last_byte+1-chunk_start, len(chunk)))]
+        if last_byte is not None and chunk_end > last_byte:
+            break
+
+
+def iter_split(chunks:Iterable[ByteString], chunk_size:int)->Iterator[ByteString]:
+    ''' split chunks larger than chunk_size (decompressed chunk can be much larger than compressed one) '''
+    for chunk in chunks:
+        if len(chunk) <= chunk_size:
+            yield chunk
+            continue
+        for i in range(0, len(chunk), chunk_size):
+            yield chunk[i:i+chunk_size]
+
+
+def decode_blob(blob:ByteString, codec:ObjectsCodec=None, detect:bool=False)->ByteString:
+    ''' decompress the blob with the codec
+        if codec is not known and detect is True - codec will be detected by the first bytes of the blob
+    '''
+    if codec is None and detect:
+        codec = ObjectsCodec.detect(blob)
+    return blob if codec is None else codec.decompress(blob)
+
+
+def iter_decoded(chunks:Iterable[ByteString], codec:ObjectsCodec=None, detect:bool=False)->Iterator[ByteString]:
+    ''' decompress the stream of chunks with the codec
+        if codec is not known and detect is True - codec will be detected by the first bytes of the stream
+    '''
+    chunks = iter(chunks)
+    if codec is None and detect:
+        # we need at least 4 bytes to detect the codec
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head)>=4:
+                break
+        codec = ObjectsCodec.detect(head)
+        chunks = _prepend(head, chunks)
+    if codec is None:
+        yield from chunks
+    else:
+        yield from codec.iter_decompress(chunks)
+
+
+def _prepend(head:ByteString, chunks:Iterator[ByteString])->Iterator[ByteString]:
+    if len(head)>0:
+        yield head
+    yield from chunks
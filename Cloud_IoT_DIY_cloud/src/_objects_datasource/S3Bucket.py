@@ -4,20 +4,30 @@ MIT License
 
 ANoSqlDatasource implementation with file '''
 
-from typing import Union, Dict, List, ByteString
+from typing import Union, Dict, List, ByteString, Tuple, Iterator, Iterable
 from importlib import import_module
 from dataclasses import dataclass
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from pathlib import Path, PurePosixPath
+import asyncio
 import json
 import logging
 _top_logger = logging.getLogger(__name__)
 
-from . import ObjectsDatasource
+from . import ObjectsDatasource, MetadataIndex
+from .ObjectsCodec import ObjectsCodec, iter_decoded, iter_range, iter_split
 
 @dataclass(eq=True, frozen=True)
 class S3BucketConfig:
     bucket_name:str
     key_prefix:str        # - the "path" to the S3 "folder" serving as Datasource
+    max_concurrency:int=32  # - max number of S3 requests in-flight for one datasource (get_objects and similar)
+    multipart_threshold:int=8*1024*1024     # - streamed objects larger than this will be uploaded with multipart upload
+    multipart_chunksize:int=8*1024*1024     # - size of one part of multipart upload (S3 requires at least 5MB)
+    multipart_concurrency:int=4             # - max number of parts uploaded concurrently (peak memory is ~ (concurrency+1)*chunksize)
+    codec:str=None          # - (optional) "gzip" or "zstd" to compress stored objects (stored as ContentEncoding metadata)
+    metadata_index:bool=False   # - maintain metadata index on writes/removes (required for query_objects)
 
 
 class S3Bucket(ObjectsDatasource):
@@ -26,13 +36,20 @@ class S3Bucket(ObjectsDatasource):
     '''
     # SOME CONSTANTS
     DELIMITER = "/"
+    MAX_DELETE_BATCH = 1000     # max number of keys in one DeleteObjects request
+    MIN_PART_SIZE = 5*1024*1024 # min size of multipart upload part (except the last one)
 
-    # dynamically loaded boto3 module
-    _boto3 = None
+    # dynamically loaded registry of shared boto3 clients (aws_clients layer)
+    _aws_clients = None
 
     # Basic client
-    _s3_client = None  # NOTE that boto3 clients are thread-safe
+    _s3_client = None  # NOTE that boto3 clients are thread-safe (and shared by all S3Bucket instances)
 
+    # worker threads pools used to run blocking boto3 calls concurrently
+    # NOTE that pools are shared by all S3Bucket instances with the same max_concurrency (like the client)
+    #      so the number of threads doesn't grow with the number of instances (like one datasource per device)
+    _executors:Dict[int, ThreadPoolExecutor] = {}
+    _executors_lock = Lock()
 
     def __init__(self, config:dict):
         '''  '''
@@ -43,58 +60,101 @@ class S3Bucket(ObjectsDatasource):
             _top_logger.error("Layer-LocalFolder: config should be a dict and has required values. Failed with exception {e}")
             raise ValueError
         try:
-            self._boto3 = import_module("boto3")
-            self._s3_client = self._boto3.client("s3") # NOTE that boto3 clients are thread-safe
+            if S3Bucket._aws_clients is None:
+                S3Bucket._aws_clients = import_module("_aws_clients")
+            # connections pool MUST be at least as large as number of concurrent requests
+            # otherwise urllib3 will discard connections (and we'll lose TCP/TLS reuse)
+            self._s3_client = S3Bucket._aws_clients.AwsClients.client("s3", config={
+                "max_pool_connections": max(self._config.max_concurrency, 10)
+            })
         except Exception as e:
             _top_logger.error(f"FAIL to init S3Bucket datasource with exception {e}")
             raise e
+        self._codec = ObjectsCodec.create(self._config.codec)
+        self._index = MetadataIndex(self, self.INDEX_PREFIX) if self._config.metadata_index else None
         self._prefix:str = self._config.key_prefix
         self._bckt:str = self._config.bucket_name
 
+    @classmethod
+    def _executor_for(cls, max_concurrency:int)->ThreadPoolExecutor:
+        ''' shared worker threads pool with max_concurrency threads (created on first use, reused by hot Lambda starts) '''
+        executor = cls._executors.get(max_concurrency, None)
+        if executor is not None:
+            return executor
+        with cls._executors_lock:
+            if max_concurrency not in cls._executors:
+                cls._executors[max_concurrency] = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="S3Bucket")
+            return cls._executors[max_concurrency]
+
 
     def list_objects(self, prefix:str=None, filter:str=None)->List[str]:
         ''' list all objects in the Datasource 
-            NOTE that filter is NOT SUPPORTED for now
+            NOTE that filter is a glob-style pattern matched from the right (like "2023/*/*/*")
         '''
-        results = []
+        return list(self.iter_keys(prefix=prefix, filter=filter))
+
+    def _ds_key(self, s3_key:str)->str:
+        ''' Datasource key for the full S3 object key (EXCLUDE prefix and DELIMITER as it's a DataSource property) '''
+        return s3_key[len(self._prefix)+len(self.DELIMITER):] if len(self._prefix)>0 and s3_key.startswith(self._prefix) else s3_key
+
+    def _iter_pages(self, cl_params:dict)->Iterator[dict]:
+        ''' iterate over list_objects_v2 responses (one page at a time) '''
         continuation_token = True
-        obj_prefix = f"{self._prefix}/{prefix}" if isinstance(prefix, str) else self._prefix
         while not continuation_token is None:
             try:
-                cl_params = {
-                    "Bucket": self._bckt,
-                    "Prefix": obj_prefix,
-                    "FetchOwner": False,
-                    # *NOTE* Multiple AWS SDK defaults are in use !
-                    # "Delimiter": self.DELIMITER,  # this one really confusing - should not be used
-                    # EncodingType='url',
-                    # MaxKeys=123,  # default is 1000
-                    # StartAfter='string',
-                    # RequestPayer='requester',
-                    # ExpectedBucketOwner='string'
-                }
-                if continuation_token not in [True, None]:
-                    cl_params["ContinuationToken"] = continuation_token,
+                if continuation_token is not True:
+                    cl_params["ContinuationToken"] = continuation_token
                 resp = self._s3_client.list_objects_v2(**cl_params)
                 continuation_token = resp.get("NextContinuationToken", None) if resp["IsTruncated"] else None
-                results.extend(resp.get("Contents",[]))
             except Exception as e:
-                _top_logger.error(f"FAIL to collect objects list from bucket {self._bckt} with prefix {self._prefix} and filter {filter} with exception {e}")
-                continuation_token = None
-
-        # for collected results we need to EXCLUDE prefix (if any) and DELIMITER (as it's a DataSource property)
-        result = [
-            v["Key"][len(self._prefix)+len(self.DELIMITER):] 
-                if len(self._prefix)>0 and v["Key"].startswith(self._prefix) else v["Key"]
-                    for v in results
+                _top_logger.error(f"FAIL to collect objects list from bucket {self._bckt} with params {cl_params} with exception {e}")
+                return
+            yield resp
+
+    def iter_keys(self, prefix:str=None, filter:str=None, start_after:str=None, page_size:int=None)->Iterator[str]:
+        ''' lazy list of objects in the Datasource (keys are collected page by page in lexicographical order)
+            start_after - (optional) only keys after this key will be listed (for resumable listing)
+        '''
+        cl_params = {
+            "Bucket": self._bckt,
+            "Prefix": self._s3_key(prefix if isinstance(prefix, str) else ""),
+            "FetchOwner": False,
+            # *NOTE* Multiple AWS SDK defaults are in use !
+            # EncodingType='url',
+            # RequestPayer='requester',
+            # ExpectedBucketOwner='string'
+        }
+        if isinstance(start_after, str):
+            cl_params["StartAfter"] = self._s3_key(start_after)
+        if isinstance(page_size, int):
+            cl_params["MaxKeys"] = page_size   # default is 1000
+        for resp in self._iter_pages(cl_params):
+            for v in resp.get("Contents",[]):
+                key = self._ds_key(v["Key"])
+                if self._is_hidden(key, prefix) or (isinstance(filter, str) and not PurePosixPath(key).match(filter)):
+                    continue
+                yield key
+
+    def list_prefixes(self, prefix:str=None)->List[str]:
+        ''' list "sub-folders" of the prefix (common prefixes up to the next DELIMITER, including DELIMITER) '''
+        cl_params = {
+            "Bucket": self._bckt,
+            "Prefix": self._s3_key(prefix if isinstance(prefix, str) else ""),
+            "Delimiter": self.DELIMITER,
+            "FetchOwner": False,
+        }
+        return [
+            self._ds_key(v["Prefix"])
+            for resp in self._iter_pages(cl_params)
+                for v in resp.get("CommonPrefixes",[])
+                    if not self._is_hidden(self._ds_key(v["Prefix"]), prefix)
         ]
-        return result
 
     def get_blob(self, key:str)->ByteString:
         ''' get the blob from the Datasource '''
         result = None
         try:
-            result = self._s3_client.get_object(
+            resp = self._s3_client.get_object(
                 Bucket=self._bckt,
                 Key=f"{self._prefix}{self.DELIMITER if len(self._prefix)>0 else ''}{key}",
                 # *NOTE* Multiple AWS SDK defaults are in use !
@@ -116,39 +176,120 @@ class S3Bucket(ObjectsDatasource):
                 # PartNumber=123,
                 # ExpectedBucketOwner='string',
                 # ChecksumMode='ENABLED'
-            )["Body"].read()
+            )
+            result = self._decode_blob(key, resp["Body"].read(), resp.get("ContentEncoding", None))
         except Exception as e:
             _top_logger.error(f"FAIL to collect blob {key} from bucket {self._bckt} with prefix {self._prefix} with exception {e}")
             result = None
         return result
 
+    def get_blob_if_changed(self, key:str, etag:str=None)->Tuple[Union[ByteString, None], Union[str, None]]:
+        ''' conditional get of the blob from the Datasource (with IfNoneMatch)
+            return tuple (blob, etag) where blob is None if the object's etag is the same as provided (not modified)
+        '''
+        cl_params = {
+            "Bucket": self._bckt,
+            "Key": self._s3_key(key),
+        }
+        if isinstance(etag, str):
+            cl_params["IfNoneMatch"] = etag
+        try:
+            resp = self._s3_client.get_object(**cl_params)
+        except Exception as e:
+            # botocore raises ClientError for 304 Not Modified
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in ["304", "NotModified"]:
+                return None, etag
+            _top_logger.error(f"FAIL to collect blob {key} from bucket {self._bckt} with prefix {self._prefix} with exception {e}")
+            raise e
+        return self._decode_blob(key, resp["Body"].read(), resp.get("ContentEncoding", None)), resp.get("ETag", None)
+
+    def _get_stream(self, key:str, byte_range:Tuple[int,Union[int,None]]=None)->dict:
+        ''' get_object response with not yet consumed Body stream '''
+        cl_params = {
+            "Bucket": self._bckt,
+            "Key": self._s3_key(key),
+        }
+        if isinstance(byte_range, tuple):
+            cl_params["Range"] = f"bytes={byte_range[0]}-{'' if byte_range[1] is None else byte_range[1]}"
+        try:
+            return self._s3_client.get_object(**cl_params)
+        except Exception as e:
+            _top_logger.error(f"FAIL to stream blob {key} from bucket {self._bckt} with prefix {self._prefix} with exception {e}")
+            raise e
+
+    def iter_blob(self, key:str, chunk_size:int=None, byte_range:Tuple[int,Union[int,None]]=None)->Iterator[ByteString]:
+        ''' iterate over the blob from the Datasource by chunks (blob is streamed from S3 - not loaded into memory) 
+            byte_range is a tuple (first_byte, last_byte) with INCLUSIVE last_byte (like HTTP Range header)
+            NOTE that byte_range of compressed object is applied to decompressed data
+            so the whole object has to be streamed (and decompressed) up to the last_byte
+        '''
+        chunk_size = chunk_size or self.STREAM_CHUNK_SIZE
+        # when codec is configured stored objects can be compressed so S3 Range can't be used
+        stored_range = byte_range if self._codec is None else None
+        resp = self._get_stream(key, stored_range)
+        codec = self._read_codec(key, resp.get("ContentEncoding", None))
+        if codec is not None and stored_range is not None:
+            # compressed object in the Datasource without codec (written by another writer)
+            resp["Body"].close()
+            stored_range = None
+            resp = self._get_stream(key)
+        body = resp["Body"]
+        try:
+            chunks = iter_split(iter_decoded(body.iter_chunks(chunk_size=chunk_size), codec, detect=self._codec is not None), chunk_size)
+            if isinstance(byte_range, tuple) and stored_range is None:
+                chunks = iter_range(chunks, byte_range[0], byte_range[1])
+            yield from chunks
+        finally:
+            body.close()
+
+    def _get_one_object(self, key:str, encoding:str, format:str)->Union[ByteString, str, Dict, List, None]:
+        ''' get and decode one object. Any failure is isolated to this key (None will be returned) '''
+        try:
+            res = self.get_blob(key)
+            if isinstance(encoding, str):
+                res = res.decode(encoding)
+                match format:
+                    case "json":
+                        res = json.loads(res)
+            return res
+        except Exception as e:
+            _top_logger.error(f"FAIL to get object {key} with exception {e}")
+        return None
+
     async def get_objects(self, filter:str, keys:List[str], encoding:str="utf8", format:str="json")->List[Union[ByteString, str, Dict, List]]:
         ''' get all objects from the Datasource 
-        NOTE that S3Bucket get objects is NOT really ASYNC for now!
+        NOTE that objects are collected concurrently (up to max_concurrency requests in-flight
+             for all S3Bucket instances with the same max_concurrency as they share the worker threads pool)
+        NOTE that results are in the same order as keys and None is returned for the keys failed to collect
         '''
-        results = []
-        for v in (keys if isinstance(keys, list) else self.list_objects(filter)):
-            try:
-                res = self.get_blob(v)
-                if isinstance(encoding, str):
-                    res = res.decode(encoding)
-                    match format:
-                        case "json":
-                            res = json.loads(res)
-                results.append(res)
-            except Exception as e:
-                _top_logger.error(f"FAIL to get object {v} with exception {e}")
-                continue
+        executor = self._executor_for(self._config.max_concurrency)
+        loop = asyncio.get_running_loop()
+        obj_load_tasks = [
+            loop.run_in_executor(executor, self._get_one_object, v, encoding, format)
+            for v in (keys if isinstance(keys, list) else self.list_objects(filter=filter))
+        ]
+        results = await asyncio.gather(*obj_load_tasks)
         return results
 
-    def put_object(self, key:str, obj:Union[str, ByteString], encoding:str="utf-8")->bool:
+    def put_object(self, key:str, obj:Union[str, ByteString], encoding:str="utf-8", metadata:dict=None)->bool:
         ''' add the object to the Datasource (replace if exists) '''
+        blob = obj if isinstance(obj, ByteString) else obj.encode(encoding=encoding)
+        codec = self._write_codec(key)
+        if not self._put_blob(key, blob if codec is None else codec.compress(blob), codec):
+            return False
+        self._index_put(key, len(blob), not isinstance(obj, ByteString), metadata)
+        return True
+
+    def _put_blob(self, key:str, blob:ByteString, codec:ObjectsCodec=None)->bool:
+        ''' put already encoded (and compressed if codec is provided) blob to the bucket '''
         try:
             resp =  self._s3_client.put_object(
-                Body=obj if isinstance(obj, ByteString) else obj.encode(encoding=encoding),
+                Body=blob,
                 Bucket=self._bckt,
                 Key=f"{self._prefix}{self.DELIMITER if len(self._prefix)>0 else ''}{key}",
                 ServerSideEncryption="AES256",       # 'AES256'|'aws:kms',
+                # readers will decompress the object by ContentEncoding metadata
+                **({"ContentEncoding": codec.name} if codec is not None else {}),
                 # *NOTE* Multiple AWS SDK defaults are in use !
                 # ACL='private'|'public-read'|'public-read-write'|'authenticated-read'|'aws-exec-read'|'bucket-owner-read'|'bucket-owner-full-control',
                 # CacheControl='string',
@@ -188,6 +329,104 @@ class S3Bucket(ObjectsDatasource):
             return False
         return True
 
+    def _upload_part(self, key:str, upload_id:str, part_number:int, data:ByteString)->dict:
+        ''' upload one part of multipart upload '''
+        resp = self._s3_client.upload_part(
+            Body=data,
+            Bucket=self._bckt,
+            Key=self._s3_key(key),
+            PartNumber=part_number,
+            UploadId=upload_id,
+        )
+        return {"ETag": resp["ETag"], "PartNumber": part_number}
+
+    def put_object_from_iter(self, key:str, chunks:Iterable[Union[str, ByteString]], encoding:str="utf-8", metadata:dict=None)->bool:
+        ''' add the object to the Datasource (replace if exists) from the chunks iterator
+            objects smaller than multipart_threshold are uploaded with one PutObject
+            larger objects are uploaded with multipart upload (up to multipart_concurrency parts in-flight)
+        '''
+        part_size = max(self._config.multipart_chunksize, self.MIN_PART_SIZE)
+        codec = self._write_codec(key)
+        size = 0     # size of the object (before compression) for the metadata index
+
+        def encoded_chunks()->Iterator[ByteString]:
+            nonlocal size
+            for v in chunks:
+                chunk = v if isinstance(v, ByteString) else v.encode(encoding=encoding)
+                size += len(chunk)
+                yield chunk
+
+        chunks_iter = encoded_chunks()
+        if codec is not None:
+            # thresholds and parts are applied to compressed data
+            chunks_iter = codec.iter_compress(chunks_iter)
+        buf = bytearray()
+
+        def fill_buffer(size:int)->bool:
+            ''' collect chunks until buf has at least size bytes. return False when chunks exhausted '''
+            while len(buf) < size:
+                chunk = next(chunks_iter, None)
+                if chunk is None:
+                    return False
+                buf.extend(chunk)
+            return True
+
+        # small objects don't need multipart upload
+        if not fill_buffer(max(self._config.multipart_threshold, part_size) + 1):
+            if not self._put_blob(key, bytes(buf), codec):
+                return False
+            self._index_put(key, size, None, metadata)
+            return True
+
+        try:
+            upload_id = self._s3_client.create_multipart_upload(
+                Bucket=self._bckt,
+                Key=self._s3_key(key),
+                ServerSideEncryption="AES256",       # 'AES256'|'aws:kms',
+                **({"ContentEncoding": codec.name} if codec is not None else {}),
+            )["UploadId"]
+        except Exception as e:
+            _top_logger.error(f"FAIL to start multipart upload of {key} to bucket {self._bckt} with prefix {self._prefix} with exception {e}")
+            return False
+
+        # number of parts in-flight is limited so peak memory is bounded by part size (not by object size)
+        in_flight = BoundedSemaphore(self._config.multipart_concurrency)
+        part_futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=self._config.multipart_concurrency, thread_name_prefix="S3BucketUpload") as upload_executor:
+                more_chunks = True
+                while more_chunks:
+                    more_chunks = fill_buffer(part_size)
+                    if len(buf)==0:
+                        break
+                    # last part can be smaller than part_size
+                    part_data = bytes(buf[:part_size]) if more_chunks else bytes(buf)
+                    del buf[:len(part_data)]
+                    in_flight.acquire()
+                    part_future = upload_executor.submit(self._upload_part, key, upload_id, len(part_futures)+1, part_data)
+                    part_future.add_done_callback(lambda _: in_flight.release())
+                    part_futures.append(part_future)
+                    if any(v.done() and v.exception() is not None for v in part_futures):
+                        # no reason to continue - at least one part failed
+                        break
+                    more_chunks = more_chunks or len(buf)>0
+            parts = [v.result() for v in part_futures]
+            self._s3_client.complete_multipart_upload(
+                Bucket=self._bckt,
+                Key=self._s3_key(key),
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception as e:
+            _top_logger.error(f"FAIL multipart upload of {key} to bucket {self._bckt} with prefix {self._prefix} with exception {e}")
+            try:
+                self._s3_client.abort_multipart_upload(Bucket=self._bckt, Key=self._s3_key(key), UploadId=upload_id)
+            except Exception as abort_e:
+                _top_logger.error(f"FAIL to abort multipart upload of {key} with exception {abort_e}")
+            return False
+        self._index_put(key, size, None, metadata)
+        return True
+
     def remove_object(self, key:str)->bool:
         ''' remove (delete) the object from the Datasource '''
         try:
@@ -204,13 +443,59 @@ class S3Bucket(ObjectsDatasource):
         except Exception as e:
             _top_logger.error(f"FAIL to remove object {key} from bucket {self._bckt} with prefix {self._prefix} with exception {e}")
             return False
+        self._index_remove([key])
         return True
 
 
-    def remove_objects(self, filter:str)->List[bool]:
-        ''' remove/delete multiple objects from the Datasource '''
-        raise RuntimeError("NOT IMPLEMENTED")
+    def _s3_key(self, key:str)->str:
+        ''' full S3 object key for the Datasource key '''
+        return f"{self._prefix}{self.DELIMITER if len(self._prefix)>0 else ''}{key}"
+
+    def _remove_batch(self, keys:List[str])->List[bool]:
+        ''' remove up to MAX_DELETE_BATCH objects with one DeleteObjects request '''
+        s3_keys = [self._s3_key(v) for v in keys]
+        try:
+            resp = self._s3_client.delete_objects(
+                Bucket=self._bckt,
+                Delete={
+                    "Objects": [{"Key": v} for v in s3_keys],
+                    # we need per-key results so Quiet mode is off
+                    "Quiet": False
+                },
+                # *NOTE* Multiple AWS SDK defaults are in use !
+                # MFA='string',
+                # RequestPayer='requester',
+                # BypassGovernanceRetention=True|False,
+                # ExpectedBucketOwner='string',
+                # ChecksumAlgorithm='CRC32'|'CRC32C'|'SHA1'|'SHA256'
+            )
+        except Exception as e:
+            _top_logger.error(f"FAIL to remove {len(keys)} objects from bucket {self._bckt} with prefix {self._prefix} with exception {e}")
+            return [False]*len(keys)
+        for err in resp.get("Errors", []):
+            _top_logger.error(f"FAIL to remove object {err.get('Key')} from bucket {self._bckt} with {err.get('Code')}: {err.get('Message')}")
+        deleted = {v["Key"] for v in resp.get("Deleted", [])}
+        return [v in deleted for v in s3_keys]
+
+    async def remove_objects(self, filter:str=None, keys:List[str]=None)->List[bool]:
+        ''' remove/delete multiple objects from the Datasource 
+            NOTE that objects are removed in batches of MAX_DELETE_BATCH keys (S3 DeleteObjects limit)
+            and batches are sent concurrently (up to max_concurrency requests in-flight)
+        '''
+        obj_keys = keys if isinstance(keys, list) else self.list_objects(filter=filter)
+        if len(obj_keys)==0:
+            return []
+        executor = self._executor_for(self._config.max_concurrency)
+        loop = asyncio.get_running_loop()
+        remove_tasks = [
+            loop.run_in_executor(executor, self._remove_batch, obj_keys[i:i+self.MAX_DELETE_BATCH])
+            for i in range(0, len(obj_keys), self.MAX_DELETE_BATCH)
+        ]
+        batch_results = await asyncio.gather(*remove_tasks)
+        results = [x for l in batch_results for x in l]
+        self._index_remove([k for k, v in zip(obj_keys, results) if v])
+        return results
 
     def query_objects(self, meta_data_query:dict)->List[str]:
-        ''' query objects by metadata in the Datasource '''
-        raise RuntimeError("NOT IMPLEMENTED")
+        ''' query objects by metadata in the Datasource (requires metadata_index in config) '''
+        return self._query_index(meta_data_query)
@@ -6,18 +6,122 @@ MIT License
 #! This is a responsibility of consuming service to install required dependencies!
 from abc import ABC, abstractmethod
 from importlib import import_module
-from typing import Union, Dict, List, ByteString
+from typing import Union, Dict, List, ByteString, Tuple, Iterator, Iterable
 from enum import Enum
+import codecs
 import json
 import logging
 _top_logger = logging.getLogger(__name__)
 
+from .ObjectsCodec import ObjectsCodec, ObjectsCodecType, decode_blob
+from .MetadataIndex import MetadataIndex, make_entry
+
 class ObjectsDatasourceType(Enum):
     S3Bucket="S3Bucket"
     LocalFolder="LocalFolder"
+    Memory="Memory"
+
+
+def iter_json_array(text_chunks:Iterable[str])->Iterator[Union[str, Dict, List, int, float, bool, None]]:
+    ''' incremental parser for json document provided by text chunks
+        if the document is an array - every array element will be yielded as soon as it's available
+        if the document is not an array - the whole document will be yielded (as one element)
+    '''
+    decoder = json.JSONDecoder()
+    chunks = iter(text_chunks)
+    buf = ""
+    pos = 0
+    eof = False
+    array_started = False
+
+    def read_more()->bool:
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            return False
+        # drop already parsed part of the buffer
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\n\r":
+            pos += 1
+        if pos >= len(buf):
+            if eof or not read_more():
+                if array_started:
+                    raise ValueError("Unexpected end of json array")
+                return
+            continue
+        if not array_started:
+            if buf[pos] != "[":
+                # not an array - nothing to stream so we'll just load the whole document
+                yield json.loads(buf[pos:] + "".join(chunks))
+                return
+            array_started = True
+            pos += 1
+            continue
+        if buf[pos] == "]":
+            return
+        if buf[pos] == ",":
+            pos += 1
+            continue
+        try:
+            elem, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if eof or not read_more():
+                raise e
+            continue
+        # element MUST be followed by the separator otherwise it can be incomplete
+        # (for example number split between chunks)
+        next_pos = end
+        while next_pos < len(buf) and buf[next_pos] in " \t\n\r":
+            next_pos += 1
+        if next_pos >= len(buf) or buf[next_pos] not in ",]":
+            if not eof and read_more():
+                continue
+            if next_pos < len(buf):
+                raise ValueError(f"Unexpected character '{buf[next_pos]}' in json array")
+        yield elem
+        pos = end
+
+
+def iter_ndjson(text_chunks:Iterable[str])->Iterator[Union[str, Dict, List, int, float, bool, None]]:
+    ''' incremental parser for new-line delimited json provided by text chunks '''
+    tail = ""
+    for chunk in text_chunks:
+        lines = (tail + chunk).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            if len(line.strip())>0:
+                yield json.loads(line)
+    if len(tail.strip())>0:
+        yield json.loads(tail)
+
+
+def dump_json_array(records:Iterable[Union[str, Dict, List, int, float, bool, None]])->Iterator[str]:
+    ''' incremental serializer of records to json array text chunks (counterpart of iter_json_array) '''
+    yield "["
+    for i, rec in enumerate(records):
+        yield (", " if i>0 else "") + json.dumps(rec)
+    yield "]"
 
 
 class ObjectsDatasource(ABC):
+    # default size of chunks for streaming reads
+    STREAM_CHUNK_SIZE = 1024*1024
+
+    # (optional) codec used to compress stored objects
+    # when codec is configured objects are compressed on write and decompressed on read
+    # (readers don't need to know if the object is compressed or not)
+    _codec:ObjectsCodec = None
+
+    # reserved prefix for the metadata index segments (keys with this prefix are not listed)
+    INDEX_PREFIX = ".objects_index/"
+    # (optional) metadata index maintained on writes/removes (used by query_objects)
+    _index:MetadataIndex = None
+
     def __init__(self) -> None:
         pass
 
@@ -27,33 +131,123 @@ class ObjectsDatasource(ABC):
             NOTE that you can use EITHER prefix OR filter but not both
         '''
 
+    @abstractmethod
+    def iter_keys(self, prefix:str=None, filter:str=None, start_after:str=None, page_size:int=None)->Iterator[str]:
+        ''' lazy list of objects in the Datasource (keys are yielded in lexicographical order)
+            start_after - (optional) only keys after this key will be listed (for resumable listing)
+        '''
+
+    @abstractmethod
+    def list_prefixes(self, prefix:str=None)->List[str]:
+        ''' list "sub-folders" of the prefix (common prefixes up to the next "/", including "/")
+            this enables hierarchical navigation (devices, years, months) without listing every object
+        '''
+
     @abstractmethod
     def get_blob(self, key:str)->ByteString:
         ''' get the blob from the Datasource '''
 
+    @abstractmethod
+    def iter_blob(self, key:str, chunk_size:int=None, byte_range:Tuple[int,Union[int,None]]=None)->Iterator[ByteString]:
+        ''' iterate over the blob from the Datasource by chunks (of up to chunk_size bytes)
+            byte_range is a tuple (first_byte, last_byte) with INCLUSIVE last_byte (like HTTP Range header)
+            last_byte can be None to read up to the end of the blob
+        '''
+
     @abstractmethod
     async def get_objects(self, filter:str, keys:List[str], encoding:str="utf-8", format:str="json")->List[Union[str, Dict, List]]:
         ''' get all objects from the Datasource '''
 
     @abstractmethod
-    def put_object(self, key:str, obj:Union[str, ByteString], encoding:str="utf-8")->bool:
-        ''' add the object to the Datasource (replace if exists) '''
+    def put_object(self, key:str, obj:Union[str, ByteString], encoding:str="utf-8", metadata:dict=None)->bool:
+        ''' add the object to the Datasource (replace if exists) 
+            metadata - (optional) dict with content_type, timestamp and tags for the metadata index
+        '''
+
+    @abstractmethod
+    def put_object_from_iter(self, key:str, chunks:Iterable[Union[str, ByteString]], encoding:str="utf-8", metadata:dict=None)->bool:
+        ''' add the object to the Datasource (replace if exists) from the chunks iterator
+            NOTE that the object is never materialized in memory as a whole
+        '''
 
     @abstractmethod
     def remove_object(self, key:str)->bool:
         ''' remove (delete) the object from the Datasource '''
 
     @abstractmethod
-    async def remove_objects(self, filter:str)->List[bool]:
-        ''' remove/delete multiple objects from the Datasource '''
+    async def remove_objects(self, filter:str=None, keys:List[str]=None)->List[bool]:
+        ''' remove/delete multiple objects from the Datasource 
+            NOTE that keys (if provided) take precedence over filter
+            return list of results in the same order as keys (or listed objects)
+        '''
 
     @abstractmethod
     def query_objects(self, meta_data_query:dict)->List[str]:
-        ''' query objects by metadata in the Datasource '''
+        ''' query objects by metadata in the Datasource (see MetadataIndex.query for the query format) '''
 
     # NON-ABSTRACT COMMON METHODS
     # not clean abstract class but more effective to code and use   
 
+    @property
+    def metadata_index(self)->Union[MetadataIndex, None]:
+        ''' metadata index of the Datasource (None if index is not enabled) 
+            use metadata_index.batch() to store index changes of multiple writes as one segment
+        '''
+        return self._index
+
+    def _is_hidden(self, key:str, prefix:str=None)->bool:
+        ''' keys of the metadata index are not listed unless requested explicitly (by prefix) '''
+        return key.startswith(self.INDEX_PREFIX) and not (prefix or "").startswith(self.INDEX_PREFIX)
+
+    def _index_put(self, key:str, size:int, obj_is_text:bool, metadata:dict=None):
+        ''' update metadata index (if enabled) with the written object '''
+        if self._index is None or key.startswith(self.INDEX_PREFIX):
+            return
+        try:
+            self._index.add(make_entry(key, size, obj_is_text, metadata))
+        except Exception as e:
+            _top_logger.error(f"FAIL to update metadata index for {key} with exception {e}")
+
+    def _index_remove(self, keys:List[str]):
+        ''' update metadata index (if enabled) with the removed objects '''
+        if self._index is None:
+            return
+        try:
+            self._index.remove([v for v in keys if not v.startswith(self.INDEX_PREFIX)])
+        except Exception as e:
+            _top_logger.error(f"FAIL to update metadata index for {len(keys)} removed objects with exception {e}")
+
+    def _query_index(self, meta_data_query:dict)->List[str]:
+        if self._index is None:
+            raise RuntimeError("NOT IMPLEMENTED: metadata_index is not enabled for the Datasource")
+        return self._index.query(meta_data_query)
+
+    def _write_codec(self, key:str)->Union[ObjectsCodec, None]:
+        ''' codec for the object to be written (known key suffix like .gz takes precedence over the Datasource codec) '''
+        if self._codec is None:
+            return None
+        return ObjectsCodec.for_key(key) or self._codec
+
+    def _read_codec(self, key:str, content_encoding:str=None)->Union[ObjectsCodec, None]:
+        ''' codec of the stored object by Content-Encoding metadata (if available) or by the key suffix
+            NOTE that key suffix is used only when the Datasource codec is configured
+            (so .gz files stored "as is" are not decompressed unexpectedly)
+        '''
+        codec = ObjectsCodec.for_content_encoding(content_encoding)
+        if codec is None and self._codec is not None:
+            codec = ObjectsCodec.for_key(key)
+        return codec
+
+    def _decode_blob(self, key:str, blob:ByteString, content_encoding:str=None)->ByteString:
+        ''' decompress the stored blob (if compressed)
+            objects stored without metadata (local files or objects written before codec was configured)
+            are detected by the first bytes of the blob
+        '''
+        if blob is None:
+            return None
+        return decode_blob(blob, self._read_codec(key, content_encoding), detect=self._codec is not None)
+
+
     def get_object(self, key:str, encoding:str="utf-8", format:str="json")->Union[ByteString, str, Dict, List]:
         ''' get the object from the Datasource '''
         res = self.get_blob(key)
@@ -68,6 +262,41 @@ class ObjectsDatasource(ABC):
         ''' get all blobs in the Datasource '''
         return await self.get_objects(filter, keys, None, None)
 
+    def get_blob_if_changed(self, key:str, etag:str=None)->Tuple[Union[ByteString, None], Union[str, None]]:
+        ''' conditional get of the blob from the Datasource 
+            return tuple (blob, etag) where blob is None if the object's etag is the same as provided (not modified)
+            NOTE that default implementation doesn't support etags so the blob is always collected
+        '''
+        return self.get_blob(key), None
+
+    def get_blob_range(self, key:str, first_byte:int, last_byte:int=None)->ByteString:
+        ''' get the part of the blob from the Datasource (last_byte is INCLUSIVE, None - up to the end) '''
+        return b"".join(self.iter_blob(key, byte_range=(first_byte, last_byte)))
+
+    def iter_text(self, key:str, encoding:str="utf-8", chunk_size:int=None)->Iterator[str]:
+        ''' iterate over the object from the Datasource by decoded text chunks '''
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for chunk in self.iter_blob(key, chunk_size=chunk_size):
+            text = decoder.decode(chunk)
+            if len(text)>0:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if len(text)>0:
+            yield text
+
+    def iter_records(self, key:str, encoding:str="utf-8", format:str="json", chunk_size:int=None)->Iterator[Union[str, Dict, List]]:
+        ''' iterate over the records of the object from the Datasource without loading the whole object 
+            format "json" - object is a json array and every array element is a record
+            format "ndjson" - object is a new-line delimited json and every line is a record
+        '''
+        match format:
+            case "json":
+                yield from iter_json_array(self.iter_text(key, encoding, chunk_size))
+            case "ndjson":
+                yield from iter_ndjson(self.iter_text(key, encoding, chunk_size))
+            case _:
+                raise ValueError(f"Records format {format} is not supported")
+
 
 class ObjectsDatasourceFactory():
     ''' 
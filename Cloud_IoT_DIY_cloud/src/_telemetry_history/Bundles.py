@@ -0,0 +1,201 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Hourly bundles of the raw telemetry (one object per MQTT message is packed into one object per device-hour) '''
+#! Bundle is stored next to the raw telemetry it replaces and named by the last raw key of the hour
+#! <device prefix>/<yyyy>/<MM>/<dd>/<last raw key name>.ndjson
+#! so bundles and raw telemetry are listed in the same (time) order and aggregation watermark works for both.
+#! Every line of the bundle is {"key": <raw key name>, "record": <raw telemetry object>}
+#! Bundles are written with object metadata (count, first/last raw key and timestamp)
+#! NOTE that only hours closed for a while are bundled (raw key is the ingestion timestamp so closed hour never gets new telemetry)
+#! Time range of the telemetry is pushed down to the listing (see iter_telemetry_keys) as keys are in the time order
+
+from datetime import datetime, timezone
+from typing import Union, List, Dict, Tuple, Iterator
+import json
+import logging
+_top_logger = logging.getLogger(__name__)
+
+from _objects_datasource import ObjectsDatasource
+
+BUNDLE_SUFFIX = ".ndjson"
+HOUR_MS = 60*60*1000
+DAY_MS = 24*HOUR_MS
+MAX_DAY_PREFIXES = 31   # longer ranges are listed as one listing from the range start
+
+
+def is_bundle_key(key:str)->bool:
+    return key.endswith(BUNDLE_SUFFIX)
+
+
+def raw_key(key:str)->str:
+    ''' the last raw telemetry key of the bundle (the key itself for the raw telemetry) '''
+    return key[:-len(BUNDLE_SUFFIX)] if is_bundle_key(key) else key
+
+
+def raw_key_timestamp(key:str)->Union[int, None]:
+    ''' ingestion timestamp (epoch ms) of the raw telemetry key (None for other objects) '''
+    name = key.split("/")[-1]
+    return int(name) if name.isdigit() else None
+
+
+def day_prefix(ts:int)->str:
+    ''' yyyy/MM/dd/ folder of the raw telemetry ingested at ts (epoch ms, UTC) '''
+    return datetime.fromtimestamp(ts/1000, tz=timezone.utc).strftime("%Y/%m/%d/")
+
+
+def iter_telemetry_keys(
+        datasource:ObjectsDatasource,
+        prefix:str="",
+        from_ts:int=None,
+        to_ts:int=None,
+        page_size:int=None,
+        start_after:str=None
+    )->Iterator[str]:
+    ''' keys of the raw telemetry and bundles ingested in the range (epoch ms, both optional and inclusive)
+        prefix - device prefix (empty for the datasource of one device)
+        every day of the range is listed separately, the first one after from_ts (StartAfter)
+        and listing is stopped as soon as keys are after to_ts
+        start_after - (optional) raw key to continue after (like the last key of the previous page)
+        NOTE that bundle is listed when its hour overlaps the range so records MUST be filtered by raw key timestamp
+    '''
+    prefix = prefix.rstrip("/") + "/" if len(prefix or "") > 0 else ""
+    listings:List[Tuple[str, Union[str, None]]] = [(prefix, None)]
+    if from_ts is not None:
+        from_key = prefix + day_prefix(from_ts) + str(from_ts - 1)
+        first_day = from_ts - from_ts % DAY_MS
+        if to_ts is not None and first_day <= to_ts < first_day + MAX_DAY_PREFIXES*DAY_MS:
+            listings = [
+                (prefix + day_prefix(day), from_key if day == first_day else None)
+                for day in range(first_day, to_ts + 1, DAY_MS)
+            ]
+        else:
+            listings = [(prefix, from_key)]
+    if start_after is not None:
+        # NOTE that bundle of start_after is listed (bundle key is after any raw key of its hour)
+        listings = [(p, max(v or "", start_after)) for p, v in listings if start_after[:len(p)] <= p]
+    for list_prefix, list_start_after in listings:
+        for key in datasource.iter_keys(prefix=list_prefix, start_after=list_start_after, page_size=page_size):
+            ts = raw_key_timestamp(raw_key(key))
+            if ts is None or (start_after is not None and raw_key(key) <= start_after):
+                # bundle ended at start_after has nothing after it
+                continue
+            if to_ts is not None:
+                if ts - ts % HOUR_MS > to_ts:
+                    # keys are in the time order so nothing else is in the range
+                    return
+                if ts > to_ts and not is_bundle_key(key):
+                    continue
+            yield key
+
+
+def iter_bundle_lines(keyed_records:List[Tuple[str, dict]])->Iterator[str]:
+    for key, record in keyed_records:
+        yield json.dumps({"key": key.split("/")[-1], "record": record}, separators=(",", ":")) + "\n"
+
+
+def parse_bundle(bundle_key:str, text:str)->List[Tuple[str, dict]]:
+    ''' (raw key, record) pairs of the bundle '''
+    folder = bundle_key[:bundle_key.rfind("/")+1]
+    result = []
+    for line in text.splitlines():
+        if len(line.strip()) == 0:
+            continue
+        v = json.loads(line)
+        result.append((folder + v["key"], v["record"]))
+    return result
+
+
+async def collect_telemetry_records(
+        datasource:ObjectsDatasource,
+        obj_keys:List[str],
+        start_after:str=None
+    )->List[Tuple[str, Union[dict, None], str]]:
+    ''' collect raw telemetry and bundles (bundles are expanded to records)
+        start_after - (optional) records with raw keys up to this key are skipped (like aggregation watermark)
+        return list of tuples (raw key, record, object key) in the raw keys order
+        NOTE that record is None for objects failed to collect (raw key of the failed bundle is its last raw key)
+    '''
+    if len(obj_keys) == 0:
+        return []
+    # NOTE that objects are collected as text because bundles are NOT json documents
+    texts:list = await datasource.get_objects(None, obj_keys, format=None)
+    result = []
+    for obj_key, text in zip(obj_keys, texts):
+        try:
+            if text is None:
+                raise ValueError("object is not available")
+            if is_bundle_key(obj_key):
+                result.extend(
+                    (k, record, obj_key) for k, record in parse_bundle(obj_key, text) if start_after is None or k > start_after
+                )
+            else:
+                result.append((obj_key, json.loads(text), obj_key))
+        except Exception as e:
+            _top_logger.warning(f"collect_telemetry_records: FAIL to collect {obj_key} with exception {e}")
+            result.append((raw_key(obj_key), None, obj_key))
+    return sorted(result, key=lambda v: v[0])
+
+
+async def bundle_hours(
+        datasource:ObjectsDatasource,
+        device_prefix:str,
+        now_ms:int,
+        grace_ms:int=10*60*1000,
+        min_objects:int=2,
+    )->Tuple[int, int]:
+    ''' pack raw telemetry of every closed hour of the device into a bundle and remove the raw objects
+        hour is closed when it ended at least grace_ms before now_ms
+        hours with less than min_objects raw objects are left as is
+        compaction is idempotent - raw objects are removed only after the bundle is stored
+        and objects left by the failed run are merged into the bundle by the next run
+        return tuple (number of bundles stored, number of raw objects removed)
+    '''
+    prefix = device_prefix.rstrip("/") + "/"
+    # objects (raw telemetry and bundles) of the closed hours grouped by (folder, hour)
+    hours:Dict[Tuple[str,int], List[str]] = {}
+    for obj_key in datasource.iter_keys(prefix=prefix):
+        ts = raw_key_timestamp(raw_key(obj_key))
+        if ts is None:
+            # unexpected objects are never bundled
+            continue
+        hour = ts - ts % HOUR_MS
+        if hour + HOUR_MS + grace_ms > now_ms:
+            continue
+        hours.setdefault((obj_key[:obj_key.rfind("/")+1], hour), []).append(obj_key)
+
+    bundles_stored, objects_removed = 0, 0
+    for (_, hour), hour_keys in sorted(hours.items()):
+        raw_count = len([k for k in hour_keys if not is_bundle_key(k)])
+        if raw_count == 0 or (raw_count < min_objects and raw_count == len(hour_keys)):
+            continue
+        # NOTE that bundle of the hour can be already available (like when removal of raw objects failed)
+        #      so it's merged with raw objects into the new bundle
+        keyed_records = await collect_telemetry_records(datasource, hour_keys)
+        if any(v[1] is None for v in keyed_records):
+            # hour is left as is and retried by the next run
+            _top_logger.warning(f"bundle_hours: FAIL to collect telemetry objects of {prefix} for hour {hour}")
+            continue
+        keyed_records = list({k: r for k, r, _ in keyed_records}.items())
+        bundle_key = keyed_records[-1][0] + BUNDLE_SUFFIX
+        first_ts, last_ts = raw_key_timestamp(keyed_records[0][0]), raw_key_timestamp(keyed_records[-1][0])
+        metadata = {
+            "content_type": "application/x-ndjson",
+            "timestamp": last_ts,
+            "tags": {
+                "bundle": "1h", "count": len(keyed_records),
+                "first_key": keyed_records[0][0], "first_ts": first_ts, "last_ts": last_ts,
+            }
+        }
+        if not datasource.put_object_from_iter(bundle_key, iter_bundle_lines(keyed_records), metadata=metadata):
+            _top_logger.error(f"bundle_hours: FAIL to store bundle {bundle_key}")
+            continue
+        bundles_stored += 1
+        to_remove = [k for k in hour_keys if k != bundle_key]
+        removed = await datasource.remove_objects(keys=to_remove)
+        objects_removed += removed.count(True)
+        if not all(removed):
+            # objects left are bundled again (merged with this bundle) by the next run
+            _top_logger.warning(f"bundle_hours: FAIL to remove {removed.count(False)} objects bundled into {bundle_key}")
+    return bundles_stored, objects_removed
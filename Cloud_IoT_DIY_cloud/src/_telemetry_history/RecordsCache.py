@@ -0,0 +1,180 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Incremental cache of the decoded device telemetry (tail of the raw telemetry and bundles) '''
+#! NOTE that cache lives in the process memory - for Lambda it's available for all "hot start" invocations of the container
+#! Raw telemetry key is the ingestion timestamp so new telemetry is always after the last key seen
+#! and refresh lists (StartAfter) and collects only new objects. Bundles of the cached hours are skipped by raw key
+#! the same way as by aggregation watermark (see Bundles.collect_telemetry_records)
+#! Empty cache is seeded with the range of the request only (like the listing without the cache)
+#! so the cache starts from the range start and covers the following requests of the same or later range
+
+from typing import Union, List, Dict, Tuple
+from dataclasses import dataclass
+from collections import OrderedDict
+import asyncio
+import logging
+_top_logger = logging.getLogger(__name__)
+
+from _objects_datasource import ObjectsDatasource
+from _telemetry_history.Bundles import iter_telemetry_keys, collect_telemetry_records, raw_key, raw_key_timestamp, is_bundle_key, day_prefix, HOUR_MS
+
+
+@dataclass(eq=True, frozen=True)
+class TelemetryRecordsCacheConfig:
+    max_records:int=20000       # - max number of records of the device (the oldest records are evicted)
+    check_removed:bool=True     # - drop records removed from the datasource (like aggregated telemetry) on refresh
+
+
+class TelemetryRecordsCache:
+    '''
+        Decoded telemetry records of one device in the raw keys order
+        - records cover all telemetry after start_key (None - from the first telemetry available) up to last_key
+        - empty cache is seeded with the range requested (start_key is the range start)
+        - refresh lists and collects telemetry after last_key only
+        - the oldest records are evicted when max_records is exceeded (start_key is moved)
+    '''
+
+    def __init__(self, config:dict=None):
+        '''  '''
+        # Verify that the config contains a dictionary object with required parameters
+        try:
+            self._config = TelemetryRecordsCacheConfig(**(config or {}))
+        except Exception as e:
+            _top_logger.error(f"Layer-TelemetryRecordsCache: config should be a dict and has required values. Failed with exception {e}")
+            raise ValueError
+        self.records:List[Tuple[str, dict]] = []
+        self.start_key:Union[str, None] = None
+        self.last_key:Union[str, None] = None
+        self.stats:Dict[str,int] = {
+            "refreshes": 0,     # refresh calls
+            "objects": 0,       # objects (raw telemetry and bundles) collected
+            "evictions": 0,     # records evicted (max_records)
+            "removed": 0,       # records dropped as removed from the datasource
+        }
+
+    async def _drop_removed(self, datasource:ObjectsDatasource, prefix:str):
+        ''' drop records before the first telemetry available (one listing of one key) '''
+        if len(self.records) == 0:
+            return
+        first_key = await asyncio.to_thread(lambda: next(iter_telemetry_keys(datasource, prefix, page_size=1), None))
+        if first_key is None:
+            first_ts = None
+        else:
+            # bundle has records of its hour only
+            first_ts = raw_key_timestamp(raw_key(first_key))
+            first_ts = first_ts - first_ts % HOUR_MS if is_bundle_key(first_key) else first_ts
+        removed = 0
+        while removed < len(self.records) and (first_ts is None or raw_key_timestamp(self.records[removed][0]) < first_ts):
+            removed += 1
+        if removed > 0:
+            del self.records[:removed]
+            self.stats["removed"] += removed
+
+    def is_empty(self)->bool:
+        ''' cache is not seeded yet '''
+        return self.start_key is None and self.last_key is None
+
+    async def refresh(self, datasource:ObjectsDatasource, prefix:str="", trim:bool=True,
+                      from_ts:int=None, to_ts:int=None, start_after:str=None)->bool:
+        ''' collect telemetry after the last key seen
+            trim - evict the oldest records right away (otherwise trim MUST be called when records are used)
+            from_ts/to_ts/start_after - (optional) range of the request. Empty cache is seeded with this range only
+            (see iter_telemetry_keys) and start_key is the range start
+            return False when some telemetry failed to collect (it's collected by the next refresh)
+        '''
+        self.stats["refreshes"] += 1
+        seed = self.is_empty()
+        if not seed:
+            # the range is applied by select (refresh collects everything after the last key)
+            from_ts, to_ts = None, None
+        # NOTE that listings are blocking so they run in threads (refresh of multiple caches can be concurrent)
+        if self._config.check_removed:
+            await self._drop_removed(datasource, prefix)
+        # NOTE that seeded cache can have no records yet (nothing in the seed range)
+        after_key = self._seed_key(prefix, from_ts, start_after) if seed else (self.last_key or self.start_key)
+        obj_keys = await asyncio.to_thread(lambda: list(iter_telemetry_keys(datasource, prefix, from_ts, to_ts, start_after=after_key)))
+        keyed_records = await collect_telemetry_records(datasource, obj_keys, start_after=after_key)
+        self.stats["objects"] += len(obj_keys)
+        new_records:Dict[str, dict] = {}
+        complete = True
+        for key, record, _ in keyed_records:
+            if record is None:
+                # last key MUST stay before telemetry failed to collect
+                complete = False
+                break
+            if to_ts is not None and raw_key_timestamp(key) > to_ts:
+                # records of the bundle after the seed range (collected by the next refresh)
+                break
+            new_records[key] = record
+        if seed:
+            if not self.is_empty():
+                # NOTE that cache can be already seeded by the concurrent refresh
+                return complete
+            self.start_key = after_key
+        # NOTE that records can be already added by the concurrent refresh
+        if self.last_key is not None:
+            new_records = {k: v for k, v in new_records.items() if k > self.last_key}
+        if len(new_records) > 0:
+            self.records.extend(new_records.items())
+            self.last_key = self.records[-1][0]
+        if trim:
+            self.trim()
+        return complete
+
+    @staticmethod
+    def _seed_key(prefix:str, from_ts:int=None, start_after:str=None)->Union[str, None]:
+        ''' raw key before the seed range (None - from the first telemetry available) '''
+        if from_ts is None:
+            return start_after
+        # the same key as the listing starts after (see iter_telemetry_keys)
+        prefix = prefix.rstrip("/") + "/" if len(prefix or "") > 0 else ""
+        return max(start_after or "", prefix + day_prefix(from_ts) + str(from_ts - 1))
+
+    def trim(self):
+        ''' evict the oldest records over max_records '''
+        evicted = len(self.records) - self._config.max_records
+        if evicted > 0:
+            self.start_key = self.records[evicted-1][0]
+            del self.records[:evicted]
+            self.stats["evictions"] += evicted
+
+    def covers(self, from_ts:int=None, start_after:str=None)->bool:
+        ''' cache has all telemetry after start_after key and/or from from_ts '''
+        if self.start_key is None:
+            return True
+        return (start_after is not None and start_after >= self.start_key) or \
+               (from_ts is not None and from_ts > raw_key_timestamp(self.start_key))
+
+    def select(self, from_ts:int=None, to_ts:int=None, start_after:str=None)->List[Tuple[str, dict]]:
+        ''' (raw key, record) pairs of the range (ingestion timestamp in epoch ms) after start_after key '''
+        return [
+            (k, v) for k, v in self.records
+                if (start_after is None or k > start_after)
+                and (from_ts is None or raw_key_timestamp(k) >= from_ts)
+                and (to_ts is None or raw_key_timestamp(k) <= to_ts)
+        ]
+
+
+class TelemetryRecordsCaches:
+    '''
+        Telemetry records caches of the recently requested devices
+        - cache of the least recently requested device is dropped when max_devices is exceeded
+    '''
+
+    def __init__(self, config:dict=None, max_devices:int=8):
+        ''' config - TelemetryRecordsCacheConfig of every device cache '''
+        self._config = config
+        self._max_devices = max_devices
+        self._caches:OrderedDict[str, TelemetryRecordsCache] = OrderedDict()   # in LRU order
+
+    def for_device(self, device_id:str)->TelemetryRecordsCache:
+        ''' collect from cache or generate a new (empty) telemetry records cache of the device '''
+        records_cache = self._caches.pop(device_id, None)
+        if records_cache is None:
+            records_cache = TelemetryRecordsCache(self._config)
+        self._caches[device_id] = records_cache
+        while len(self._caches) > self._max_devices:
+            self._caches.popitem(last=False)
+        return records_cache
@@ -0,0 +1,279 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Pre-computed rollups of the numeric telemetry (maintained by aggregation) '''
+#! Rollups are stored next to the history segments of the device-year
+#! <device prefix>/<yyyy>/rollups/1m/<MMdd>.json - 1 minute buckets of one day
+#! <device prefix>/<yyyy>/rollups/1h/<MM>.json   - 1 hour buckets of one month
+#! <device prefix>/<yyyy>/rollups/1d/<yyyy>.json - 1 day buckets of the year
+#! Every rollup object is columnar (per field) and remembers the last telemetry key applied
+#! so the same telemetry is never counted twice (like when aggregation is retried)
+#! NOTE that NumPy is optional - it's a responsibility of consuming service to install it for vectorized statistics
+
+from datetime import datetime, timezone
+from bisect import bisect_right
+from importlib import import_module
+from typing import Union, List, Dict, Tuple, Iterable
+import json
+import logging
+_top_logger = logging.getLogger(__name__)
+
+from _objects_datasource import ObjectsDatasource
+from _telemetry_history import year_folder, record_timestamp, get_existing_blob
+
+ROLLUPS_FOLDER = "rollups"
+# resolution name -> bucket size in milliseconds
+RESOLUTIONS:Dict[str, int] = {
+    "1m": 60*1000,
+    "1h": 60*60*1000,
+    "1d": 24*60*60*1000,
+}
+# statistics of every bucket (mean is calculated on serialization)
+STATS = ["count", "min", "max", "sum", "mean", "last"]
+
+
+def rollup_key(resolution:str, ts:int)->str:
+    ''' key of the rollup object with the bucket of ts (relative to the year folder) '''
+    dt = datetime.fromtimestamp(ts/1000, tz=timezone.utc)
+    match resolution:
+        case "1m":
+            partition = dt.strftime("%m%d")
+        case "1h":
+            partition = dt.strftime("%m")
+        case "1d":
+            partition = dt.strftime("%Y")
+        case _:
+            raise ValueError(f"Rollup resolution {resolution} is not supported")
+    return f"{ROLLUPS_FOLDER}/{resolution}/{partition}.json"
+
+
+class Rollup:
+    '''
+        Buckets of one rollup object: field -> bucket start (epoch ms) -> [count, min, max, sum, last, last_ts]
+    '''
+    VERSION = 1
+
+    def __init__(self, key:str, resolution:str, serialized:dict=None) -> None:
+        self.key:str = key
+        self.resolution:str = resolution
+        self.through_key:str = None
+        self.buckets:Dict[str, Dict[int, list]] = {}
+        if isinstance(serialized, dict):
+            if serialized.get("v", None) != self.VERSION:
+                raise ValueError(f"Rollup version {serialized.get('v', None)} is not supported")
+            self.through_key = serialized.get("through_key", None)
+            for field, columns in serialized["fields"].items():
+                self.buckets[field] = {
+                    ts: [c, mn, mx, sm, last, last_ts]
+                    for ts, c, mn, mx, sm, last, last_ts in zip(
+                        columns["ts"], columns["count"], columns["min"], columns["max"],
+                        columns["sum"], columns["last"], columns["last_ts"]
+                    )
+                }
+
+    @classmethod
+    def load(cls, datasource:ObjectsDatasource, key:str, resolution:str)->"Rollup":
+        ''' collect the rollup (empty rollup is returned if not exists yet) '''
+        blob = get_existing_blob(datasource, key)
+        return cls(key, resolution, None if blob is None else json.loads(blob))
+
+    def serialize(self)->dict:
+        fields = {}
+        for field, buckets in sorted(self.buckets.items()):
+            rows = sorted(buckets.items())
+            fields[field] = {
+                "ts": [ts for ts, _ in rows],
+                "count": [v[0] for _, v in rows],
+                "min": [v[1] for _, v in rows],
+                "max": [v[2] for _, v in rows],
+                "sum": [v[3] for _, v in rows],
+                "mean": [v[3]/v[0] for _, v in rows],
+                "last": [v[4] for _, v in rows],
+                "last_ts": [v[5] for _, v in rows],
+            }
+        return {"v": self.VERSION, "resolution": self.resolution, "through_key": self.through_key, "fields": fields}
+
+    def store(self, datasource:ObjectsDatasource)->bool:
+        return datasource.put_object(self.key, json.dumps(self.serialize(), separators=(",", ":")))
+
+    def add(self, field:str, ts:int, value:float):
+        ''' add one value to the bucket of ts '''
+        self.merge(field, ts - ts % RESOLUTIONS[self.resolution], 1, value, value, value, value, ts)
+
+    def merge(self, field:str, bucket_ts:int, count:int, mn:float, mx:float, sm:float, last:float, last_ts:int):
+        ''' merge statistics of the bucket calculated for a batch of values '''
+        bucket = self.buckets.setdefault(field, {}).get(bucket_ts, None)
+        if bucket is None:
+            self.buckets[field][bucket_ts] = [count, mn, mx, sm, last, last_ts]
+            return
+        bucket[0] += count
+        bucket[1] = min(bucket[1], mn)
+        bucket[2] = max(bucket[2], mx)
+        bucket[3] += sm
+        if last_ts >= bucket[5]:
+            bucket[4], bucket[5] = last, last_ts
+
+    def rows(self, field:str, stat:str="mean")->List[Tuple[int, float]]:
+        ''' (bucket start, statistic value) of the field in time order '''
+        if stat not in STATS:
+            raise ValueError(f"Rollup statistic {stat} is not supported")
+        pos = {"count": 0, "min": 1, "max": 2, "sum": 3, "last": 4}
+        return [
+            (ts, v[3]/v[0] if stat == "mean" else v[pos[stat]])
+            for ts, v in sorted(self.buckets.get(field, {}).items())
+        ]
+
+
+class RollupBatch:
+    '''
+        Columnar batch of the numeric telemetry - records are converted to typed columns in one pass
+        keys/ts - telemetry key and timestamp of every record (in the keys order)
+        fields - field -> (record positions, values)
+        NOTE that bucketed statistics are vectorized with NumPy when it's installed (pure Python otherwise)
+    '''
+    _np = None          # numpy module (False when not available)
+
+    @classmethod
+    def numpy(cls):
+        ''' numpy module or None (NumPy is optional) '''
+        if cls._np is None:
+            try:
+                cls._np = import_module("numpy")
+            except ImportError:
+                _top_logger.info("RollupBatch: numpy is not available so statistics are calculated in pure Python")
+                cls._np = False
+        return cls._np or None
+
+    def __init__(self, keyed_records:Iterable[Tuple[str, dict]], use_numpy:bool=True) -> None:
+        self.keys:List[str] = []
+        self.ts:List[int] = []
+        self.fields:Dict[str, Tuple[List[int], List[float]]] = {}
+        self._np = self.numpy() if use_numpy else None
+        numeric_fields:Dict[str, bool] = {}
+        for obj_key, record in keyed_records:
+            ts = record_timestamp(record) if isinstance(record, dict) else None
+            if ts is None:
+                continue
+            pos = len(self.keys)
+            self.keys.append(obj_key)
+            self.ts.append(ts)
+            for field, v in record.items():
+                is_numeric = numeric_fields.get(field, None)
+                if is_numeric is None:
+                    name_comp = field.split("|")
+                    is_numeric = numeric_fields.setdefault(field, len(name_comp) == 3 and name_comp[2] in ["float", "int"])
+                if not is_numeric or v is None or isinstance(v, bool):
+                    continue
+                try:
+                    value = float(v)
+                except Exception:
+                    continue
+                column = self.fields.get(field, None)
+                if column is None:
+                    column = self.fields[field] = ([], [])
+                column[0].append(pos)
+                column[1].append(value)
+        if self._np is not None:
+            self.ts = self._np.array(self.ts, dtype=self._np.int64)
+            self.fields = {
+                k: (self._np.array(pos, dtype=self._np.int64), self._np.array(values, dtype=self._np.float64))
+                for k, (pos, values) in self.fields.items()
+            }
+
+    def __len__(self)->int:
+        return len(self.keys)
+
+    def partitions(self, resolution:str)->Dict[str, List[int]]:
+        ''' rollup key (relative to the year folder) -> positions of the records in the rollup object '''
+        # partitions are whole days (UTC) for all resolutions so only one key per day is calculated
+        day_ms = RESOLUTIONS["1d"]
+        result:Dict[str, List[int]] = {}
+        if self._np is not None:
+            days, day_of_record = self._np.unique(self.ts // day_ms, return_inverse=True)
+            for i, day in enumerate(days.tolist()):
+                key = rollup_key(resolution, day*day_ms)
+                positions = self._np.flatnonzero(day_of_record == i)
+                result[key] = positions if key not in result else self._np.sort(self._np.concatenate([result[key], positions]))
+            return result
+        day_keys:Dict[int, str] = {}
+        for pos, ts in enumerate(self.ts):
+            day = ts // day_ms
+            key = day_keys.get(day, None) or day_keys.setdefault(day, rollup_key(resolution, day*day_ms))
+            result.setdefault(key, []).append(pos)
+        return result
+
+    def bucket_stats(self, field:str, positions, bucket_size:int)->List[Tuple[int, int, float, float, float, float, int]]:
+        ''' statistics of the field samples of the records at positions by buckets
+            return list of tuples (bucket start, count, min, max, sum, last, last_ts)
+        '''
+        np = self._np
+        field_pos, values = self.fields[field]
+        if np is not None:
+            selected = np.isin(field_pos, positions)
+            if not selected.any():
+                return []
+            ts = self.ts[field_pos[selected]]
+            values = values[selected]
+            buckets = ts - ts % bucket_size
+            # sorted by bucket then by timestamp (stable so the latest record wins for the same timestamp)
+            order = np.lexsort((ts, buckets))
+            buckets, ts, values = buckets[order], ts[order], values[order]
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(buckets)) + 1])
+            ends = np.concatenate([starts[1:], [len(buckets)]])
+            return list(zip(
+                buckets[starts].tolist(), (ends - starts).tolist(),
+                np.minimum.reduceat(values, starts).tolist(), np.maximum.reduceat(values, starts).tolist(),
+                np.add.reduceat(values, starts).tolist(), values[ends-1].tolist(), ts[ends-1].tolist(),
+            ))
+        selected = set(positions)
+        stats:Dict[int, list] = {}
+        for pos, value in zip(field_pos, values):
+            if pos not in selected:
+                continue
+            ts = self.ts[pos]
+            bucket_ts = ts - ts % bucket_size
+            bucket = stats.get(bucket_ts, None)
+            if bucket is None:
+                stats[bucket_ts] = [1, value, value, value, value, ts]
+                continue
+            bucket[0] += 1
+            bucket[1] = min(bucket[1], value)
+            bucket[2] = max(bucket[2], value)
+            bucket[3] += value
+            if ts >= bucket[5]:
+                bucket[4], bucket[5] = value, ts
+        return [(k, *v) for k, v in sorted(stats.items())]
+
+
+def update_rollups(datasource:ObjectsDatasource, device_prefix:str, year:Union[str, int],
+                   keyed_records:Iterable[Tuple[str, dict]], use_numpy:bool=True)->bool:
+    ''' add (telemetry key, record) pairs to all rollups of the device-year
+        NOTE that keyed_records MUST be in the keys order, records up to the rollup through_key are skipped
+        statistics are calculated for the whole batch by columns (see RollupBatch)
+    '''
+    folder = year_folder(device_prefix, year)
+    batch = RollupBatch(keyed_records, use_numpy)
+    if len(batch) == 0:
+        return True
+    for resolution, bucket_size in RESOLUTIONS.items():
+        for key, positions in batch.partitions(resolution).items():
+            try:
+                rollup = Rollup.load(datasource, folder + key, resolution)
+            except Exception as e:
+                _top_logger.error(f"update_rollups: FAIL to collect rollup {folder + key} with exception {e}")
+                return False
+            if rollup.through_key is not None:
+                # records are in the keys order so already applied records are at the beginning of the batch
+                first_pos = bisect_right(batch.keys, rollup.through_key)
+                positions = positions[positions >= first_pos] if batch._np is not None else [v for v in positions if v >= first_pos]
+            if len(positions) == 0:
+                continue
+            for field in batch.fields.keys():
+                for bucket_ts, *stats in batch.bucket_stats(field, positions, bucket_size):
+                    rollup.merge(field, bucket_ts, *stats)
+            rollup.through_key = batch.keys[positions[-1]]
+            if not rollup.store(datasource):
+                _top_logger.error(f"update_rollups: FAIL to store rollup {folder + key}")
+                return False
+    return True
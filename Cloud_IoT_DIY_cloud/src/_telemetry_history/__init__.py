@@ -0,0 +1,328 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+
+Layout of the historical data (shared by aggregation and historical data readers) '''
+#! History of every device is partitioned by year and every year is a set of immutable segments
+#! <device prefix>/<yyyy>/manifest.json               - small manifest with the list of segments
+#! <device prefix>/<yyyy>/segments/<MMdd>-<batch id>.json - json array of records of one day added by one aggregation batch
+#! Segments are never modified so aggregation writes only new data and readers collect only segments they need.
+#! Segment not registered in the manifest (like left by failed aggregation) is ignored by readers
+#! Records of every segment are sorted by (mqtt_timestamp, mqtt_topic) without duplicates
+#! and segments of one day are merged (k-way merge) into one when there are too many of them
+#! Manifest also has the aggregation watermark (the last aggregated telemetry key) so aggregation
+#! lists only new telemetry and never aggregates the same telemetry twice
+
+from dataclasses import dataclass, asdict
+from bisect import bisect_left, bisect_right
+from typing import Union, List, Set, Tuple, Iterable, Iterator
+import heapq
+import re
+import time
+import uuid
+import json
+import logging
+_top_logger = logging.getLogger(__name__)
+
+from _objects_datasource import ObjectsDatasource, dump_json_array
+
+MANIFEST_NAME = "manifest.json"
+SEGMENTS_FOLDER = "segments"
+# segments of one day are merged when there are more than this number of them
+MAX_DAY_SEGMENTS = 4
+# history of the previous versions (all years in one object directly under device prefix)
+LEGACY_HISTORY_NAME = "history.json"
+
+
+@dataclass
+class HistorySegment:
+    key:str                     # segment key relative to the year folder
+    day:str                     # MMdd of the records in the segment
+    count:int=0                 # number of records
+    first_ts:int=None           # epoch ms of the earliest record
+    last_ts:int=None            # epoch ms of the latest record
+    first_key:str=None          # range of telemetry keys aggregated into the segment
+    last_key:str=None
+    sorted:bool=False           # records are sorted by (mqtt_timestamp, mqtt_topic) without duplicates
+
+
+@dataclass
+class AggregationWatermark:
+    run_id:str                  # the last aggregation run which added telemetry of the group
+    last_key:str                # all telemetry keys up to (including) this key are aggregated
+    last_ts:int=None            # epoch ms of the latest aggregated record
+    removed:bool=False          # aggregated telemetry (up to last_key) is removed from the telemetry Datasource
+
+
+def new_run_id()->str:
+    ''' unique id of the aggregation run or batch (ordered by time) '''
+    return f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+
+
+def segment_key(day:str, batch_id:str)->str:
+    ''' key of the segment relative to the year folder '''
+    return f"{SEGMENTS_FOLDER}/{day}-{batch_id}.json"
+
+
+def year_folder(device_prefix:str, year:Union[str, int])->str:
+    ''' year folder of the device history (with trailing delimiter) '''
+    return f"{device_prefix}/{year}/" if len(device_prefix or "") > 0 else f"{year}/"
+
+
+def record_timestamp(record:dict, default:int=None)->Union[int, None]:
+    ''' timestamp (epoch ms) added to the telemetry by IoT rule '''
+    try:
+        return int(record["mqtt_timestamp"])
+    except Exception:
+        return default
+
+
+def record_sort_key(record:dict)->Tuple[int, str]:
+    ''' history order of the records (the same message redelivered by MQTT has the same key) '''
+    return record_timestamp(record, 0), str(record.get("mqtt_topic", ""))
+
+
+def merge_records(*sorted_streams:Iterable[dict])->Iterator[dict]:
+    ''' k-way merge of sorted records streams (the first record of duplicates is kept) '''
+    last_key = None
+    for record in heapq.merge(*sorted_streams, key=record_sort_key):
+        key = record_sort_key(record)
+        # NOTE that records without timestamp can't be identified so they are never dropped
+        if key == last_key and record_timestamp(record) is not None:
+            continue
+        last_key = key
+        yield record
+
+
+def sorted_records(records:Iterable[dict])->List[dict]:
+    ''' records in the history order without duplicates '''
+    return list(merge_records(sorted((v for v in records if isinstance(v, dict)), key=record_sort_key)))
+
+
+def records_in_range(records:List[dict], from_ts:int=None, to_ts:int=None)->List[dict]:
+    ''' records of the sorted segment in the [from_ts, to_ts] range (binary search instead of scan) '''
+    first = 0 if from_ts is None else bisect_left(records, from_ts, key=lambda v: record_timestamp(v, 0))
+    last = len(records) if to_ts is None else bisect_right(records, to_ts, key=lambda v: record_timestamp(v, 0))
+    return records[first:last]
+
+
+def get_existing_blob(datasource:ObjectsDatasource, key:str)->Union[bytes, None]:
+    ''' blob of the object or None when the object doesn't exist
+        NOTE that Datasources return None (or raise) for both missing objects and failed requests
+        so existence is checked to never mistake failed request for the missing manifest
+    '''
+    try:
+        blob = datasource.get_blob(key)
+    except Exception as e:
+        blob, error = None, e
+    else:
+        error = None
+    if blob is None and key in datasource.list_objects(prefix=key):
+        raise RuntimeError(f"FAIL to collect {key} with exception {error}")
+    return blob
+
+
+def device_prefix_template(telemetry_key:str, telemetry_topic:str)->str:
+    ''' prefix of the device telemetry (and history) keys with {{ ... }} placeholders for device attributes
+        telemetry_key - key of IoT Rule (like ${topic(1)}/${topic(2)}/${topic(6)}/${topic(7)}/${parse_time('yyyy',timestamp())}/...)
+        telemetry_topic - topic with placeholders (like $aws/rules/TelemetryInjection/dt/diyiot/{{ building_id }}/...)
+        NOTE that aggregation groups history by the same prefix (all key parts before the year)
+    '''
+    topic_parts = telemetry_topic.split("/")
+    if telemetry_topic.startswith("$aws/rules/"):
+        # basic ingest is used so we need to remove rule prefix
+        topic_parts = topic_parts[3:]
+    prefix_parts = []
+    for key_comp in telemetry_key.split("/"):
+        if "timestamp()" in key_comp:
+            # everything starting from the date related parts is not a part of the prefix
+            break
+        m = re.match(r"\$\{topic\((?P<topic_index>\d+)\)}", key_comp.replace(" ",""))
+        if m is None:
+            prefix_parts.append(key_comp)
+            continue
+        try:
+            prefix_parts.append(topic_parts[int(m.group("topic_index"))-1])
+        except Exception as e:
+            _top_logger.warning(f"device_prefix_template: FAIL to convert {key_comp} to topic part value with exception {e}")
+            prefix_parts.append(key_comp)
+    return "/".join(prefix_parts)
+
+
+class HistoryManifest:
+    '''
+        List of the segments of one device-year
+        - manifest is small (one entry per segment) and is the only object updated in place
+        - segments are ordered by day and batch id (so records are in the time order)
+    '''
+    VERSION = 1
+
+    def __init__(self, key:str, segments:List[HistorySegment]=None, watermark:AggregationWatermark=None) -> None:
+        self.key:str = key
+        self.segments:List[HistorySegment] = segments or []
+        self.watermark:AggregationWatermark = watermark
+
+    @property
+    def folder(self)->str:
+        ''' folder of the manifest (segment keys are relative to it) '''
+        return self.key[:-len(MANIFEST_NAME)]
+
+    @staticmethod
+    def manifest_key(device_prefix:str, year:Union[str, int])->str:
+        return year_folder(device_prefix, year) + MANIFEST_NAME
+
+    @classmethod
+    def load(cls, datasource:ObjectsDatasource, device_prefix:str, year:Union[str, int])->"HistoryManifest":
+        ''' collect the manifest (empty manifest is returned if not exists yet) '''
+        key = cls.manifest_key(device_prefix, year)
+        try:
+            blob = get_existing_blob(datasource, key)
+        except Exception as e:
+            _top_logger.error(f"HistoryManifest: FAIL to collect manifest {key} with exception {e}")
+            raise e
+        if blob is None:
+            return cls(key)
+        serialized = json.loads(blob)
+        if serialized.get("v", None) != cls.VERSION:
+            raise ValueError(f"Manifest version {serialized.get('v', None)} is not supported")
+        return cls(
+            key,
+            [HistorySegment(**v) for v in serialized["segments"]],
+            AggregationWatermark(**serialized["watermark"]) if isinstance(serialized.get("watermark", None), dict) else None
+        )
+
+    def store(self, datasource:ObjectsDatasource)->bool:
+        ''' store the manifest (replace existing) '''
+        self.segments.sort(key=lambda v: v.key)
+        return datasource.put_object(
+            self.key,
+            json.dumps({
+                "v": self.VERSION,
+                "segments": [asdict(v) for v in self.segments],
+                "watermark": None if self.watermark is None else asdict(self.watermark)
+            }, separators=(",", ":"))
+        )
+
+    def add(self, segment:HistorySegment):
+        self.segments = [v for v in self.segments if v.key != segment.key] + [segment]
+        self.segments.sort(key=lambda v: v.key)
+
+    def is_aggregated(self, telemetry_key:str)->bool:
+        ''' telemetry key is already aggregated (telemetry keys are ordered by time within the group) '''
+        return self.watermark is not None and telemetry_key <= self.watermark.last_key
+
+    @property
+    def count(self)->int:
+        return sum(v.count for v in self.segments)
+
+    def select(self, from_ts:int=None, to_ts:int=None)->List[HistorySegment]:
+        ''' segments which can have records in the [from_ts, to_ts] range (time order) '''
+        return [
+            v for v in self.segments
+                if (from_ts is None or v.last_ts is None or v.last_ts >= from_ts)
+                    and (to_ts is None or v.first_ts is None or v.first_ts <= to_ts)
+        ]
+
+
+def write_segment(datasource:ObjectsDatasource, device_prefix:str, year:Union[str, int], day:str,
+                  records:Iterable[dict], batch_id:str, keys_range:Tuple[str,str]=(None, None))->Union[HistorySegment, None]:
+    ''' store records of one day as a new segment and return its manifest entry (None if fails)
+        keys_range - (first, last) telemetry keys aggregated into the segment
+        NOTE that records are stored sorted and without duplicates
+    '''
+    records = sorted_records(records)
+    if len(records) == 0:
+        return None
+    timestamps = [v for v in (record_timestamp(r) for r in records) if v is not None]
+    segment = HistorySegment(
+        key=segment_key(day, batch_id),
+        day=day,
+        count=len(records),
+        first_ts=min(timestamps) if len(timestamps) > 0 else None,
+        last_ts=max(timestamps) if len(timestamps) > 0 else None,
+        first_key=keys_range[0],
+        last_key=keys_range[1],
+        sorted=True,
+    )
+    if not datasource.put_object_from_iter(year_folder(device_prefix, year) + segment.key, dump_json_array(records)):
+        _top_logger.error(f"write_segment: FAIL to store segment {segment.key} of {device_prefix} for {year}")
+        return None
+    return segment
+
+
+def compact_day(datasource:ObjectsDatasource, manifest:HistoryManifest, day:str, batch_id:str)->Union[List[str], None]:
+    ''' merge all segments of the day into one sorted segment without duplicates
+        segments are streamed (k-way merge) so the day is never loaded into memory as a whole
+        manifest is updated (but NOT stored) and keys of the merged segments are returned (None if fails)
+        NOTE that merged segments MUST be removed only after the manifest is stored
+    '''
+    day_segments = [v for v in manifest.segments if v.day == day]
+    if len(day_segments) < 2:
+        return []
+    streams = [
+        datasource.iter_records(manifest.folder + v.key) if v.sorted else iter(sorted_records(datasource.iter_records(manifest.folder + v.key)))
+        for v in day_segments
+    ]
+    merged = HistorySegment(
+        key=segment_key(day, batch_id), day=day, sorted=True,
+        first_key=min((v.first_key for v in day_segments if v.first_key is not None), default=None),
+        last_key=max((v.last_key for v in day_segments if v.last_key is not None), default=None),
+    )
+    def counted(records:Iterator[dict])->Iterator[dict]:
+        for record in records:
+            merged.count += 1
+            ts = record_timestamp(record)
+            if ts is not None:
+                merged.first_ts = ts if merged.first_ts is None else merged.first_ts
+                merged.last_ts = ts
+            yield record
+    try:
+        if not datasource.put_object_from_iter(manifest.folder + merged.key, dump_json_array(counted(merge_records(*streams)))):
+            return None
+    except Exception as e:
+        _top_logger.error(f"compact_day: FAIL to merge {len(day_segments)} segments of {day} in {manifest.folder} with exception {e}")
+        return None
+    manifest.segments = [v for v in manifest.segments if v.day != day]
+    manifest.add(merged)
+    return [manifest.folder + v.key for v in day_segments]
+
+
+def history_record_keys(datasource:ObjectsDatasource, manifest:HistoryManifest, day:str, from_ts:int, to_ts:int)->Set[Tuple[int, str]]:
+    ''' record_sort_key of the records of the day in the [from_ts, to_ts] range already in the history
+        only segments overlapping the range are streamed (so new telemetry can be deduplicated like by compact_day)
+        NOTE that exception is raised when a segment can't be collected
+    '''
+    result:Set[Tuple[int, str]] = set()
+    for segment in manifest.segments:
+        if segment.day != day or segment.first_ts is None or segment.first_ts > to_ts or segment.last_ts < from_ts:
+            continue
+        for record in datasource.iter_records(manifest.folder + segment.key):
+            ts = record_timestamp(record) if isinstance(record, dict) else None
+            if ts is None or ts < from_ts:
+                continue
+            if ts > to_ts:
+                if segment.sorted:
+                    break
+                continue
+            result.add(record_sort_key(record))
+    return result
+
+
+def iter_group_prefixes(telemetry_ds:ObjectsDatasource, depth:int, prefix:str=None)->Iterator[str]:
+    ''' "sub-folders" of telemetry_ds at the depth (like device prefixes) '''
+    for sub_prefix in telemetry_ds.list_prefixes(prefix=prefix):
+        if depth <= 1:
+            yield sub_prefix
+            continue
+        yield from iter_group_prefixes(telemetry_ds, depth-1, sub_prefix)
+
+
+def history_years(datasource:ObjectsDatasource, device_prefix:str=None)->List[str]:
+    ''' years with the history available for the device (the latest first) '''
+    prefix = f"{device_prefix}/" if len(device_prefix or "") > 0 else None
+    years = []
+    for v in datasource.list_prefixes(prefix=prefix):
+        year = v.rstrip("/").split("/")[-1]
+        if year.isdigit():
+            years.append(year)
+    return sorted(years, reverse=True)
@@ -5,6 +5,7 @@ MIT License
 import json
 import logging
 import os
+from typing import Dict
 
 # this is import from layer!
 # NOTE that we don't include layer to Lambda deployment package
@@ -16,6 +17,7 @@ if os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", None) is None:
 
 from _api_handlers_common import aws_common_headers
 from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
+from _objects_datasource.CachingObjectsDatasource import CachingObjectsDatasource
 
 # logging level can/will be redefined in any specific Cloud (Lambda/Azure function/etc.)
 # predefined here for local
@@ -24,6 +26,18 @@ _root_logger.setLevel(level=logging.INFO)
 # instantiate _top_logger to be used in this code
 _top_logger = logging.getLogger(__name__)
 
+# define some global variables to benefit from Lambda "hot start"
+# updates are immutable (new update gets new update_id) so they're revalidated rarely
+# updates evicted from memory are spilled to Lambda ephemeral storage
+updates_data_sources:Dict[str, ObjectsDatasource] = {}
+updates_cache_config:dict = {
+    "ttl": 3600,
+    "max_cache_size": 64*1024*1024,
+    "max_object_size": 16*1024*1024,
+    "spill_folder": "/tmp/updates_cache",
+    "max_spill_size": 384*1024*1024,
+}
+
 def update_by_id_for_deviceid(
         *,
         device_id:str,
@@ -81,14 +95,20 @@ def lambda_handler(event:dict, context):
         # NOTE that we're relying on stage variables!
         updates_bucket_name = event["stageVariables"]["service_bucket_name"]
         updates_key_prefix = event["stageVariables"]["updates_prefix"]
-        # Datasource for dashboards
-        updates_ds_s3 = ObjectsDatasourceFactory.create(
-            provider_name=ObjectsDatasourceType.S3Bucket,
-            config={
-                "bucket_name": updates_bucket_name,
-                "key_prefix": updates_key_prefix
-            }
-        )
+        # Datasource for updates (cached for "hot start")
+        updates_ds_key = f"{updates_bucket_name}/{updates_key_prefix}"
+        if updates_ds_key not in updates_data_sources:
+            updates_data_sources[updates_ds_key] = CachingObjectsDatasource(
+                ObjectsDatasourceFactory.create(
+                    provider_name=ObjectsDatasourceType.S3Bucket,
+                    config={
+                        "bucket_name": updates_bucket_name,
+                        "key_prefix": updates_key_prefix
+                    }
+                ),
+                updates_cache_config
+            )
+        updates_ds_s3 = updates_data_sources[updates_ds_key]
 
     except Exception as e:
         payload = "ERROR: incorrect context"
@@ -6,6 +6,7 @@ import json
 import logging
 import os
 from urllib.parse import unquote
+from typing import Dict
 
 # this is import from layer!
 # NOTE that we don't include layer to Lambda deployment package
@@ -17,6 +18,7 @@ if os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", None) is None:
 
 from _api_handlers_common import aws_common_headers
 from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
+from _objects_datasource.CachingObjectsDatasource import CachingObjectsDatasource
 
 # logging level can/will be redefined in any specific Cloud (Lambda/Azure function/etc.)
 # predefined here for local
@@ -25,6 +27,16 @@ _root_logger.setLevel(level=logging.INFO)
 # instantiate _top_logger to be used in this code
 _top_logger = logging.getLogger(__name__)
 
+# define some global variables to benefit from Lambda "hot start"
+# dashboards can be updated by other Lambdas so cached dashboards are always revalidated (ttl=0)
+# NOTE that one Datasource (and cache) serves all users - user_id is a part of the dashboard key
+dashboards_data_sources:Dict[str, ObjectsDatasource] = {}
+dashboards_cache_config:dict = {
+    "ttl": 0,
+    "max_cache_size": 1024*1024,
+    "max_object_size": 256*1024,
+}
+
 def users_dashboard_by_id(
         dashboard_id:str,
         *,
@@ -43,7 +55,8 @@ def users_dashboard_by_id(
         return {}
 
     try:
-        return dashboards_ds.get_object(dashboard_id) or {}
+        # dashboards of the user are stored under user_id "folder"
+        return dashboards_ds.get_object(f"{userid}/{dashboard_id}") or {}
     except Exception as e:
         _top_logger.error(f"users_dashboard_by_id: FAIL to collect dashboard {dashboard_id} for {userid} with exception {e}")
         return {}
@@ -83,14 +96,20 @@ def lambda_handler(event:dict, context):
         # NOTE that we're relying on stage variables!
         dashboards_bucket_name = event["stageVariables"]["dashboards_bucket_name"]
         dashboards_key_prefix = event["stageVariables"]["saved_dashboards_prefix"]
-        # Datasource for dashboards
-        dashboards_ds_s3 = ObjectsDatasourceFactory.create(
-            provider_name=ObjectsDatasourceType.S3Bucket,
-            config={
-                "bucket_name": dashboards_bucket_name,
-                "key_prefix": f"{dashboards_key_prefix}/{user_id}"
-            }
-        )
+        # Datasource for dashboards (cached for "hot start")
+        dashboards_ds_key = f"{dashboards_bucket_name}/{dashboards_key_prefix}"
+        if dashboards_ds_key not in dashboards_data_sources:
+            dashboards_data_sources[dashboards_ds_key] = CachingObjectsDatasource(
+                ObjectsDatasourceFactory.create(
+                    provider_name=ObjectsDatasourceType.S3Bucket,
+                    config={
+                        "bucket_name": dashboards_bucket_name,
+                        "key_prefix": dashboards_key_prefix
+                    }
+                ),
+                dashboards_cache_config
+            )
+        dashboards_ds_s3 = dashboards_data_sources[dashboards_ds_key]
 
     except Exception as e:
         payload = "ERROR: incorrect context"
@@ -6,7 +6,8 @@ import json
 import logging
 import os
 import asyncio
-from typing import Union, List, Dict
+from collections import OrderedDict
+from typing import Union, List, Dict, Set
 
 # this is import from layer!
 # NOTE that we don't include layer to Lambda deployment package
@@ -17,8 +18,13 @@ if os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", None) is None:
     sys.path.append("./src")
 
 from _api_handlers_common import aws_common_headers, decode_data_value_by_name
+from _api_handlers_common.Downsampling import downsample_objects
 from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
+from _objects_datasource.CachingObjectsDatasource import CachingObjectsDatasource
 from _devices_registry import DevicesRegistry, DevicesRegistryFactory, DevicesRegistryType
+from _telemetry_history import HistoryManifest, history_years, device_prefix_template, LEGACY_HISTORY_NAME
+from _telemetry_history import records_in_range, record_timestamp
+from _telemetry_history.Rollups import Rollup, RESOLUTIONS, STATS, ROLLUPS_FOLDER
 
 # logging level can/will be redefined in any specific Cloud (Lambda/Azure function/etc.)
 # predefined here for local
@@ -28,11 +34,23 @@ _root_logger.setLevel(level=logging.DEBUG)
 _top_logger = logging.getLogger(__name__)
 
 # define some global variables to benefit from Lambda "hot start"
-historical_data_sources:Dict[str, ObjectsDatasource] = {}
+historical_data_sources:OrderedDict[str, CachingObjectsDatasource] = OrderedDict()   # in LRU order
 aws_registry:DevicesRegistry = None
+# history is updated by scheduled aggregation so cached history is always revalidated (ttl=0)
+# history evicted from memory is spilled to Lambda ephemeral storage (limits are per device
+# so the number of cached devices is limited by the ephemeral storage size - 512MB by default)
+max_cached_devices:int = 4
+historical_cache_config:dict = {
+    "ttl": 0,
+    "max_cache_size": 4*1024*1024,
+    "max_object_size": 32*1024*1024,
+    "spill_folder": "/tmp/historical_cache",
+    "max_spill_size": 64*1024*1024,
+}
 
 def historical_ds_for_deviceid(historical_bucket_name:str, device_id:str,
-                              historical_key:str,
+                              telemetry_key:str,
+                              telemetry_topic:str,
                               user_groups:str=None,
                               things_group_name:str=None,
                               historical_ingest_rule_prefix:str=None)->ObjectsDatasource:
@@ -40,14 +58,12 @@ def historical_ds_for_deviceid(historical_bucket_name:str, device_id:str,
     global historical_data_sources, aws_registry
 
     if device_id in historical_data_sources:
+        historical_data_sources.move_to_end(device_id)
         return historical_data_sources[device_id]
 
     # we need to find the right prefix for this device_id datasource
-    # we know that the key can have a rule in the name (if basic ingest is used)
-    key_prefix = historical_key
-    if historical_key.startswith("$aws/rules/"):
-        # basic ingest is used so we need to remove rule prefix
-        key_prefix = "/".join(historical_key.split("/")[3:])
+    # history is grouped by aggregation using telemetry key parts (topic references) before the year
+    key_prefix = device_prefix_template(telemetry_key, telemetry_topic)
     # now we need to replace thing attributes in the key
     # including {{ building_id }}/{{ location_id }}/{{ things_group_name }}/{{ thing_type }}/{{ thing_name }}
     # we'll not use jinja (overkill for so simple pattern)
@@ -88,18 +104,26 @@ def historical_ds_for_deviceid(historical_bucket_name:str, device_id:str,
     device_attrs = device_info.get("attributes", {})
     key_prefix = key_prefix.replace("{{ building_id }}", device_attrs.get("building_id", ""))
     key_prefix = key_prefix.replace("{{ location_id }}", device_attrs.get("location_id", ""))
-    key_prefix = key_prefix.replace("{{ things_group_name }}", things_group_name)
+    key_prefix = key_prefix.replace("{{ things_group_name }}", things_group_name or "")
     key_prefix = key_prefix.replace("{{ thing_type }}", device_info.get("thingTypeName",""))
     key_prefix = key_prefix.replace("{{ thing_name }}", device_id)
     _top_logger.debug(f"historical_ds_for_deviceid: final key prefix for device {device_id} is {key_prefix}")
     # finally we can arrange the DataSource and add it to the "cache"
-    historical_data_sources[device_id] = ObjectsDatasourceFactory.create(
-            provider_name=ObjectsDatasourceType.S3Bucket,
-            config={
-                "bucket_name": historical_bucket_name,
-                "key_prefix": key_prefix
-            }
+    historical_data_sources[device_id] = CachingObjectsDatasource(
+            ObjectsDatasourceFactory.create(
+                provider_name=ObjectsDatasourceType.S3Bucket,
+                config={
+                    "bucket_name": historical_bucket_name,
+                    "key_prefix": key_prefix,
+                    "codec": "gzip"     # history is stored compressed by the aggregation
+                }
+            ),
+            historical_cache_config
         )
+    while len(historical_data_sources) > max_cached_devices:
+        # NOTE that spilled history of the device is removed from the ephemeral storage
+        _, evicted_ds = historical_data_sources.popitem(last=False)
+        evicted_ds.invalidate()
 
     return historical_data_sources[device_id]
 
@@ -109,33 +133,50 @@ async def collect_historical_obj(
         obj_keys:List[str],
         attributes:Union[str, List[str], None],
         label:str,
+        from_ts:int=None,
+        to_ts:int=None,
+        sorted_keys:Set[str]=None,
     )->List[dict]:
-    ''' '''
-    if len(obj_keys):
+    ''' collect historical objects (every object is a list of records) and transform the records
+        from_ts/to_ts - (optional) range of mqtt_timestamp of the records
+        sorted_keys - objects with sorted records (binary search is used instead of scan for the range)
+    '''
+    if len(obj_keys) == 0:
         return []
     try:
-        telem_data:list = await device_historical_ds.get_objects(None, obj_keys)
+        hist_data:list = await device_historical_ds.get_objects(None, obj_keys)
     except Exception as e:
         _top_logger.error(f"collect_historical_obj: FAIL to collect historical objects {obj_keys} with exception {e}")
         return []
+    if from_ts is not None or to_ts is not None:
+        hist_data = [
+            records_in_range(obj, from_ts, to_ts) if k in (sorted_keys or set()) else [
+                v for v in obj
+                    if (from_ts is None or record_timestamp(v, 0) >= from_ts) and (to_ts is None or record_timestamp(v, 0) <= to_ts)
+            ]
+            for k, obj in zip(obj_keys, hist_data) if isinstance(obj, list)
+        ]
     # transform collected objects
-    attrs = (attributes or []).copy()
+    attrs = list(attributes or []) if not isinstance(attributes, str) else []
     result = []
-    for data_obj in telem_data:
+    for data_obj in (rec for obj in hist_data if isinstance(obj, list) for rec in obj):
+        if not isinstance(data_obj, dict):
+            continue
         elem = {
             "label": data_obj.get(label,"")
         }
         if isinstance(attributes,str):
             # simple scenario
             elem["value"] = decode_data_value_by_name(data_obj.get(attributes, None), attributes)
+            result.append(elem)
             continue
         # when attributes not provided all data_obj fields except 'label' will be added
         if attributes is None:
-            attrs.extend([k for k in data_obj.keys() if k!=label])
-        elem = {
-            **{k:decode_data_value_by_name(v,k) for k,v in data_obj.items()}
+            attrs.extend([k for k in data_obj.keys() if k!=label and k not in attrs])
+        result.append({
+            **{k:decode_data_value_by_name(v,k) for k,v in data_obj.items() if attributes is None or k in attributes},
             **elem
-        }
+        })
     # finally - update all elements by adding None for not-available attributes
     if not isinstance(attributes, str):
         result = [
@@ -156,10 +197,13 @@ async def collect_historical_for_device(
         latest_year_of_interest:str=None,
         number_of_years:int=1,
         max_number_of_history_records:int=3000,
+        from_ts:int=None,
+        to_ts:int=None,
         **kwargs
     )->List[dict]:
-    ''' 
-        return list of objects with ALL historical data available
+    '''
+        return list of objects with the latest historical data available (up to max_number_of_history_records)
+        from_ts/to_ts - (optional) range of the records timestamps (only segments with records in the range are collected)
         depending from attributes/label value object will have different formats
         1. attributes is str
         each object in the list has format like this:
@@ -174,34 +218,91 @@ async def collect_historical_for_device(
             "attribute_name": attribute value in correct format
         }
     '''
+    hist_objects = []
+    sorted_keys = set()
     try:
-        # first - we need to identify historical sources for aggregation
-        # each object has historical data for one YEAR
-        hist_objects = device_historical_ds.list_objects()
-        # we need to limit number of loaded years
+        # first - we need to identify historical years of interest
+        # each year has a manifest with the list of segments (so segments are never listed)
+        years = history_years(device_historical_ds)
+        if latest_year_of_interest is not None:
+            years = [v for v in years if int(v) <= int(latest_year_of_interest)]
+        # we need to collect only segments with the latest records (starting from the latest year)
         # TODO: latest year, number of years and number of records should be query params !!!
-        hist_objects.sort(reverse=True)
-        hist_objects = hist_objects[:number_of_years]
-        # split all objects into reasonable number of loading groups
-        number_of_concurrent_loads = max(len(hist_objects), 5)
-
-        chunk_size = len(hist_objects)//number_of_concurrent_loads
-        # create a set of coroutines where each one load one set of years
-        collect_data_tasks = [
-            collect_historical_obj(
-                device_historical_ds, 
-                hist_objects[i:i+chunk_size],
-                attributes,
-                label,
-            ) for i in range(0,len(chunk_size),chunk_size)]
-        # collect each objects group
-        collect_data_result = await asyncio.gather(*collect_data_tasks)
+        records_available = 0
+        for year in years[:number_of_years]:
+            manifest = HistoryManifest.load(device_historical_ds, None, year)
+            for segment in reversed(manifest.select(from_ts, to_ts)):
+                hist_objects.insert(0, manifest.folder + segment.key)
+                if segment.sorted:
+                    sorted_keys.add(manifest.folder + segment.key)
+                records_available += segment.count
+                if records_available >= max_number_of_history_records:
+                    break
+            if records_available >= max_number_of_history_records:
+                break
+        if len(years) == 0:
+            # history of the previous versions is one object for all years
+            hist_objects = [LEGACY_HISTORY_NAME]
+        # NOTE that objects are collected concurrently by the Datasource
+        collect_data_result = await collect_historical_obj(
+            device_historical_ds, hist_objects, attributes, label, from_ts, to_ts, sorted_keys
+        )
 
     except Exception as e:
         _top_logger.error(f"collect_historical_for_device: FAIL to collect historical objects {hist_objects} with exception {e}")
         return []
-    
-    return [x for l in collect_data_result for x in l][:max_number_of_history_records]
+
+    return collect_data_result[-max_number_of_history_records:]
+
+
+async def collect_rollups_for_device(
+        *,
+        device_historical_ds:ObjectsDatasource,
+        attributes:Union[str, List[str], None],
+        resolution:str,
+        stat:str="mean",
+        latest_year_of_interest:str=None,
+        number_of_years:int=1,
+        max_number_of_history_records:int=3000,
+        **kwargs
+    )->List[dict]:
+    ''' 
+        return list of objects with the latest pre-computed rollups (resolution is 1m, 1h or 1d)
+        objects have the same format as collect_historical_for_device results 
+        where label is the bucket start and values are bucket statistic (stat)
+    '''
+    if resolution not in RESOLUTIONS or stat not in STATS:
+        raise ValueError(f"Rollup {resolution} {stat} is not supported")
+    rollups:List[Rollup] = []
+    rows_available = 0
+    years = history_years(device_historical_ds)
+    if latest_year_of_interest is not None:
+        years = [v for v in years if int(v) <= int(latest_year_of_interest)]
+    # rollup objects are small so they are collected one by one (the latest first) until we have enough buckets
+    for year in years[:number_of_years]:
+        for key in sorted(device_historical_ds.list_objects(prefix=f"{year}/{ROLLUPS_FOLDER}/{resolution}/"), reverse=True):
+            rollup = Rollup(key, resolution, device_historical_ds.get_object(key))
+            rollups.insert(0, rollup)
+            rows_available += max([len(v) for v in rollup.buckets.values()], default=0)
+            if rows_available >= max_number_of_history_records:
+                break
+        if rows_available >= max_number_of_history_records:
+            break
+    # transform collected rollups
+    fields = [attributes] if isinstance(attributes, str) else attributes
+    if fields is None:
+        fields = sorted({k for v in rollups for k in v.buckets.keys()})
+    rows:Dict[int, dict] = {}
+    for rollup in rollups:
+        for field in fields:
+            for ts, value in rollup.rows(field, stat):
+                rows.setdefault(ts, {})[field] = value
+    result = [
+        {"label": ts, "value": v.get(attributes, None)} if isinstance(attributes, str) else
+        {**{k: v.get(k, None) for k in fields}, "label": ts}
+        for ts, v in sorted(rows.items())
+    ]
+    return result[-max_number_of_history_records:]
 
 
 @aws_common_headers()
@@ -230,15 +331,28 @@ def lambda_handler(event:dict, context):
     except Exception as e:
         _top_logger.debug(f"lambda_handler: Exception: {e}")
 
+    # NOTE that the loop is closed by every invocation so warm invocations MUST NOT reuse it (get_event_loop)
+    handler_loop = asyncio.new_event_loop()
     try:
         device_id = event["pathParameters"]["device_id"]
         historical_bucket_name = event["stageVariables"]["historical_bucket_name"]
         things_group_name = event["stageVariables"]["things_group_name"]
-        historical_key:str = os.environ.get("telemetry_topic") # telemetry topic is environment var as it's not needed by most Lambdas
+        telemetry_topic:str = os.environ.get("telemetry_topic") # telemetry topic is environment var as it's not needed by most Lambdas
+        telemetry_key:str = os.environ.get("telemetry_key")
         historical_ingest_rule_prefix = os.environ.get("telemetry_ingest_rule_prefix",None)
         user_groups = event.get("requestContext",{}).get("authorizer",{}).get("claims",{}).get("cognito:groups", None)
-        req_datapoints = event.get("queryStringParameters",{}).get("values", "").split(",")
-        req_format = event.get("queryStringParameters",{}).get("format", None)
+        # NOTE that API Gateway provides None (not empty dict) when there are no query parameters
+        query_params = event.get("queryStringParameters",None) or {}
+        req_datapoints = [v for v in (query_params.get("values", None) or "").split(",") if len(v)>0]
+        req_format = query_params.get("format", None)
+        # pre-computed rollups (like resolution=1h&stat=max) are used for long-range charts instead of raw history
+        req_resolution = query_params.get("resolution", None)
+        req_stat = query_params.get("stat", None) or "mean"
+        # range of the history (epoch ms)
+        req_from_ts = int(query_params["from"]) if query_params.get("from", None) else None
+        req_to_ts = int(query_params["to"]) if query_params.get("to", None) else None
+        # charts are a few hundred pixels wide so responses can be downsampled to the number of points (LTTB)
+        req_points = int(query_params["points"]) if query_params.get("points", None) else None
         req_attributes = None
         if len(req_datapoints)>0:
             req_attributes = req_datapoints[0] if req_format in ["line", "bar", "gauge"] else req_datapoints
@@ -246,23 +360,30 @@ def lambda_handler(event:dict, context):
         # 1. Datasource for historical (to get the data and removed handled data)
         telem_datasource = historical_ds_for_deviceid(
             historical_bucket_name=historical_bucket_name,
-            device_id=device_id, historical_key=historical_key,
+            device_id=device_id, telemetry_key=telemetry_key, telemetry_topic=telemetry_topic,
             user_groups=user_groups, things_group_name=things_group_name,
             historical_ingest_rule_prefix=historical_ingest_rule_prefix
         )
         # 2. Invoke historical collection
         # total number of historical objects can be quite large so we'll try to do it async
         #device_historical_ds.get_objects()
-        handler_loop = asyncio.get_event_loop()
         historical_data:list = handler_loop.run_until_complete(
             collect_historical_for_device(
                 device_historical_ds=telem_datasource,
                 attributes=req_attributes,                    
                 user_groups=user_groups,
+                from_ts=req_from_ts,
+                to_ts=req_to_ts,
+            ) if req_resolution is None else collect_rollups_for_device(
+                device_historical_ds=telem_datasource,
+                attributes=req_attributes,
+                resolution=req_resolution,
+                stat=req_stat,
             )
         )
         if not handler_loop.is_closed():
             handler_loop.close()
+        historical_data = downsample_objects(historical_data, req_points)
 
         result = {
             "statusCode": 200,
@@ -274,18 +395,12 @@ def lambda_handler(event:dict, context):
         payload = "ERROR: incorrect context"
         _top_logger.error(payload)
         _top_logger.error(f"Exception: {e}")
+        if not handler_loop.is_closed():
+            handler_loop.close()
 
         return {
             "statusCode": 400,
             "body": payload
         }
 
-    #! ----- M O C K ------
-    result["body"] = json.dumps([
-        {
-            'label': f"1683599846{i:03d}",
-            'value': 42.22 + i*3
-        }
-        for i in range(0,1000)
-    ])
     return result
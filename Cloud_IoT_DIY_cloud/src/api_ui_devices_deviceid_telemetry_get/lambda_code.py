@@ -7,7 +7,9 @@ import logging
 import os
 import asyncio
 import re
-from typing import Union, List, Dict
+import base64
+from itertools import islice
+from typing import Union, List, Dict, Tuple
 
 # this is import from layer!
 # NOTE that we don't include layer to Lambda deployment package
@@ -17,9 +19,12 @@ if os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", None) is None:
     import sys
     sys.path.append("./src")
 
-from _api_handlers_common import aws_common_headers, decode_data_value_by_name
+from _api_handlers_common import aws_common_headers, telemetry_objects
+from _api_handlers_common.Downsampling import downsample_objects
 from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
 from _devices_registry import DevicesRegistry, DevicesRegistryFactory, DevicesRegistryType
+from _telemetry_history.Bundles import collect_telemetry_records, iter_telemetry_keys, raw_key_timestamp
+from _telemetry_history.RecordsCache import TelemetryRecordsCache, TelemetryRecordsCaches
 
 # logging level can/will be redefined in any specific Cloud (Lambda/Azure function/etc.)
 # predefined here for local
@@ -31,6 +36,26 @@ _top_logger = logging.getLogger(__name__)
 # define some global variables to benefit from Lambda "hot start"
 telemetry_data_sources:Dict[str, ObjectsDatasource] = {}
 aws_registry:DevicesRegistry = None
+# decoded telemetry of the recently requested devices (so dashboard refresh collects only new telemetry)
+# NOTE that decoded record takes ~1KB so limits are aligned with the Lambda memory size (256MB)
+telemetry_records_caches = TelemetryRecordsCaches({"max_records": 5000}, max_devices=8)
+
+
+def encode_cursor(raw_key:str)->str:
+    ''' opaque cursor of the page (the last raw telemetry key returned) '''
+    return base64.urlsafe_b64encode(raw_key.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor:str)->str:
+    ''' raw telemetry key of the cursor. Raise ValueError for incorrect cursor '''
+    try:
+        raw_key = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except Exception as e:
+        raise ValueError(f"Incorrect cursor {cursor}") from e
+    if raw_key_timestamp(raw_key) is None:
+        raise ValueError(f"Incorrect cursor {cursor}")
+    return raw_key
+
 
 def telemetry_ds_for_deviceid(telemetry_bucket_name:str, device_id:str,
                               telemetry_key:str,
@@ -133,55 +158,29 @@ async def collect_telemetry_objects(
         obj_keys:List[str],
         attributes:Union[str, List[str], None],
         label:str,
-    )->List[dict]:
-    ''' we need to collect and parse one telemetry object. Internal logic is 
-            around "label" (what value to use for "label" key)
-            around attributes - if str we'll return just that attribute value for key "value", if None - return all
+        from_ts:int=None,
+        to_ts:int=None,
+        start_after:str=None,
+    )->List[Tuple[str, dict]]:
+    ''' we need to collect and parse telemetry objects (see telemetry_objects for the transformation)
+            from_ts/to_ts - (optional) range of the ingestion timestamp (records of bundles out of the range are skipped)
+            start_after - (optional) records up to this raw key are skipped (like records of the previous page)
+        return list of tuples (raw key, telemetry object) in the raw keys order
     '''
     _top_logger.debug(f"collect_telemetry_objects: collect telemetry objects {obj_keys} with attributes {attributes}")
     if len(obj_keys)==0:
         return []
     try:
-        telem_data:list = await device_telemetry_ds.get_objects(None, obj_keys)
+        # NOTE that hourly bundles are expanded so every record is returned as one telemetry object
+        telem_data:list = [
+            v[:2] for v in await collect_telemetry_records(device_telemetry_ds, obj_keys, start_after)
+                if (from_ts is None or raw_key_timestamp(v[0]) >= from_ts) and (to_ts is None or raw_key_timestamp(v[0]) <= to_ts)
+        ]
     except Exception as e:
         _top_logger.error(f"collect_telemetry_objects: FAIL to collect telemetry objects {obj_keys} with exception {e}")
         return []
     _top_logger.debug(f"collect_telemetry_objects: collected {len(telem_data)} objects")
-    # attrs should always be a list even when attributes is str or None
-    attrs = [attributes] if isinstance(attributes,str) else (attributes or []).copy()
-    # transform collected objects
-    result = []
-    for data_obj in telem_data:
-        _top_logger.debug(f"collect_telemetry_objects: object {json.dumps(data_obj)[:15]}...")
-        elem = {
-            "label": data_obj.get(label,"")
-        }
-        if isinstance(attributes,str):
-            # simple scenario
-            elem["value"] = decode_data_value_by_name(data_obj.get(attributes, None), attributes)
-            result.append(elem)
-            continue
-        elif attributes is None:
-            # when attributes not provided all data_obj fields except 'label' will be added
-            attrs.extend([k for k in data_obj.keys() if k!=label])
-            attrs = list(set(attrs))
-        elem = {
-            **{k:decode_data_value_by_name(v,k) for k,v in data_obj.items()}
-            **elem
-        }
-        result.append(elem)
-    # finally - update all elements by adding None for not-available attributes
-    # and converting label to string
-    if isinstance(attributes, str):
-        result = [ {"label":str(v["label"]), "value":v["value"]} for v in result]
-    else:
-        result = [
-            {
-                **{k:None for k in attrs},
-                **v
-            } for v in result
-        ]
-    return result
+    return telemetry_objects(telem_data, attributes, label)
 
 
 async def collect_telemetry_for_device(
@@ -190,10 +189,21 @@ async def collect_telemetry_for_device(
         attributes:Union[str, List[str], None],
         label:str="mqtt_timestamp",
         user_groups:str=None,
+        from_ts:int=None,
+        to_ts:int=None,
+        limit:int=None,
+        cursor:str=None,
+        records_cache:TelemetryRecordsCache=None,
         **kwargs
-    )->List[dict]:
+    )->Tuple[List[dict], Union[str, None]]:
     ''' 
-        return list of objects with ALL telemetry data available
+        return tuple (list of objects with ALL telemetry data available, next cursor)
+        from_ts/to_ts - (optional) range of the telemetry ingestion timestamp (telemetry key) in epoch ms
+        only objects of the range are listed and collected (see iter_telemetry_keys)
+        limit - (optional) max number of objects to return, next cursor is None when there is nothing more
+        cursor - (optional) next cursor of the previous page
+        records_cache - (optional) decoded telemetry of the device (refreshed with telemetry after its last key)
+        the request is served from the cache when it has all telemetry requested (listing is used otherwise)
         depending from attributes/label value object will have different formats
         1. attributes is str
         each object in the list has format like this:
@@ -208,34 +218,75 @@ async def collect_telemetry_for_device(
             "attribute_name": attribute value in correct format
         }
     '''
-    result = []
+    result:List[Tuple[str, dict]] = []
+    next_cursor = None
     tlm_objects = None
+    # NOTE that incorrect cursor is an error of the request (raised)
+    start_after = decode_cursor(cursor) if cursor else None
+    if records_cache is not None and limit is not None and records_cache.is_empty():
+        # page costs O(limit) reads so empty cache is not seeded with the whole range (seeded by the next request)
+        records_cache = None
+    if records_cache is not None:
+        try:
+            # NOTE that the oldest records are evicted after the request is served (so the first request is served from the cache)
+            #      and empty cache is seeded with the range requested only (the same listing as without the cache)
+            if not await records_cache.refresh(device_telemetry_ds, trim=False, from_ts=from_ts, to_ts=to_ts, start_after=start_after):
+                _top_logger.warning(f"collect_telemetry_for_device: not all new telemetry collected to the cache")
+            if records_cache.covers(from_ts, start_after):
+                keyed_records = records_cache.select(from_ts, to_ts, start_after)
+                if limit is not None and len(keyed_records) > limit:
+                    keyed_records = keyed_records[:limit]
+                    next_cursor = encode_cursor(keyed_records[-1][0])
+                return [v for _, v in telemetry_objects(keyed_records, attributes, label)], next_cursor
+        except Exception as e:
+            # telemetry is collected without the cache
+            _top_logger.error(f"collect_telemetry_for_device: FAIL to use telemetry cache with exception {e}")
+            next_cursor = None
+        finally:
+            records_cache.trim()
     try:
         # first - we need to identify telemetry sources for aggregation
-        tlm_objects = device_telemetry_ds.list_objects()
-        # split all objects into reasonable number of loading groups
-        number_of_concurrent_loads = 5
-        chunk_size = len(tlm_objects)//number_of_concurrent_loads
-        # create a set of coroutines where each one aggregate one group
-        collect_data_tasks = [
-            collect_telemetry_objects(
-                device_telemetry_ds, 
-                tlm_objects[i:i+chunk_size],
-                attributes,
-                label,
-            ) for i in range(0,len(tlm_objects),chunk_size)]
-        # collect each objects group
-        _top_logger.info(f"collect_telemetry_for_device: start {len(collect_data_tasks)} tasks to collect data")
-        collect_data_result = await asyncio.gather(*collect_data_tasks)
-        _top_logger.info(f"collect_telemetry_for_device: data collected with result len {len(collect_data_result) if isinstance(collect_data_result, list) else -1}")
-        _top_logger.debug(f"collect_data_result:\n{json.dumps(collect_data_result)}")
-        result = [x for l in collect_data_result for x in l]
+        # NOTE that key is yyyy/MM/dd/<ingestion timestamp> so the range is applied to the listing
+        tlm_keys = iter_telemetry_keys(device_telemetry_ds, from_ts=from_ts, to_ts=to_ts, start_after=start_after)
+        while limit is None or len(result) < limit:
+            # every object has at least one record (bundles have more) so the page never needs more than limit objects
+            tlm_objects = list(tlm_keys) if limit is None else list(islice(tlm_keys, limit - len(result)))
+            if len(tlm_objects) == 0:
+                break
+            # split all objects into reasonable number of loading groups
+            # NOTE that datasource limits number of requests in-flight so groups are just for transformation
+            number_of_concurrent_loads = 5
+            chunk_size = max(len(tlm_objects)//number_of_concurrent_loads, 1)
+            # create a set of coroutines where each one aggregate one group
+            collect_data_tasks = [
+                collect_telemetry_objects(
+                    device_telemetry_ds, 
+                    tlm_objects[i:i+chunk_size],
+                    attributes,
+                    label,
+                    from_ts,
+                    to_ts,
+                    start_after,
+                ) for i in range(0,len(tlm_objects),chunk_size)]
+            # collect each objects group
+            _top_logger.info(f"collect_telemetry_for_device: start {len(collect_data_tasks)} tasks to collect data")
+            collect_data_result = await asyncio.gather(*collect_data_tasks)
+            _top_logger.info(f"collect_telemetry_for_device: data collected with result len {len(collect_data_result) if isinstance(collect_data_result, list) else -1}")
+            _top_logger.debug(f"collect_data_result:\n{json.dumps(collect_data_result)}")
+            result.extend(x for l in collect_data_result for x in l)
+            if limit is None:
+                break
+        if limit is not None and len(result) >= limit:
+            # there is a next page when the last bundle has more records or there are more objects
+            if len(result) > limit or next(tlm_keys, None) is not None:
+                result = result[:limit]
+                next_cursor = encode_cursor(result[-1][0])
         _top_logger.debug(f"result:\n{json.dumps(result)}")
     except Exception as e:
         _top_logger.error(f"collect_telemetry_for_device: FAIL to collect telemetry objects {tlm_objects} with exception {e}")
-        result = []
+        result, next_cursor = [], None
     
-    return result
+    return [v for _, v in result], next_cursor
 
 
 @aws_common_headers()
@@ -273,8 +324,20 @@ def lambda_handler(event:dict, context):
         telemetry_key:str = os.environ.get("telemetry_key") # telemetry key is environment var as it's not needed by most Lambdas
         telemetry_ingest_rule_prefix = os.environ.get("telemetry_ingest_rule_prefix",None)
         user_groups = event.get("requestContext",{}).get("authorizer",{}).get("claims",{}).get("cognito:groups", None)
-        req_datapoints = event.get("queryStringParameters",{}).get("values", "").split(",")
-        req_format = event.get("queryStringParameters",{}).get("format", None)
+        # NOTE that API Gateway provides None (not empty dict) when there are no query parameters
+        query_params = event.get("queryStringParameters",None) or {}
+        req_datapoints = [v for v in (query_params.get("values", None) or "").split(",") if len(v)>0]
+        req_format = query_params.get("format", None)
+        # range of the telemetry (epoch ms)
+        req_from_ts = int(query_params["from"]) if query_params.get("from", None) else None
+        req_to_ts = int(query_params["to"]) if query_params.get("to", None) else None
+        # charts are a few hundred pixels wide so responses can be downsampled to the number of points (LTTB)
+        req_points = int(query_params["points"]) if query_params.get("points", None) else None
+        # pagination (limit and next_cursor of the previous page)
+        req_limit = int(query_params["limit"]) if query_params.get("limit", None) else None
+        req_cursor = query_params.get("cursor", None) or None
+        if req_limit is not None and req_limit < 1:
+            raise ValueError(f"Incorrect limit {req_limit}")
         req_attributes = None
         if len(req_datapoints)>0:
             req_attributes = req_datapoints[0] if req_format in ["line", "bar", "gauge"] else req_datapoints
@@ -290,20 +353,31 @@ def lambda_handler(event:dict, context):
         # total number of telemetry objects can be quite large so we'll try to do it async
         #device_telemetry_ds.get_objects()
         # handler_loop = asyncio.get_event_loop()
-        telemetry_data:list = handler_loop.run_until_complete(
+        telemetry_data, next_cursor = handler_loop.run_until_complete(
             collect_telemetry_for_device(
                 device_telemetry_ds=telem_datasource,
+                records_cache=telemetry_records_caches.for_device(device_id),
                 attributes=req_attributes,                    
                 user_groups=user_groups,
+                from_ts=req_from_ts,
+                to_ts=req_to_ts,
+                limit=req_limit,
+                cursor=req_cursor,
             )
         )
         if not handler_loop.is_closed():
             handler_loop.close()
+        # NOTE that paginated response is downsampled page by page
+        telemetry_data = downsample_objects(telemetry_data, req_points)
 
         result = {
             "statusCode": 200,
             "isBase64Encoded": False,
-            "body": json.dumps(telemetry_data)
+            # NOTE that paginated response is an object so list response is not changed for existing clients
+            "body": json.dumps(telemetry_data if req_limit is None and req_cursor is None else {
+                "items": telemetry_data,
+                "next_cursor": next_cursor
+            })
         }
 
     except Exception as e:
@@ -0,0 +1,264 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+'''
+import json
+import logging
+import os
+import asyncio
+from typing import List, Dict, Tuple, Callable
+
+# this is import from layer!
+# NOTE that we don't include layer to Lambda deployment package
+# instead it's deployed separately and made available for Lambdas (see cloud_iot_diy_cloud/cloud_iot_diy_cloud_stack.py)
+if os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", None) is None:
+    # this part is required for local debugging only!
+    import sys
+    sys.path.append("./src")
+
+from _api_handlers_common import aws_common_headers, telemetry_objects
+from _api_handlers_common.Downsampling import downsample_objects
+from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
+from _devices_registry import DevicesRegistry, DevicesRegistryFactory, DevicesRegistryType
+from _telemetry_history import device_prefix_template
+from _telemetry_history.Bundles import collect_telemetry_records, iter_telemetry_keys, raw_key_timestamp
+from _telemetry_history.RecordsCache import TelemetryRecordsCache, TelemetryRecordsCaches
+
+# logging level can/will be redefined in any specific Cloud (Lambda/Azure function/etc.)
+# predefined here for local
+_root_logger = logging.getLogger()
+_root_logger.setLevel(level=logging.INFO)
+# instantiate _top_logger to be used in this code
+_top_logger = logging.getLogger(__name__)
+
+MAX_BATCH_DEVICES = 20      # max number of devices of one request
+
+# define some global variables to benefit from Lambda "hot start"
+# NOTE that one datasource serves all devices so all requests of the batch share its concurrency budget (max_concurrency)
+telemetry_data_source:ObjectsDatasource = None
+device_prefixes:Dict[str, str] = {}
+aws_registry:DevicesRegistry = None
+# decoded telemetry of the recently requested devices (see api_ui_devices_deviceid_telemetry_get)
+telemetry_records_caches = TelemetryRecordsCaches({"max_records": 5000}, max_devices=2*MAX_BATCH_DEVICES)
+
+
+def telemetry_ds_for_bucket(telemetry_bucket_name:str, max_concurrency:int=32)->ObjectsDatasource:
+    ''' collect from cache or generate a new DataSource (the whole bucket, device prefix is a part of the key) '''
+    global telemetry_data_source
+    if telemetry_data_source is None:
+        telemetry_data_source = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.S3Bucket,
+            config={
+                "bucket_name": telemetry_bucket_name,
+                "key_prefix": "",
+                "max_concurrency": max_concurrency
+            }
+        )
+    return telemetry_data_source
+
+
+def device_prefix_for_deviceid(device_id:str,
+                               telemetry_key:str,
+                               telemetry_topic:str,
+                               things_group_name:str=None)->str:
+    ''' collect from cache or resolve (with the device info from the registry) telemetry key prefix of the device '''
+    global device_prefixes, aws_registry
+
+    if device_id in device_prefixes:
+        return device_prefixes[device_id]
+
+    # telemetry key parts (topic references) before the year with placeholders for thing attributes
+    key_prefix = device_prefix_template(telemetry_key, telemetry_topic)
+    try:
+        if aws_registry is None:
+            aws_registry = DevicesRegistryFactory.create(
+                provider_name=DevicesRegistryType.AwsIotCoreRegistry,
+                config={}
+            )
+        device_info = aws_registry.get_device(device_id=device_id)
+        _ = device_info.pop("ResponseMetadata",None)    # ResponseMetadata can be helpful but will be just removed for now
+    except Exception as e:
+        _top_logger.error(f"device_prefix_for_deviceid: FAIL to collect info for device {device_id} with exception {e}")
+        raise RuntimeError("FAIL to collect device info")
+
+    if isinstance(things_group_name,str) and isinstance(device_info.get("billingGroupName", None),str):
+        # check if access to this device info is expected
+        if things_group_name != device_info["billingGroupName"]:
+            _top_logger.error(f"device_prefix_for_deviceid: FAIL to collect info for device {device_id} as group name is incorrect")
+            raise ValueError("Cannot access device info for the group")
+
+    # we have device info collected so we can assemble key prefix
+    # (see telemetry_ds_for_deviceid of api_ui_devices_deviceid_telemetry_get for device_info format)
+    device_attrs = device_info.get("attributes", {})
+    key_prefix = key_prefix.replace("{{ building_id }}", device_attrs.get("building_id", ""))
+    key_prefix = key_prefix.replace("{{ location_id }}", device_attrs.get("location_id", ""))
+    key_prefix = key_prefix.replace("{{ things_group_name }}", things_group_name or "")
+    key_prefix = key_prefix.replace("{{ thing_type }}", device_info.get("thingTypeName",""))
+    key_prefix = key_prefix.replace("{{ thing_name }}", device_id)
+    _top_logger.debug(f"device_prefix_for_deviceid: final key prefix for device {device_id} is {key_prefix}")
+    device_prefixes[device_id] = key_prefix
+    return key_prefix
+
+
+async def collect_device_records(
+        telemetry_ds:ObjectsDatasource,
+        device_prefix:str,
+        records_cache:TelemetryRecordsCache=None,
+        from_ts:int=None,
+        to_ts:int=None,
+    )->List[Tuple[str, dict]]:
+    ''' (raw key, record) pairs of the device telemetry in the range (ingestion timestamp in epoch ms)
+        records are served from the cache when it has all telemetry requested (listing is used otherwise)
+        NOTE that empty cache is seeded with the range requested only (the same listing as without the cache)
+    '''
+    if records_cache is not None:
+        try:
+            if not await records_cache.refresh(telemetry_ds, device_prefix, trim=False, from_ts=from_ts, to_ts=to_ts):
+                _top_logger.warning(f"collect_device_records: not all new telemetry of {device_prefix} collected to the cache")
+            if records_cache.covers(from_ts):
+                return records_cache.select(from_ts, to_ts)
+        except Exception as e:
+            # telemetry is collected without the cache
+            _top_logger.error(f"collect_device_records: FAIL to use telemetry cache of {device_prefix} with exception {e}")
+        finally:
+            records_cache.trim()
+    obj_keys = await asyncio.to_thread(lambda: list(iter_telemetry_keys(telemetry_ds, device_prefix, from_ts, to_ts)))
+    return [
+        (k, record) for k, record, _ in await collect_telemetry_records(telemetry_ds, obj_keys)
+            if record is not None
+            and (from_ts is None or raw_key_timestamp(k) >= from_ts) and (to_ts is None or raw_key_timestamp(k) <= to_ts)
+    ]
+
+
+async def collect_telemetry_for_devices(
+        *,
+        telemetry_ds:ObjectsDatasource,
+        devices:List[dict],
+        resolve_prefix:Callable[[str], str],
+        label:str="mqtt_timestamp",
+        from_ts:int=None,
+        to_ts:int=None,
+        points:int=None,
+        use_cache:bool=True,
+        max_concurrent_lookups:int=8,
+        **kwargs
+    )->dict:
+    '''
+        collect telemetry of all devices of the batch concurrently
+        devices - list of requests of format
+        {
+            "device_id": <device id>,
+            "values": <attribute name or list of attribute names> (optional, all attributes when not provided),
+            "format": <"line", "bar", "gauge" for the first attribute only> (optional)
+        }
+        resolve_prefix - callable device_id -> telemetry key prefix of the device (blocking, like registry lookup)
+        NOTE that prefixes are resolved in threads (up to max_concurrent_lookups) and telemetry requests
+             of all devices share concurrency budget of telemetry_ds
+        return dict of format
+        {
+            "results": { <device id>: [ <objects of the same format as GET device telemetry> ] },
+            "errors": { <device id>: <error message> }
+        }
+    '''
+    lookups = asyncio.Semaphore(max_concurrent_lookups)
+
+    async def collect_device(request:dict)->list:
+        device_id = request["device_id"]
+        values = request.get("values", None)
+        if isinstance(values, str):
+            values = [v for v in values.split(",") if len(v)>0]
+        attributes = None
+        if isinstance(values, list) and len(values)>0:
+            attributes = values[0] if request.get("format", None) in ["line", "bar", "gauge"] else values
+        async with lookups:
+            device_prefix = await asyncio.to_thread(resolve_prefix, device_id)
+        keyed_records = await collect_device_records(
+            telemetry_ds, device_prefix, telemetry_records_caches.for_device(device_id) if use_cache else None, from_ts, to_ts
+        )
+        return downsample_objects([v for _, v in telemetry_objects(keyed_records, attributes, label)], points)
+
+    results = await asyncio.gather(*[collect_device(v) for v in devices], return_exceptions=True)
+    body = {"results": {}, "errors": {}}
+    for request, result in zip(devices, results):
+        if isinstance(result, BaseException):
+            _top_logger.error(f"collect_telemetry_for_devices: FAIL to collect telemetry of {request['device_id']} with exception {result}")
+            body["errors"][request["device_id"]] = str(result)
+            continue
+        body["results"][request["device_id"]] = result
+    return body
+
+
+@aws_common_headers()
+def lambda_handler(event:dict, context):
+    ''' AWS Lambda entry point. Transform event and context to consumable by microservice_logic
+    details on event parameter can be found at:
+    - https://docs.aws.amazon.com/lambda/latest/dg/gettingstarted-concepts.html#gettingstarted-concepts-event
+    - https://docs.aws.amazon.com/lambda/latest/dg/services-apigateway.html#apigateway-example-event
+
+    details on context parameter can be found at:
+    - https://docs.aws.amazon.com/lambda/latest/dg/python-context.html
+    - https://github.com/aws/aws-lambda-python-runtime-interface-client/blob/main/awslambdaric/lambda_context.py
+
+    expected request body format is
+    {
+        "devices": [ { "device_id": <device id>, "values": [<attribute name>], "format": <format> } ],
+        "from": <epoch ms> (optional), "to": <epoch ms> (optional), "points": <number of points> (optional)
+    }
+    '''
+
+    try:
+        # This can be extremely useful for understanding of AWS specific parameters
+        _top_logger.debug(f"lambda_handler: event type: {type(event)}, context type: {type(context)}")
+        _top_logger.debug(f"lambda_handler: event json: {json.dumps(event, indent=2)}")
+    except Exception as e:
+        _top_logger.debug(f"lambda_handler: Exception: {e}")
+
+    handler_loop = asyncio.new_event_loop()
+    try:
+        telemetry_bucket_name = event["stageVariables"]["telemetry_bucket_name"]
+        things_group_name = event["stageVariables"]["things_group_name"]
+        telemetry_topic:str = os.environ.get("telemetry_topic") # telemetry topic is environment var as it's not needed by most Lambdas
+        telemetry_key:str = os.environ.get("telemetry_key") # telemetry key is environment var as it's not needed by most Lambdas
+        payload = json.loads(event["body"]) if isinstance(event["body"], str) else event["body"]
+        req_devices:list = payload["devices"]
+        if not isinstance(req_devices, list) or len(req_devices) == 0 or len(req_devices) > MAX_BATCH_DEVICES:
+            raise ValueError(f"Request MUST have 1 to {MAX_BATCH_DEVICES} devices")
+        # the same device can be requested only once (results are keyed by device id)
+        if len({v["device_id"] for v in req_devices}) != len(req_devices):
+            raise ValueError("Device requested more than once")
+        req_from_ts = int(payload["from"]) if payload.get("from", None) else None
+        req_to_ts = int(payload["to"]) if payload.get("to", None) else None
+        req_points = int(payload["points"]) if payload.get("points", None) else None
+
+        telemetry_data:dict = handler_loop.run_until_complete(
+            collect_telemetry_for_devices(
+                telemetry_ds=telemetry_ds_for_bucket(telemetry_bucket_name),
+                devices=req_devices,
+                resolve_prefix=lambda device_id: device_prefix_for_deviceid(device_id, telemetry_key, telemetry_topic, things_group_name),
+                from_ts=req_from_ts,
+                to_ts=req_to_ts,
+                points=req_points,
+            )
+        )
+        if not handler_loop.is_closed():
+            handler_loop.close()
+
+        result = {
+            "statusCode": 200,
+            "isBase64Encoded": False,
+            "body": json.dumps(telemetry_data)
+        }
+
+    except Exception as e:
+        payload = "ERROR: incorrect context"
+        _top_logger.error(payload)
+        _top_logger.error(f"Exception: {e}")
+        if not handler_loop.is_closed():
+            handler_loop.close()
+
+        return {
+            "statusCode": 400,
+            "body": payload
+        }
+
+    return result
@@ -2,11 +2,14 @@
 © 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
 MIT License
 '''
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Set, Callable
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import json
 import logging
 import os
 import asyncio
+import time
 import re
 
 # logging level can/will be redefined in any specific Cloud (Lambda/Azure function/etc.)
@@ -24,94 +27,399 @@ if os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", None) is None:
     import sys
     sys.path.append("./src")
 from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
+from _aws_clients import AwsClients
+from _telemetry_history import HistoryManifest, AggregationWatermark, write_segment, new_run_id
+from _telemetry_history import compact_day, history_record_keys, record_sort_key, record_timestamp, iter_group_prefixes, MAX_DAY_SEGMENTS
+from _telemetry_history.Rollups import update_rollups
+from _telemetry_history.Bundles import collect_telemetry_records, raw_key, raw_key_timestamp
+
+# groups not aggregated by the interrupted run (see aggregate_telemetry_to_annual_history)
+CONTINUATION_KEY = ".aggregation/continuation.json"
+# max number of self invocations to continue the scheduled run
+MAX_CONTINUATIONS = 16
 
 async def aggregate_group(
         telemetry_ds:ObjectsDatasource,
         history_ds:ObjectsDatasource,
-        history_obj_key:str,
-        objects_to_group:List[str]
-    )->bool:
-    ''' 
-    collect objects_to_group records from telemetry_ds and add them to history_ds/history_obj_key
-    return True when aggregation successful
+        device_prefix:str,
+        year:str,
+        run_id:str,
+        remove_aggregated:bool=True,
+        max_objects:int=None,
+        max_day_segments:int=MAX_DAY_SEGMENTS,
+        chunk_size:int=100,
+        now_ms:int=None,
+        grace_ms:int=10*60*1000
+    )->Tuple[bool, bool]:
+    '''
+    collect telemetry of the device_prefix/year group from telemetry_ds (only keys after the group watermark)
+    and add it to the device_prefix/year history in history_ds as new segments (one per day)
+    hourly bundles of the telemetry are expanded (watermark is the last raw telemetry key aggregated)
+    aggregation is idempotent and resumable:
+    - segments and watermark become visible with the manifest update (failed run leaves nothing but ignored segments)
+    - telemetry is removed only after the manifest update (and removal is retried by the next run if failed)
+    max_objects - (optional) max number of telemetry objects (raw or bundles) aggregated (the rest is left for the next run)
+    max_day_segments - segments of the day are merged into one (k-way merge) when there are more of them
+    chunk_size - number of telemetry objects (raw or bundles) in memory at once (so memory doesn't depend on max_objects or history size)
+    now_ms/grace_ms - only telemetry ingested at least grace_ms before now_ms (default - current time) is aggregated
+    NOTE that object can be stored after objects with later keys (ingestion timestamp) so watermark MUST stay
+         before keys which can be still in-flight (otherwise late objects are listed before the watermark and lost)
+    return tuple (True when aggregation successful, True when group has more telemetry to aggregate)
     '''
-    # Collect telemetry
+    has_more = False
+    # Collect current manifest (it's small, segments are NOT collected)
     try:
-        in_data:list = await telemetry_ds.get_objects(None, objects_to_group)
+        manifest = HistoryManifest.load(history_ds, device_prefix, year)
     except Exception as e:
-        _top_logger.error(f"FAIL to collect telemetry for aggregation with exception {e}")
-        return False
+        _top_logger.error(f"FAIL to collect history manifest of {device_prefix} for {year} with exception {e}")
+        return False, has_more
+    watermark = manifest.watermark
+    group_prefix = f"{device_prefix}/{year}/"
+
+    # Telemetry aggregated by the previous run but not removed (like when Lambda timed out)
+    # NOTE that keys are in time order so listing is stopped at the watermark
+    to_remove:List[str] = []
+    if remove_aggregated and watermark is not None and not watermark.removed:
+        for obj_key in telemetry_ds.iter_keys(prefix=group_prefix):
+            if not manifest.is_aggregated(raw_key(obj_key)):
+                break
+            to_remove.append(obj_key)
+
+    # Collect telemetry keys after the watermark
+    # NOTE that bundle is listed while its last raw key is after the watermark
+    merged_segments:List[str] = []
+    days:List[str] = []
+    last_key:str = None     # the last telemetry key aggregated
+    listed_keys:List[str] = []
+    collect_failed = False
+    cutoff_ts = (now_ms or int(time.time()*1000)) - grace_ms
+    for obj_key in telemetry_ds.iter_keys(prefix=group_prefix, start_after=None if watermark is None else watermark.last_key):
+        obj_ts = raw_key_timestamp(raw_key(obj_key))
+        if obj_ts is not None and obj_ts > cutoff_ts:
+            # keys are in time order so the rest is aggregated by the next run (like bundle_hours)
+            break
+        listed_keys.append(obj_key)
+        if isinstance(max_objects, int) and len(listed_keys) >= max_objects:
+            has_more = True
+            break
+
+    # Telemetry is streamed by chunks of objects so only one chunk of records is in memory
+    # - records of every day of the chunk are stored as a new immutable segment
+    # - segments of the day are merged with the existing history of the day (streaming k-way merge) at the end
+    # NOTE that group can be aggregated in several batches by one run so every chunk has own id
+    # MQTT redeliveries (the same timestamp and topic) are dropped from rollups like from the history of the day
+    for chunk_start in range(0, len(listed_keys), chunk_size):
+        # Collect telemetry (bundles are expanded to records with raw keys after the watermark)
+        try:
+            keyed_records = await collect_telemetry_records(
+                telemetry_ds, listed_keys[chunk_start:chunk_start+chunk_size], start_after=None if watermark is None else watermark.last_key
+            )
+        except Exception as e:
+            _top_logger.error(f"FAIL to collect telemetry for aggregation with exception {e}")
+            return False, has_more
+        failed_pos = next((i for i, v in enumerate(keyed_records) if v[1] is None), None)
+        if failed_pos is not None:
+            # watermark can't pass not collected telemetry so it'll be aggregated (with the following keys) by the next run
+            _top_logger.warning(f"FAIL to collect {len([v for v in keyed_records if v[1] is None])} telemetry objects of {device_prefix} for {year}")
+            keyed_records = keyed_records[:failed_pos]
+            collect_failed = True
+        records_by_key = {k: record for k, record, _ in keyed_records}
+        del keyed_records
+        # grouped by day (MMdd)
+        objects_to_group:Dict[str,List[str]] = {}
+        for obj_key in records_by_key.keys():
+            day = "".join(obj_key[len(group_prefix):].split("/")[:2])
+            if len(day) != 4 or not day.isdigit():
+                # date parts are not available in the key so all telemetry of the run will be in one segment
+                day = "0000"
+            objects_to_group.setdefault(day, []).append(obj_key)
+
+        chunk_id = new_run_id()
+        rollup_keys:Set[str] = set()
+        for day, day_keys in sorted(objects_to_group.items()):
+            day_records = [records_by_key[k] for k in day_keys if isinstance(records_by_key[k], dict)]
+            if len(day_records) == 0:
+                continue
+            # records already in the history of the day (previous runs or chunks) are not counted by rollups again
+            day_ts = [v for v in (record_timestamp(r) for r in day_records) if v is not None]
+            try:
+                day_record_keys = history_record_keys(history_ds, manifest, day, min(day_ts), max(day_ts)) if len(day_ts) > 0 else set()
+            except Exception as e:
+                _top_logger.error(f"FAIL to collect history of {day} of {device_prefix} for {year} with exception {e}")
+                return False, has_more
+            for k in day_keys:
+                record = records_by_key[k]
+                if isinstance(record, dict) and record_timestamp(record) is not None and record_sort_key(record) not in day_record_keys:
+                    day_record_keys.add(record_sort_key(record))
+                    rollup_keys.add(k)
+            segment = write_segment(history_ds, device_prefix, year, day, day_records, chunk_id, (day_keys[0], day_keys[-1]))
+            if segment is None:
+                return False, has_more
+            manifest.add(segment)
+            if day not in days:
+                days.append(day)
+        # Rollups of the numeric telemetry (1m/1h/1d buckets) so long-range queries don't need raw history
+        # NOTE that rollups skip already applied telemetry so retried aggregation doesn't count it twice
+        if not update_rollups(history_ds, device_prefix, year, ((k, v) for k, v in records_by_key.items() if k in rollup_keys)):
+            return False, has_more
+        if len(records_by_key) > 0:
+            last_key = next(reversed(records_by_key))
+        if collect_failed:
+            break
+
+    # Merge segments of the days with too many segments (so history of the day is sorted and without duplicates)
+    for day in days:
+        if len([v for v in manifest.segments if v.day == day]) > max_day_segments:
+            day_merged_segments = compact_day(history_ds, manifest, day, new_run_id())
+            if day_merged_segments is None:
+                return False, has_more
+            merged_segments.extend(day_merged_segments)
 
-    # Collect current history
+    if last_key is not None:
+        # Save updated manifest (segments and watermark become visible only after this step)
+        last_ts = max([v.last_ts for v in manifest.segments if v.last_ts is not None], default=None)
+        manifest.watermark = AggregationWatermark(run_id=run_id, last_key=last_key, last_ts=last_ts, removed=not remove_aggregated)
+        try:
+            if not manifest.store(history_ds):
+                return False, has_more
+        except Exception as e:
+            _top_logger.error(f"FAIL to store updated history manifest after aggregation with exception {e}")
+            return False, has_more
+        if len(merged_segments) > 0:
+            # merged segments are not in the manifest anymore (and ignored by readers if removal fails)
+            removed_segments = await history_ds.remove_objects(keys=merged_segments)
+            if not all(removed_segments):
+                _top_logger.warning(f"FAIL to remove {removed_segments.count(False)} merged segments of {device_prefix} for {year}")
+
+    if remove_aggregated and manifest.watermark is not None:
+        # raw telemetry and bundles with all records aggregated
+        to_remove.extend(k for k in listed_keys if manifest.is_aggregated(raw_key(k)))
+
+    if len(to_remove) == 0:
+        return not collect_failed, has_more
+
+    # Remove aggregated telemetry data (batch removal - one request per up to 1000 objects)
     try:
-        in_history:list = history_ds.get_object(history_obj_key)
+        cleanup_results = await telemetry_ds.remove_objects(keys=to_remove)
     except Exception as e:
-        _top_logger.warning(f"No history found for {history_obj_key}. Will create a new one.")
-        in_history = []
-    
-    # Really SIMPLE aggregation
-    for tlm_data in in_data:
-        if not isinstance(tlm_data, dict):
-            continue
-        in_history.append(tlm_data)
-    
-    # Save update history
+        _top_logger.error(f"FAIL to remove telemetry data after aggregation with exception {e}")
+        return False, has_more
+    if not all(cleanup_results):
+        return False, has_more
+    # Mark removal as completed (so the next run doesn't need to look for telemetry before the watermark)
+    manifest.watermark.removed = True
+    return manifest.store(history_ds) and not collect_failed, has_more
+
+
+def load_continuation(history_ds:ObjectsDatasource)->List[Tuple[str,str]]:
+    ''' groups left by the previous (interrupted) run '''
     try:
-        history_ds.put_object(history_obj_key, json.dumps(in_history))
+        if len(history_ds.list_objects(prefix=CONTINUATION_KEY)) == 0:
+            return []
+        return [tuple(v) for v in history_ds.get_object(CONTINUATION_KEY)["pending"]]
     except Exception as e:
-        _top_logger.error(f"FAIL to store updated history after aggregation with exception {e}")
-        return False
+        _top_logger.warning(f"FAIL to collect aggregation continuation marker with exception {e}")
+        return []
 
-    # Remove aggregated telemetry data
+
+def store_continuation(history_ds:ObjectsDatasource, run_id:str, pending:List[Tuple[str,str]])->bool:
+    ''' remember groups not aggregated by this run (marker is removed when nothing is pending) '''
+    if len(pending) == 0:
+        if len(history_ds.list_objects(prefix=CONTINUATION_KEY)) == 0:
+            return True
+        return history_ds.remove_object(CONTINUATION_KEY)
+    return history_ds.put_object(CONTINUATION_KEY, json.dumps({"run_id": run_id, "pending": [list(v) for v in pending]}))
+
+
+async def aggregate_groups(
+        telemetry_ds:ObjectsDatasource,
+        history_ds:ObjectsDatasource,
+        groups:List[Tuple[str,str]],
+        run_id:str,
+        remove_aggregated:bool=True,
+        remaining_time_ms:Callable[[],int]=None,
+        safety_margin_ms:int=30000,
+        max_concurrent_groups:int=8,
+        max_objects_per_group:int=5000,
+        chunk_size:int=100,
+        grace_ms:int=10*60*1000,
+        **kwargs
+    )->Tuple[List[bool], List[Tuple[str,str]]]:
+    '''
+        aggregate groups (device-year) in the order provided wave by wave while we have time
+        - groups are aggregated in waves of max_concurrent_groups (up to max_objects_per_group objects of every group)
+          and new wave is started only when it's expected to complete safety_margin_ms before the deadline
+        - telemetry of every group is streamed by chunk_size objects (see aggregate_group)
+        - telemetry ingested less than grace_ms ago is left for the next run (see aggregate_group)
+        - groups with more telemetry are continued after all other groups
+        return tuple (results of aggregated groups, groups not completed)
+    '''
+    queue = deque(groups)
+    aggr_result:List[bool] = []
+    wave_duration_ms = 0
+    while len(queue) > 0:
+        if remaining_time_ms is not None and remaining_time_ms() < safety_margin_ms + wave_duration_ms:
+            _top_logger.info(f"Aggregation run {run_id} stopped before the deadline with {len(queue)} groups pending")
+            break
+        wave = [queue.popleft() for _ in range(min(max_concurrent_groups, len(queue)))]
+        wave_start = time.monotonic()
+        wave_result = await asyncio.gather(*[
+            aggregate_group(
+                telemetry_ds, history_ds, k[0], k[1], run_id, remove_aggregated, max_objects_per_group,
+                chunk_size=chunk_size, grace_ms=grace_ms
+            ) for k in wave
+        ])
+        wave_duration_ms = max(wave_duration_ms, int((time.monotonic() - wave_start)*1000))
+        for group, (ok, has_more) in zip(wave, wave_result):
+            aggr_result.append(ok)
+            if ok and has_more:
+                queue.append(group)
+    return aggr_result, list(queue)
+
+
+def run_worker(telemetry_ds_spec:dict, history_ds_spec:dict, groups:List[Tuple[str,str]], run_id:str,
+               deadline_ms:int=None, options:dict=None)->dict:
+    ''' worker entry point (separate process or Lambda invocation)
+        datasources are created from specs (dict with provider_name and config for ObjectsDatasourceFactory)
+        deadline_ms - (optional) epoch ms when worker MUST complete
+        return dict of format { "results": [<bool>], "pending": [[<device prefix>, <year>]] }
+    '''
+    telemetry_ds = ObjectsDatasourceFactory.create(**telemetry_ds_spec)
+    history_ds = ObjectsDatasourceFactory.create(**history_ds_spec)
+    remaining_time_ms = None if deadline_ms is None else (lambda: deadline_ms - int(time.time()*1000))
+    worker_loop = asyncio.new_event_loop()
     try:
-        cleanup_results = [telemetry_ds.remove_object(v) for v in objects_to_group]
-    except Exception as e:
-        _top_logger.error(f"FAIL to remove telemetry data after aggregation with exception {e}")
-        return False
+        results, pending = worker_loop.run_until_complete(aggregate_groups(
+            telemetry_ds, history_ds, [tuple(v) for v in groups], run_id, remaining_time_ms=remaining_time_ms, **(options or {})
+        ))
+    finally:
+        worker_loop.close()
+    return {"results": results, "pending": [list(v) for v in pending]}
+
+
+class ProcessPoolWorkers:
+    '''
+        Workers running in separate processes (to use all cores for the CPU-bound decoding)
+        NOTE that datasources MUST be available for all processes (like LocalFolder or S3Bucket)
+    '''
+    def __init__(self, telemetry_ds_spec:dict, history_ds_spec:dict, number_of_workers:int=None, options:dict=None) -> None:
+        self._specs = (telemetry_ds_spec, history_ds_spec)
+        self._options = options
+        self.number_of_workers:int = number_of_workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(max_workers=self.number_of_workers)
+
+    def __call__(self, groups:List[Tuple[str,str]], run_id:str, deadline_ms:int=None)->dict:
+        return self._executor.submit(run_worker, *self._specs, groups, run_id, deadline_ms, self._options).result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class LambdaWorkers:
+    '''
+        Workers running as separate invocations of the worker Lambda (see lambda_handler "worker" event)
+    '''
+    def __init__(self, function_name:str, number_of_workers:int) -> None:
+        self._function_name = function_name
+        self.number_of_workers:int = number_of_workers
+        # NOTE that invocation is synchronous so read timeout MUST be longer than the worker Lambda timeout
+        self._lambda_client = AwsClients.client("lambda", config={"read_timeout": 900, "max_pool_connections": max(number_of_workers, 10)})
+
+    def __call__(self, groups:List[Tuple[str,str]], run_id:str, deadline_ms:int=None)->dict:
+        resp = self._lambda_client.invoke(
+            FunctionName=self._function_name,
+            InvocationType="RequestResponse",
+            Payload=json.dumps({"worker": {"groups": [list(v) for v in groups], "run_id": run_id, "deadline_ms": deadline_ms}})
+        )
+        result = json.loads(resp["Payload"].read())
+        if resp.get("FunctionError", None) is not None or result.get("statusCode", None) != 200:
+            raise RuntimeError(f"Worker invocation failed with {result}")
+        return result["body"]
 
-    return all(cleanup_results)
 
 async def aggregate_telemetry_to_annual_history(
         telemetry_ds:ObjectsDatasource,
         history_ds:ObjectsDatasource,
         group_prefix:str,
         group_by_part:List[str]=None,   # TODO - add support for more complex grouping
+        remaining_time_ms:Callable[[],int]=None,
+        safety_margin_ms:int=30000,
+        workers:Callable[[List[Tuple[str,str]], str, int], dict]=None,
         **kwargs
     )->dict:
-    ''' 
+    '''
         collect telemetry files available and do the aggregation with this assumptions:
         - telemetry object key (file name) is the source of group information
         - group_prefix is regex string with prefix to be used for group definition
+        - key parts after the year are month and day (used for daily history segments)
         - OPTIONAL (NOT SUPPORTED FOR NOW) group_by_part parameter enables complex groupings - by specific part of the prefix
+        - kwargs are options of aggregate_groups (like remove_aggregated or max_concurrent_groups)
+        aggregation is time budget aware:
+        - remaining_time_ms - (optional) callable with remaining time of the invocation (like Lambda context.get_remaining_time_in_millis)
+        - groups left by the previous run are aggregated first, then groups of the latest years
+        - groups not aggregated are stored as continuation marker (body "pending" has their number)
+        aggregation can be distributed (coordinator mode):
+        - workers - (optional) ProcessPoolWorkers/LambdaWorkers or any callable (groups, run_id, deadline_ms)->{"results", "pending"}
+          groups are partitioned between workers.number_of_workers batches and results of all workers are reconciled
         return dict of format
         {
             "statusCode": 200,
-            "body": { },
+            "body": { "run_id": <run id>, "groups": <number of groups>, "pending": <number of groups not completed> },
         }
     '''
     #! We'll ignore group_by_part for now an use just split instead of regex
     group_pos_in_split = len(group_prefix.split(")/("))-1
-    # first - we need to identify telemetry sources for aggregation
-    tlm_objects = telemetry_ds.list_objects()
-    tlm_groups:Dict[str,List[str]] = {}
-    for obj_key in tlm_objects:
-        key_comp = obj_key.split("/")
-        if len(key_comp)<=group_pos_in_split:
-            _top_logger.info(f"{obj_key} ignored as it has incorrect key pattern")
-            continue
-        history_obj_key = "/".join(key_comp[:group_pos_in_split]) + "/history.json"
-        tlm_groups.setdefault(history_obj_key, [])
-        # tlm_groups[group_key].append("/".join(key_comp[group_pos_in_split:]))
-        tlm_groups[history_obj_key].append(obj_key)
-    
-    # collect each sources group, run the aggregation, delete sources
-    # set of coroutines where each one aggregate one group
-    aggr_tasks = [aggregate_group(telemetry_ds, history_ds,k,v) for k,v in tlm_groups.items()]
-    aggr_result = await asyncio.gather(*aggr_tasks)
+    # first - we need to identify telemetry groups for aggregation (device-year)
+    # NOTE that only "sub-folders" are listed here, telemetry is listed by every group after its watermark
+    tlm_groups:List[Tuple[str,str]] = []
+    for device_prefix in iter_group_prefixes(telemetry_ds, group_pos_in_split):
+        for year_prefix in telemetry_ds.list_prefixes(prefix=device_prefix):
+            year = year_prefix[len(device_prefix):].rstrip("/")
+            if not year.isdigit():
+                _top_logger.info(f"{year_prefix} ignored as it has incorrect key pattern")
+                continue
+            tlm_groups.append((device_prefix.rstrip("/"), year))
+
+    # priority order - groups left by the previous run, then the latest years first
+    continuation = [v for v in load_continuation(history_ds) if v in tlm_groups]
+    queue = continuation + sorted(set(tlm_groups) - set(continuation), key=lambda v: (-int(v[1]), v[0]))
+
+    run_id = new_run_id()
+    if workers is None or getattr(workers, "number_of_workers", 1) < 2 or len(queue) < 2:
+        aggr_result, pending = await aggregate_groups(
+            telemetry_ds, history_ds, queue, run_id,
+            remaining_time_ms=remaining_time_ms, safety_margin_ms=safety_margin_ms, **kwargs
+        )
+    else:
+        # coordinator - every worker gets groups of all priorities (round robin)
+        number_of_batches = min(workers.number_of_workers, len(queue))
+        batches = [queue[i::number_of_batches] for i in range(number_of_batches)]
+        deadline_ms = None if remaining_time_ms is None else int(time.time()*1000) + remaining_time_ms() - safety_margin_ms
+        workers_results = await asyncio.gather(
+            *[asyncio.to_thread(workers, batch, run_id, deadline_ms) for batch in batches],
+            return_exceptions=True
+        )
+        # reconcile - groups of failed worker are pending (watermarks make repeated aggregation safe)
+        aggr_result, pending = [], []
+        for batch, worker_result in zip(batches, workers_results):
+            if isinstance(worker_result, BaseException):
+                _top_logger.error(f"Aggregation worker of run {run_id} FAIL with exception {worker_result}")
+                aggr_result.append(False)
+                pending.extend(batch)
+                continue
+            aggr_result.extend(worker_result["results"])
+            pending.extend(tuple(v) for v in worker_result["pending"])
+        # keep the priority order for the next run
+        pending_groups = set(pending)
+        pending = [v for v in queue if v in pending_groups]
+
+    # checkpoint - every completed group has its watermark so only pending groups are stored
+    if not store_continuation(history_ds, run_id, pending):
+        _top_logger.error(f"FAIL to store aggregation continuation marker of run {run_id}")
 
     return {
             "statusCode": 200 if all(aggr_result) else 400,
-            "body": { },
+            "body": { "run_id": run_id, "groups": len(tlm_groups), "pending": len(pending) },
         }
 
 def telemetry_key_grouping_components(telemetry_key:str)->Tuple[int,str]:
@@ -161,36 +469,72 @@ def lambda_handler(event:dict, context):
         telemetry_key:str = os.environ.get("telemetry_key")
         grouping_key_prefix = telemetry_key_grouping_components(telemetry_key)
         # 1. Datasource for telemetry (to get the data and removed handled data)
-        telem_datasource = ObjectsDatasourceFactory.create(
-            provider_name=ObjectsDatasourceType.S3Bucket,
-            config={
+        telem_datasource_spec = {
+            "provider_name": ObjectsDatasourceType.S3Bucket,
+            "config": {
                 "bucket_name": telemetry_s3_bucket_name,
                 "key_prefix": ""
             }
-        )
+        }
+        telem_datasource = ObjectsDatasourceFactory.create(**telem_datasource_spec)
         # 2. Datasource for historical data (to get current history and update it)
-        hist_datasource = ObjectsDatasourceFactory.create(
-            provider_name=ObjectsDatasourceType.S3Bucket,
-            config={
+        # NOTE that history is stored compressed (json payloads are very repetitive)
+        hist_datasource_spec = {
+            "provider_name": ObjectsDatasourceType.S3Bucket,
+            "config": {
                 "bucket_name": historical_s3_bucket_name,
-                "key_prefix": ""
+                "key_prefix": "",
+                "codec": "gzip"
+            }
+        }
+        hist_datasource = ObjectsDatasourceFactory.create(**hist_datasource_spec)
+
+        # worker mode - aggregate groups provided by the coordinator
+        if isinstance((event or {}).get("worker", None), dict):
+            worker_deadline_ms = int(time.time()*1000) + context.get_remaining_time_in_millis()
+            if event["worker"].get("deadline_ms", None) is not None:
+                worker_deadline_ms = min(worker_deadline_ms, int(event["worker"]["deadline_ms"]))
+            return {
+                "statusCode": 200,
+                "body": run_worker(
+                    telem_datasource_spec, hist_datasource_spec,
+                    event["worker"]["groups"], event["worker"]["run_id"], worker_deadline_ms
+                )
             }
-        )
         # 3. Create context
         # NOTE that keys here are either logic function parameters or 
         invocation_context:dict = {
-            "group_prefix": grouping_key_prefix
+            "group_prefix": grouping_key_prefix,
+            # run is stopped (and checkpointed) before Lambda timeout
+            "remaining_time_ms": getattr(context, "get_remaining_time_in_millis", None),
         }
+        # coordinator mode - groups are distributed between invocations of the worker Lambda
+        aggregation_worker_function = os.environ.get("aggregation_worker_function", None)
+        aggregation_workers = int(os.environ.get("aggregation_workers", "1"))
+        if isinstance(aggregation_worker_function, str) and aggregation_workers > 1:
+            invocation_context["workers"] = LambdaWorkers(aggregation_worker_function, aggregation_workers)
 
         # Now we are ready to proceed with logic invocation
         # Our microservice logic is async so we need 
-        handler_loop = asyncio.get_event_loop()
+        # NOTE that new loop is used as loop of the previous ("hot start") invocation is closed
+        handler_loop = asyncio.new_event_loop()
         result:dict = handler_loop.run_until_complete(
             aggregate_telemetry_to_annual_history(telem_datasource, hist_datasource, **invocation_context)
         )
         if not handler_loop.is_closed():
             handler_loop.close()
 
+        # 4. Continue the run with a new invocation when there are pending groups
+        # NOTE that scheduled run will continue the groups anyway (from the continuation marker)
+        continuation_depth = int((event or {}).get("continuation", {}).get("depth", 0))
+        if result["body"].get("pending", 0) > 0 and continuation_depth < MAX_CONTINUATIONS:
+            AwsClients.client("lambda").invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType="Event",
+                Payload=json.dumps({"continuation": {"run_id": result["body"]["run_id"], "depth": continuation_depth+1}})
+            )
+            _top_logger.info(f"lambda_handler: run {result['body']['run_id']} will be continued by invocation {continuation_depth+1}")
+
     except Exception as e:
         payload = "ERROR: incorrect context"
         _top_logger.error(payload)
@@ -0,0 +1,137 @@
+'''
+© 2022 Daniil Sokolov (daniil.sokolov@webcloudai.com)
+MIT License
+'''
+from typing import Tuple, List, Callable
+import json
+import logging
+import os
+import asyncio
+import time
+
+# logging level can/will be redefined in any specific Cloud (Lambda/Azure function/etc.)
+# predefined here for local
+_root_logger = logging.getLogger()
+_root_logger.setLevel(level=logging.INFO)
+# instantiate _top_logger to be used in this code
+_top_logger = logging.getLogger(__name__)
+
+# this is import from layer!
+# NOTE that we don't include layer to Lambda deployment package
+# instead it's deployed separately and made available for Lambdas (see cloud_iot_diy_cloud/cloud_iot_diy_cloud_stack.py)
+if os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", None) is None:
+    # this part is required for local debugging only!
+    import sys
+    sys.path.append("./src")
+from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
+from _telemetry_history import iter_group_prefixes
+from _telemetry_history.Bundles import bundle_hours
+
+
+def device_prefix_depth(telemetry_key:str)->int:
+    ''' number of the telemetry key parts before the year (device prefix) '''
+    year_affix_location = telemetry_key.find("yyyy")
+    if year_affix_location ==-1 :
+        raise ValueError(f"Key MUST include a year pattern of format 'yyyy' but {telemetry_key} was provided")
+    # the last part is the beginning of the year pattern like ${parse_time('
+    return len(telemetry_key[:year_affix_location].split("/")) - 1
+
+
+async def compact_telemetry_to_hourly_bundles(
+        telemetry_ds:ObjectsDatasource,
+        device_prefix_depth:int,
+        now_ms:int=None,
+        grace_ms:int=10*60*1000,
+        remaining_time_ms:Callable[[],int]=None,
+        safety_margin_ms:int=30000,
+        max_concurrent_devices:int=8,
+        **kwargs
+    )->dict:
+    '''
+        pack raw telemetry (one object per MQTT message) of every device into hourly bundles
+        - only hours ended at least grace_ms before now_ms are bundled
+        - devices are compacted concurrently (up to max_concurrent_devices) while we have time
+          (devices not compacted are compacted by the next run)
+        return dict of format
+        {
+            "statusCode": 200,
+            "body": { "devices": <number of devices>, "bundles": <number of bundles stored>, "removed": <number of raw objects removed> },
+        }
+    '''
+    now_ms = now_ms or int(time.time()*1000)
+    device_prefixes:List[str] = list(iter_group_prefixes(telemetry_ds, device_prefix_depth))
+    in_flight = asyncio.Semaphore(max_concurrent_devices)
+
+    async def compact_device(device_prefix:str)->Tuple[int, int]:
+        async with in_flight:
+            if remaining_time_ms is not None and remaining_time_ms() < safety_margin_ms:
+                return 0, 0
+            try:
+                return await bundle_hours(telemetry_ds, device_prefix, now_ms, grace_ms)
+            except Exception as e:
+                _top_logger.error(f"FAIL to compact telemetry of {device_prefix} with exception {e}")
+                return -1, 0
+
+    results = await asyncio.gather(*[compact_device(v) for v in device_prefixes])
+    return {
+            "statusCode": 200 if all(v[0] >= 0 for v in results) else 400,
+            "body": {
+                "devices": len(device_prefixes),
+                "bundles": sum(v[0] for v in results if v[0] > 0),
+                "removed": sum(v[1] for v in results),
+            },
+        }
+
+
+def lambda_handler(event:dict, context):
+    ''' AWS Lambda entry point. Transform event and context to consumable by microservice_logic
+    details on event parameter can be found at:
+    - https://docs.aws.amazon.com/lambda/latest/dg/gettingstarted-concepts.html#gettingstarted-concepts-event
+    - https://docs.aws.amazon.com/lambda/latest/dg/services-cloudwatchevents.html
+
+    details on context parameter can be found at:
+    - https://docs.aws.amazon.com/lambda/latest/dg/python-context.html
+    '''
+
+    try:
+        # This can be extremely useful for understanding of AWS specific parameters
+        _top_logger.debug(f"lambda_handler: event type: {type(event)}, context type: {type(context)}")
+        _top_logger.debug(f"lambda_handler: event json: {json.dumps(event, indent=2)}")
+    except Exception as e:
+        _top_logger.debug(f"lambda_handler: Exception: {e}")
+
+    try:
+        # Information about S3 bucket serving telemetry is available in environment variables
+        telemetry_s3_bucket_name = os.environ.get("telemetry_bucket")
+        telemetry_key:str = os.environ.get("telemetry_key")
+        # NOTE that metadata index is not used for the telemetry bucket (telemetry is listed by keys in the time order)
+        telem_datasource = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.S3Bucket,
+            config={
+                "bucket_name": telemetry_s3_bucket_name,
+                "key_prefix": ""
+            }
+        )
+        invocation_context:dict = {
+            "device_prefix_depth": device_prefix_depth(telemetry_key),
+            "remaining_time_ms": getattr(context, "get_remaining_time_in_millis", None),
+        }
+        # Our microservice logic is async
+        # NOTE that new loop is used as loop of the previous ("hot start") invocation is closed
+        handler_loop = asyncio.new_event_loop()
+        result:dict = handler_loop.run_until_complete(
+            compact_telemetry_to_hourly_bundles(telem_datasource, **invocation_context)
+        )
+        if not handler_loop.is_closed():
+            handler_loop.close()
+
+    except Exception as e:
+        payload = "ERROR: incorrect context"
+        _top_logger.error(payload)
+        _top_logger.error(f"lambda_handler: Exception: {e}")
+        return {
+            "statusCode": 500,
+            "body": payload
+        }
+
+    return result
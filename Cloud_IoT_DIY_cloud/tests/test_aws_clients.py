@@ -0,0 +1,34 @@
+''' Unit tests for the shared boto3 clients registry
+    NOTE that clients are created but no requests are sent
+'''
+import unittest
+import os
+
+import sys
+sys.path.insert(1, "../src")
+sys.path.insert(1, "./src")
+
+from _aws_clients import AwsClients
+from _objects_datasource import ObjectsDatasourceFactory, ObjectsDatasourceType
+
+class TestAwsClients(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        AwsClients.clear()
+
+    def test_clients_are_shared(self):
+        ''' clients with the same service, region and config are created once '''
+        s3_client = AwsClients.client("s3")
+        self.assertIs(AwsClients.client("s3", config={}), s3_client)
+        self.assertIsNot(AwsClients.client("s3", config={"max_pool_connections": 50}), s3_client)
+        self.assertIsNot(AwsClients.client("s3", region="eu-west-1"), s3_client)
+        self.assertEqual(s3_client.meta.config.max_pool_connections, 10)
+        # all S3Bucket Datasources with the same concurrency share one client (and connections pool)
+        ds1 = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.S3Bucket, config={"bucket_name": "b1", "key_prefix": ""})
+        ds2 = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.S3Bucket, config={"bucket_name": "b2", "key_prefix": "p"})
+        self.assertIs(ds1._s3_client, ds2._s3_client)
+        self.assertEqual(ds1._s3_client.meta.config.max_pool_connections, 32)
+
+    def tearDown(self):
+        AwsClients.clear()
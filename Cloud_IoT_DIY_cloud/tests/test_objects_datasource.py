@@ -0,0 +1,354 @@
+''' Unit tests for ObjectsDatasource implementations
+    LocalFolder datasource (in the temporary folder) will be used for unit tests
+'''
+import unittest
+
+from pathlib import Path
+import tempfile
+import asyncio
+import shutil
+import json
+import os
+import io
+import time
+import threading
+from itertools import chain
+
+import sys
+sys.path.insert(1, "../src")
+sys.path.insert(1, "./src")
+
+from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType, dump_json_array
+from _objects_datasource.CachingObjectsDatasource import CachingObjectsDatasource
+from _objects_datasource.Memory import Memory
+from _objects_datasource.MetadataIndex import MetadataIndex
+
+class TestLocalFolderDatasource(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp())
+        self.ds:ObjectsDatasource = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.LocalFolder.value,
+            config={"folder_path": self.folder})
+        self.handler_loop = asyncio.new_event_loop()
+
+    def test_remove_objects(self):
+        ''' batch removal returns per-key results in keys order and cleans up empty folders '''
+        keys = [f"dt/diyiot/thing/2023/05/09/16835998206{i:02d}" for i in range(10)]
+        for k in keys:
+            self.assertTrue(self.ds.put_object(k, json.dumps({"k": k})))
+        self.assertTrue(self.ds.put_object("dt/diyiot/other/2023/05/09/1683599820600", "{}"))
+
+        result = self.handler_loop.run_until_complete(
+            self.ds.remove_objects(keys=keys[:5]+["dt/not/existing"]+keys[5:])
+        )
+        self.assertEqual(result, [True]*5 + [False] + [True]*5)
+        self.assertEqual(self.ds.list_objects(), ["dt/diyiot/other/2023/05/09/1683599820600"])
+        self.assertFalse((self.folder / "dt/diyiot/thing").exists())
+        self.assertTrue(self.folder.is_dir())
+
+    def test_lazy_and_hierarchical_listing(self):
+        ''' keys are listed in lexicographical order (like S3), resumable with start_after '''
+        keys = [
+            "dt/diyiot/thing1/2023/05/09/1683599820600", "dt/diyiot/thing1/2023/05/09/1683599820700",
+            "dt/diyiot/thing1/2023/05/10/1683699820600", "dt/diyiot/thing1/2024/01/01/1703699820600",
+            "dt/diyiot/thing2/2023/05/09/1683599820601", "dt-other",
+        ]
+        for k in keys:
+            self.ds.put_object(k, "{}")
+        self.assertEqual(self.ds.list_objects(), sorted(keys))
+        self.assertEqual(
+            list(self.ds.iter_keys(prefix="dt/diyiot/thing1/2023/", start_after="dt/diyiot/thing1/2023/05/09/1683599820600")),
+            ["dt/diyiot/thing1/2023/05/09/1683599820700", "dt/diyiot/thing1/2023/05/10/1683699820600"]
+        )
+        self.assertEqual(self.ds.list_prefixes("dt/diyiot/"), ["dt/diyiot/thing1/", "dt/diyiot/thing2/"])
+        self.assertEqual(self.ds.list_prefixes("dt/diyiot/thing1/20"), ["dt/diyiot/thing1/2023/", "dt/diyiot/thing1/2024/"])
+        self.assertEqual(self.ds.list_prefixes(), ["dt/"])
+        self.assertEqual(len(self.ds.list_objects(filter="2023/*/*/*")), 4)
+
+    def test_streaming_reads(self):
+        ''' chunked, ranged and record-by-record reads '''
+        history = [{"mqtt_timestamp": 1683599820600+i, "temperature|C|float": f"{20+i/10}"} for i in range(100)]
+        self.ds.put_object("history.json", json.dumps(history))
+        self.ds.put_object("history.ndjson", "\n".join([json.dumps(v) for v in history]))
+        blob = self.ds.get_blob("history.json")
+
+        chunks = list(self.ds.iter_blob("history.json", chunk_size=64))
+        self.assertTrue(all(len(v)<=64 for v in chunks))
+        self.assertEqual(b"".join(chunks), blob)
+        self.assertEqual(self.ds.get_blob_range("history.json", 10, 19), blob[10:20])
+        self.assertEqual(self.ds.get_blob_range("history.json", 100), blob[100:])
+        self.assertEqual(list(self.ds.iter_records("history.json", chunk_size=7)), history)
+        self.assertEqual(list(self.ds.iter_records("history.ndjson", format="ndjson", chunk_size=7)), history)
+
+    def test_streaming_write(self):
+        ''' object written from chunks iterator can replace the object it's streamed from '''
+        self.ds.put_object("history.json", json.dumps([{"i": i} for i in range(10)]))
+        self.assertTrue(self.ds.put_object_from_iter(
+            "history.json",
+            dump_json_array(chain(self.ds.iter_records("history.json"), [{"i": i} for i in range(10, 20)]))
+        ))
+        self.assertEqual(self.ds.get_object("history.json"), [{"i": i} for i in range(20)])
+        self.assertEqual(self.ds.list_objects(), ["history.json"])
+
+    def test_compression(self):
+        ''' objects are compressed on write and transparently decompressed on read (including not compressed ones) '''
+        gz_ds:ObjectsDatasource = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.LocalFolder.value,
+            config={"folder_path": self.folder, "codec": "gzip"})
+        history = [{"mqtt_timestamp": 1683599820600+i, "temperature|C|float": f"{20+i/10}"} for i in range(1000)]
+        self.ds.put_object("plain.json", json.dumps(history))
+        self.assertTrue(gz_ds.put_object("history.json", json.dumps(history)))
+        self.assertTrue(gz_ds.put_object_from_iter("streamed.json", dump_json_array(history)))
+        stored = (self.folder / "history.json").read_bytes()
+        self.assertEqual(stored[:2], b"\x1f\x8b")
+        self.assertLess(len(stored)*5, (self.folder / "plain.json").stat().st_size)
+        for k in ["plain.json", "history.json", "streamed.json"]:
+            self.assertEqual(gz_ds.get_object(k), history)
+            self.assertEqual(list(gz_ds.iter_records(k, chunk_size=100)), history)
+        blob = gz_ds.get_blob("history.json")
+        self.assertEqual(gz_ds.get_blob_range("history.json", 1000, 1099), blob[1000:1100])
+        self.assertTrue(all(len(v)<=64 for v in gz_ds.iter_blob("history.json", chunk_size=64)))
+        self.assertEqual(
+            self.handler_loop.run_until_complete(gz_ds.get_objects(None, ["history.json", "plain.json"])),
+            [history, history]
+        )
+
+    def tearDown(self):
+        if not self.handler_loop.is_closed():
+            self.handler_loop.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class TestMemoryDatasource(unittest.TestCase):
+
+    def setUp(self):
+        self.ds:ObjectsDatasource = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.Memory.value,
+            config={"store_name": "test", "key_prefix": "telemetry"})
+        self.handler_loop = asyncio.new_event_loop()
+
+    def test_objects_and_listing(self):
+        ''' Memory Datasource behaves like other Datasources (prefixes are applied like for S3Bucket) '''
+        keys = [f"dt/diyiot/thing{i%3}/2023/05/09/16835998206{i:02d}" for i in range(30)]
+        for k in keys:
+            self.assertTrue(self.ds.put_object(k, json.dumps({"k": k})))
+        other_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "test"})
+        self.assertEqual(len(other_ds.list_objects()), 30)
+        self.assertEqual(other_ds.list_prefixes(), ["telemetry/"])
+        self.assertEqual(self.ds.list_objects(), sorted(keys))
+        self.assertEqual(list(self.ds.iter_keys(prefix="dt/diyiot/thing1/", page_size=3)), sorted(keys[1::3]))
+        self.assertEqual(self.ds.list_prefixes("dt/diyiot/"), ["dt/diyiot/thing0/", "dt/diyiot/thing1/", "dt/diyiot/thing2/"])
+        self.assertEqual(self.ds.get_object(keys[0]), {"k": keys[0]})
+        self.assertEqual(
+            self.handler_loop.run_until_complete(self.ds.get_objects(None, keys[:2]+["missing"])),
+            [{"k": keys[0]}, {"k": keys[1]}, None]
+        )
+        self.assertEqual(
+            self.handler_loop.run_until_complete(self.ds.remove_objects(keys=keys[:10]+["missing"])),
+            [True]*10 + [False]
+        )
+        self.assertEqual(self.ds.list_objects(), sorted(keys[10:]))
+        # objects are removed in batches (one request per up to MAX_DELETE_BATCH objects like S3Bucket)
+        keys = [f"o{i:05d}" for i in range(2*Memory.MAX_DELETE_BATCH + 1)]
+        for k in keys:
+            self.ds.put_object(k, "{}")
+        self.ds.stats["requests"] = 0
+        self.assertTrue(all(self.handler_loop.run_until_complete(self.ds.remove_objects(keys=keys))))
+        self.assertEqual(self.ds.stats["requests"], 3)
+
+    def test_metadata_index(self):
+        ''' query_objects is answered by the metadata index (index itself is not listed) '''
+        indexed_ds:ObjectsDatasource = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.Memory.value,
+            config={"store_name": "indexed", "metadata_index": True})
+        with indexed_ds.metadata_index.batch():
+            for i in range(40):
+                indexed_ds.put_object(
+                    f"dt/diyiot/type{i%2}/thing{i%4}/2023/05/09/{1683599820000+i*1000}", json.dumps({"i": i}),
+                    metadata={"tags": {"thing_type": f"type{i%2}"}}
+                )
+        indexed_ds.put_object("dashboards/d1", json.dumps({}), metadata={"content_type": "application/json"})
+        self.assertEqual(len(indexed_ds.list_objects()), 41)
+        self.assertEqual(indexed_ds.list_prefixes(), ["dashboards/", "dt/"])
+        query = {"tags.thing_type": "type1", "timestamp": {"gte": 1683599820000+30*1000}}
+        self.assertEqual(
+            indexed_ds.query_objects(query),
+            sorted([f"dt/diyiot/type1/thing{i%4}/2023/05/09/{1683599820000+i*1000}" for i in range(31, 40, 2)])
+        )
+        self.assertEqual(indexed_ds.query_objects({"content_type": "application/json"}), ["dashboards/d1"])
+        self.assertEqual(len(indexed_ds.query_objects({"prefix": "dt/diyiot/type0/thing2/", "size": {"gt": 8}})), 8)
+        # removed objects are removed from the index, segments are compacted
+        to_remove = indexed_ds.query_objects({"prefix": "dt/diyiot/type1/"})
+        for k in to_remove[:MetadataIndex.MAX_SEGMENTS]:
+            indexed_ds.remove_object(k)
+        self.handler_loop.run_until_complete(indexed_ds.remove_objects(keys=to_remove[MetadataIndex.MAX_SEGMENTS:]))
+        self.assertEqual(indexed_ds.query_objects(query), [])
+        self.assertEqual(len(indexed_ds.query_objects({})), 21)
+        # changes are buffered (writes cost no index requests) and stored as one segment by flush
+        segments = len(indexed_ds.list_objects(prefix=ObjectsDatasource.INDEX_PREFIX))
+        indexed_ds.stats["requests"] = 0
+        indexed_ds.put_object("dashboards/d2", json.dumps({}))
+        self.assertEqual(indexed_ds.stats["requests"], 1)
+        self.assertTrue(indexed_ds.metadata_index.flush())
+        self.assertEqual(len(indexed_ds.list_objects(prefix=ObjectsDatasource.INDEX_PREFIX)), segments + 1)
+        # another Datasource instance (like another Lambda) sees the same index
+        other_ds = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.Memory.value,
+            config={"store_name": "indexed", "metadata_index": True})
+        self.assertEqual(len(other_ds.query_objects({"tags.thing_type": {"in": ["type0", "type1"]}})), 20)
+
+    def test_metadata_index_compaction(self):
+        ''' query is answered when segments are compacted by another writer after the listing '''
+        writer_ds:ObjectsDatasource = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.Memory.value,
+            config={"store_name": "indexed_compaction", "metadata_index": True})
+        for i in range(MetadataIndex.MAX_SEGMENTS):
+            writer_ds.put_object(f"dt/thing{i%2}/{1683599820000+i*1000}", json.dumps({"i": i}))
+            writer_ds.metadata_index.flush()
+        self.assertEqual(len(writer_ds.list_objects(prefix=ObjectsDatasource.INDEX_PREFIX)), MetadataIndex.MAX_SEGMENTS)
+        reader_ds:ObjectsDatasource = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.Memory.value,
+            config={"store_name": "indexed_compaction", "metadata_index": True})
+        # segments are compacted after the reader listed them (before they are collected)
+        get_object = reader_ds.get_object
+        def get_object_after_compaction(key, *args, **kwargs):
+            if len(writer_ds.list_objects(prefix=ObjectsDatasource.INDEX_PREFIX)) > 1:
+                self.assertTrue(writer_ds.metadata_index.compact())
+            return get_object(key, *args, **kwargs)
+        reader_ds.get_object = get_object_after_compaction
+        self.assertEqual(len(reader_ds.query_objects({"prefix": "dt/thing1/"})), MetadataIndex.MAX_SEGMENTS//2)
+        self.assertEqual(len(writer_ds.list_objects(prefix=ObjectsDatasource.INDEX_PREFIX)), 1)
+        # the next flush (more than MAX_SEGMENTS segments) compacts the index
+        for i in range(MetadataIndex.MAX_SEGMENTS + 1):
+            reader_ds.put_object(f"dt/thing2/{1683599830000+i*1000}", json.dumps({"i": i}))
+            reader_ds.metadata_index.flush()
+        self.assertLessEqual(len(reader_ds.list_objects(prefix=ObjectsDatasource.INDEX_PREFIX)), MetadataIndex.MAX_SEGMENTS)
+        self.assertEqual(len(writer_ds.query_objects({"prefix": "dt/"})), 2*MetadataIndex.MAX_SEGMENTS + 1)
+        Memory.clear("indexed_compaction")
+
+    def test_simulated_failures(self):
+        ''' failures injection is deterministic for the same seed '''
+        results = []
+        for _ in range(2):
+            Memory.clear("test")
+            failing_ds = ObjectsDatasourceFactory.create(
+                provider_name=ObjectsDatasourceType.Memory.value,
+                config={"store_name": "test", "failure_rate": 0.3, "seed": 42})
+            results.append([failing_ds.put_object(f"o{i}", "{}") for i in range(50)])
+            self.assertEqual(failing_ds.stats["failures"], results[-1].count(False))
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(0 < results[0].count(False) < 50)
+
+    def tearDown(self):
+        if not self.handler_loop.is_closed():
+            self.handler_loop.close()
+        Memory.clear()
+
+
+class TestCachingObjectsDatasource(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp())
+        self.ds:ObjectsDatasource = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.LocalFolder.value,
+            config={"folder_path": self.folder / "objects"})
+
+    def test_revalidation_and_ttl(self):
+        ''' unchanged objects are revalidated (not collected), prefix ttl skips revalidation '''
+        cached_ds = CachingObjectsDatasource(self.ds, {"ttl": 0, "prefix_ttl": {"updates/": 3600}})
+        self.ds.put_object("dashboards/d1", json.dumps({"v": 1}))
+        self.ds.put_object("updates/fw1", b"firmware")
+        self.assertEqual(cached_ds.get_object("dashboards/d1"), {"v": 1})
+        self.assertEqual(cached_ds.get_object("dashboards/d1"), {"v": 1})
+        self.assertEqual(cached_ds.get_blob("updates/fw1"), b"firmware")
+        self.assertEqual(cached_ds.get_blob("updates/fw1"), b"firmware")
+        self.assertEqual(cached_ds.stats["misses"], 2)
+        self.assertEqual(cached_ds.stats["revalidated"], 1)
+        self.assertEqual(cached_ds.stats["hits"], 1)
+        # write through the cache invalidates cached blob
+        cached_ds.put_object("dashboards/d1", json.dumps({"v": 2}))
+        self.assertEqual(cached_ds.get_object("dashboards/d1"), {"v": 2})
+        self.assertEqual(cached_ds.stats["misses"], 3)
+
+    def test_failed_reads(self):
+        ''' missing objects are reported like by the wrapped Datasource (None or exception) and dropped from the cache '''
+        memory_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "caching"})
+        for ds in [memory_ds, self.ds]:
+            cached_ds = CachingObjectsDatasource(ds, {"ttl": 0})
+            ds.put_object("dashboards/d1", json.dumps({"v": 1}))
+            self.assertEqual(cached_ds.get_object("dashboards/d1"), {"v": 1})
+            # removed without the cache (like by another Lambda)
+            ds.remove_object("dashboards/d1")
+            for key in ["dashboards/d1", "dashboards/missing"]:
+                if ds is memory_ds:
+                    self.assertIsNone(cached_ds.get_blob(key))
+                else:
+                    with self.assertRaises(Exception):
+                        cached_ds.get_blob(key)
+            self.assertEqual(len(cached_ds._entries), 0)
+        Memory.clear()
+
+    def test_size_limit_and_spill(self):
+        ''' least recently used blobs are spilled to the folder and evicted when spill folder is full '''
+        cached_ds = CachingObjectsDatasource(self.ds, {
+            "ttl": 3600, "max_cache_size": 250, "spill_folder": str(self.folder / "spill"), "max_spill_size": 200
+        })
+        for i in range(5):
+            self.ds.put_object(f"o{i}", bytes([i])*100)
+            self.assertEqual(cached_ds.get_blob(f"o{i}"), bytes([i])*100)
+        self.assertEqual(cached_ds.stats["spills"], 3)
+        self.assertEqual(cached_ds.stats["evictions"], 1)
+        self.assertEqual(cached_ds.get_blob("o1"), bytes([1])*100)   # served from spill folder
+        self.assertEqual(cached_ds.stats["hits"], 1)
+        self.assertEqual(len(list((self.folder / "spill").glob("*"))), 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class TestS3BucketDatasource(unittest.TestCase):
+    ''' NOTE that S3 client is stubbed so no requests are sent '''
+
+    class StubS3Client:
+        ''' get_object of the objects in memory (keys with "missing" fail) with in-flight requests tracking '''
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        def get_object(self, Bucket:str, Key:str, **kwargs):
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                time.sleep(0.01)
+                if "missing" in Key:
+                    raise KeyError(Key)
+                return {"Body": io.BytesIO(json.dumps({"key": Key}).encode("utf-8"))}
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+    def setUp(self):
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.handler_loop = asyncio.new_event_loop()
+
+    def test_concurrent_get_objects(self):
+        ''' objects are collected concurrently (up to max_concurrency in-flight) in the keys order '''
+        ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.S3Bucket,
+                                             config={"bucket_name": "b1", "key_prefix": "telemetry", "max_concurrency": 4})
+        ds._s3_client = self.StubS3Client()
+        keys = [f"missing{i}" if i % 7 == 3 else f"k{i:02d}" for i in range(30)]
+        result = self.handler_loop.run_until_complete(ds.get_objects(None, keys))
+        self.assertEqual(result, [None if "missing" in k else {"key": f"telemetry/{k}"} for k in keys])
+        self.assertLessEqual(ds._s3_client.max_in_flight, 4)
+        self.assertGreater(ds._s3_client.max_in_flight, 1)
+        # worker threads are shared by instances with the same max_concurrency
+        ds2 = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.S3Bucket,
+                                              config={"bucket_name": "b2", "key_prefix": "", "max_concurrency": 4})
+        self.assertIs(ds2._executor_for(4), ds._executor_for(4))
+        self.assertIsNot(ds2._executor_for(8), ds._executor_for(4))
+
+    def tearDown(self):
+        self.handler_loop.close()
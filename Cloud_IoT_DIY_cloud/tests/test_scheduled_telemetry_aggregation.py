@@ -4,15 +4,32 @@
 import unittest
 
 from pathlib import Path
+import tempfile
 import asyncio
+import json
 import re
+import time
 
 import sys
 sys.path.insert(1, "../src")
 sys.path.insert(1, "./src")
+sys.path.insert(1, ".")
 
 from _objects_datasource import ObjectsDatasource, ObjectsDatasourceFactory, ObjectsDatasourceType
-from scheduled_telemetry_aggregation.lambda_code import telemetry_key_grouping_components, aggregate_telemetry_to_annual_history
+from _objects_datasource.Memory import Memory
+from _telemetry_history import HistoryManifest, device_prefix_template, records_in_range, MAX_DAY_SEGMENTS
+from _telemetry_history.Rollups import Rollup, RollupBatch, update_rollups
+from _telemetry_history.Bundles import collect_telemetry_records, bundle_hours, day_prefix, BUNDLE_SUFFIX
+from _telemetry_history.RecordsCache import TelemetryRecordsCache, TelemetryRecordsCaches
+from scheduled_telemetry_aggregation.lambda_code import telemetry_key_grouping_components, aggregate_telemetry_to_annual_history, CONTINUATION_KEY
+from scheduled_telemetry_aggregation.lambda_code import ProcessPoolWorkers
+from scheduled_telemetry_compaction.lambda_code import compact_telemetry_to_hourly_bundles, device_prefix_depth
+from api_ui_devices_deviceid_historical_get.lambda_code import collect_historical_for_device, collect_rollups_for_device
+from api_ui_devices_deviceid_telemetry_get.lambda_code import collect_telemetry_for_device
+import api_ui_telemetry_post.lambda_code as telemetry_post
+from api_ui_telemetry_post.lambda_code import collect_telemetry_for_devices
+from _api_handlers_common.Downsampling import lttb_indices, downsample_objects
+from aggregation_benchmark import render_telemetry_key, run_benchmark
 
 class TestScheduledTelemetryAggregation(unittest.TestCase):
 
@@ -68,6 +85,621 @@ class TestScheduledTelemetryAggregation(unittest.TestCase):
         self.assertEqual(1,1)
 
 
+    def test_history_segments(self):
+        ''' every aggregation run adds new segments (existing history is never rewritten) '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        self.assertEqual(
+            device_prefix_template(self.telemetry_key, "$aws/rules/Ingest/dt/diyiot/b1/l1/diy/DiyThing/thing01"),
+            device_prefix
+        )
+        telemetry_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry"})
+        history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history", "codec": "gzip"})
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        def add_telemetry(day:str, timestamps:list):
+            for ts in timestamps:
+                telemetry_ds.put_object(f"{device_prefix}/2023/05/{day}/{ts}", json.dumps({"mqtt_timestamp": ts, "t|C|float": str(ts % 100)}))
+        def aggregate():
+            return self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key)
+            ))
+
+        add_telemetry("09", [1683599820000 + i for i in range(10)])
+        add_telemetry("10", [1683686220000 + i for i in range(5)])
+        self.assertEqual(aggregate()["statusCode"], 200)
+        self.assertEqual(telemetry_ds.list_objects(), [])
+        manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+        self.assertEqual([(v.day, v.count) for v in manifest.segments], [("0509", 10), ("0510", 5)])
+        first_segments = {manifest.folder + v.key: history_ds.get_blob(manifest.folder + v.key) for v in manifest.segments}
+
+        add_telemetry("10", [1683686230000 + i for i in range(3)])
+        self.assertEqual(aggregate()["statusCode"], 200)
+        manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+        self.assertEqual([(v.day, v.count) for v in manifest.segments], [("0509", 10), ("0510", 5), ("0510", 3)])
+        self.assertEqual(manifest.count, 18)
+        for k, v in first_segments.items():
+            self.assertEqual(history_ds.get_blob(k), v)
+
+        # reader collects only the latest segments required
+        device_history_ds = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history", "key_prefix": device_prefix, "codec": "gzip"})
+        requests_before = device_history_ds.stats["requests"]
+        history = self.handler_loop.run_until_complete(collect_historical_for_device(
+            device_historical_ds=device_history_ds, attributes="t|C|float", max_number_of_history_records=6
+        ))
+        self.assertEqual([v["label"] for v in history], [1683686220000 + i for i in range(2, 5)] + [1683686230000 + i for i in range(3)])
+        self.assertEqual(history[-1]["value"], 2.0)
+        # list of years + manifest + 2 segments
+        self.assertEqual(device_history_ds.stats["requests"] - requests_before, 4)
+
+    def test_aggregation_watermark(self):
+        ''' aggregation continues after the watermark and never aggregates the same telemetry twice '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        telemetry_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry"})
+        history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history"})
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        def add_telemetry(timestamps:list):
+            for ts in timestamps:
+                telemetry_ds.put_object(f"{device_prefix}/2023/05/09/{ts}", json.dumps({"mqtt_timestamp": ts}))
+        def aggregate(**kwargs):
+            return self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key), **kwargs
+            ))
+
+        # run "crashed" after the history update (telemetry is not removed)
+        add_telemetry([1683599820000 + i for i in range(4)])
+        remove_objects = telemetry_ds.remove_objects
+        async def crash(*args, **kwargs):
+            raise TimeoutError()
+        telemetry_ds.remove_objects = crash
+        self.assertEqual(aggregate()["statusCode"], 400)
+        telemetry_ds.remove_objects = remove_objects
+        manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+        self.assertEqual(manifest.watermark.last_key, f"{device_prefix}/2023/05/09/1683599820003")
+        self.assertFalse(manifest.watermark.removed)
+        # the next run removes aggregated telemetry and aggregates only the new one
+        add_telemetry([1683599830000])
+        self.assertEqual(aggregate()["statusCode"], 200)
+        manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+        self.assertEqual([v.count for v in manifest.segments], [4, 1])
+        self.assertTrue(manifest.watermark.removed)
+        self.assertEqual(telemetry_ds.list_objects(), [])
+
+        # telemetry can be kept (only telemetry after the watermark is aggregated)
+        add_telemetry([1683599840000, 1683599840001])
+        self.assertEqual(aggregate(remove_aggregated=False)["statusCode"], 200)
+        self.assertEqual(aggregate(remove_aggregated=False)["statusCode"], 200)
+        manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+        self.assertEqual([v.count for v in manifest.segments], [4, 1, 2])
+        self.assertEqual(manifest.segments[-1].first_key, f"{device_prefix}/2023/05/09/1683599840000")
+        self.assertEqual(len(telemetry_ds.list_objects()), 2)
+
+    def test_late_telemetry(self):
+        ''' telemetry stored after the later keys (in-flight) is not skipped by the watermark '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        telemetry_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry_late"})
+        history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history_late"})
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        def add_telemetry(timestamps:list):
+            for ts in timestamps:
+                telemetry_ds.put_object(f"{device_prefix}/{day_prefix(ts)}{ts}", json.dumps({"mqtt_timestamp": ts}))
+        def aggregate(**kwargs):
+            return self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key), **kwargs
+            ))
+        def history_keys():
+            keys = []
+            for year in {day_prefix(ts)[:4] for ts in timestamps}:
+                manifest = HistoryManifest.load(history_ds, device_prefix, year)
+                keys.extend((v.first_key, v.last_key) for v in manifest.segments)
+            return sorted(keys)
+
+        now_ms = int(time.time()*1000)
+        timestamps = [now_ms - 20*60*1000, now_ms - 60*1000]
+        add_telemetry(timestamps)
+        # telemetry of the grace period is left for the next run
+        self.assertEqual(aggregate()["statusCode"], 200)
+        self.assertEqual(telemetry_ds.list_objects(), [f"{device_prefix}/{day_prefix(timestamps[1])}{timestamps[1]}"])
+        # late telemetry (behind the latest key) is aggregated by the next run
+        timestamps.append(now_ms - 2*60*1000)
+        add_telemetry(timestamps[-1:])
+        self.assertEqual(aggregate(grace_ms=0)["statusCode"], 200)
+        self.assertEqual(telemetry_ds.list_objects(), [])
+        self.assertEqual(len(history_keys()), 2)
+        self.assertEqual(history_keys()[-1][0], f"{device_prefix}/{day_prefix(timestamps[2])}{timestamps[2]}")
+        Memory.clear()
+
+    def test_rollups(self):
+        ''' aggregation maintains 1m/1h/1d rollups of numeric telemetry '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        telemetry_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry"})
+        history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history"})
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        # 2023-05-09 00:00:00 UTC, one sample every 20 seconds (3 per minute) for 2 minutes
+        start_ts = 1683590400000
+        records = [(f"{device_prefix}/2023/05/09/{start_ts + i*20000}", {
+            "mqtt_timestamp": start_ts + i*20000, "t|C|float": str(i), "state|na|str": "on"
+        }) for i in range(6)]
+        for k, v in records:
+            telemetry_ds.put_object(k, json.dumps(v))
+        result = self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+            telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key)
+        ))
+        self.assertEqual(result["statusCode"], 200)
+        rollup = Rollup(f"{device_prefix}/2023/rollups/1m/0509.json", "1m", history_ds.get_object(f"{device_prefix}/2023/rollups/1m/0509.json"))
+        self.assertEqual(list(rollup.buckets.keys()), ["t|C|float"])
+        self.assertEqual(rollup.rows("t|C|float", "mean"), [(start_ts, 1.0), (start_ts + 60000, 4.0)])
+        self.assertEqual(rollup.rows("t|C|float", "last"), [(start_ts, 2.0), (start_ts + 60000, 5.0)])
+        for resolution, partition in [("1h", "05"), ("1d", "2023")]:
+            rollup = Rollup("", resolution, history_ds.get_object(f"{device_prefix}/2023/rollups/{resolution}/{partition}.json"))
+            self.assertEqual(rollup.buckets["t|C|float"], {start_ts: [6, 0.0, 5.0, 15.0, 5.0, start_ts + 100000]})
+        # already applied telemetry is skipped
+        self.assertTrue(update_rollups(history_ds, device_prefix, 2023, records))
+        rollup = Rollup("", "1d", history_ds.get_object(f"{device_prefix}/2023/rollups/1d/2023.json"))
+        self.assertEqual(rollup.buckets["t|C|float"][start_ts][0], 6)
+        # message redelivered after its aggregation (new key, the same timestamp and topic) is counted once like by history
+        redelivered = [
+            (f"{device_prefix}/2023/05/09/{start_ts + 200000}", records[2][1]),
+            (f"{device_prefix}/2023/05/09/{start_ts + 200001}", {"mqtt_timestamp": start_ts + 120000, "t|C|float": "6"}),
+        ]
+        for k, v in redelivered:
+            telemetry_ds.put_object(k, json.dumps(v))
+        result = self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+            telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key)
+        ))
+        self.assertEqual(result["statusCode"], 200)
+        rollup = Rollup("", "1d", history_ds.get_object(f"{device_prefix}/2023/rollups/1d/2023.json"))
+        self.assertEqual(rollup.buckets["t|C|float"][start_ts], [7, 0.0, 6.0, 21.0, 6.0, start_ts + 120000])
+        # reader collects rollups instead of raw history
+        device_history_ds = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history", "key_prefix": device_prefix})
+        rows = self.handler_loop.run_until_complete(collect_rollups_for_device(
+            device_historical_ds=device_history_ds, attributes="t|C|float", resolution="1m", stat="max"
+        ))
+        self.assertEqual(rows, [{"label": start_ts, "value": 2.0}, {"label": start_ts + 60000, "value": 5.0}, {"label": start_ts + 120000, "value": 6.0}])
+
+    def test_sorted_history(self):
+        ''' segments are sorted and deduplicated, days with many segments are compacted by k-way merge '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        telemetry_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry"})
+        history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history"})
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        key_ts = [1683599900000]
+        def aggregate(timestamps:list):
+            # keys are NOT in the timestamps order and the same message (timestamp and topic) is delivered twice
+            for ts in timestamps:
+                key_ts.append(key_ts[-1] + 1)
+                telemetry_ds.put_object(f"{device_prefix}/2023/05/09/{key_ts[-1]}",
+                                        json.dumps({"mqtt_timestamp": ts, "mqtt_topic": "dt/diyiot/thing01"}))
+            return self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key)
+            ))
+        self.assertEqual(aggregate([1683599820003, 1683599820001, 1683599820003, 1683599820002])["statusCode"], 200)
+        manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+        self.assertEqual([(v.count, v.sorted) for v in manifest.segments], [(3, True)])
+        segment_records = history_ds.get_object(manifest.folder + manifest.segments[0].key)
+        self.assertEqual([v["mqtt_timestamp"] for v in segment_records], [1683599820001, 1683599820002, 1683599820003])
+        self.assertEqual([v["mqtt_timestamp"] for v in records_in_range(segment_records, 1683599820002, 1683599820003)],
+                         [1683599820002, 1683599820003])
+        # day with more than MAX_DAY_SEGMENTS segments is merged into one (duplicates across segments are dropped too)
+        for i in range(MAX_DAY_SEGMENTS):
+            self.assertEqual(aggregate([1683599820000 + i*2, 1683599820010 + i])["statusCode"], 200)
+        manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+        self.assertEqual(len(manifest.segments), 1)
+        self.assertTrue(manifest.segments[0].sorted)
+        self.assertEqual(len(history_ds.list_objects(prefix=f"{manifest.folder}segments/")), 1)
+        merged = [v["mqtt_timestamp"] for v in history_ds.get_object(manifest.folder + manifest.segments[0].key)]
+        self.assertEqual(merged, sorted(set(merged)))
+        self.assertEqual(len(merged), manifest.segments[0].count)
+        self.assertEqual(merged, [1683599820000 + i for i in [0, 1, 2, 3, 4, 6, 10, 11, 12, 13]])
+        # reader seeks the range by timestamp
+        device_history_ds = ObjectsDatasourceFactory.create(
+            provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history", "key_prefix": device_prefix})
+        rows = self.handler_loop.run_until_complete(collect_historical_for_device(
+            device_historical_ds=device_history_ds, attributes="mqtt_timestamp",
+            from_ts=1683599820005, to_ts=1683599820010
+        ))
+        self.assertEqual([v["label"] for v in rows], [1683599820006, 1683599820010])
+
+    def test_telemetry_bundles(self):
+        ''' raw telemetry of closed hours is packed into bundles which are read transparently '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        telemetry_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry"})
+        history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history"})
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        # 2023-05-09 08:00:00 UTC, one message every 20 minutes for 3 hours
+        start_ts = 1683619200000
+        timestamps = [start_ts + i*20*60*1000 for i in range(9)]
+        for ts in timestamps:
+            telemetry_ds.put_object(f"{device_prefix}/2023/05/09/{ts}", json.dumps({"mqtt_timestamp": ts, "t|C|float": "1.5"}))
+        # the last hour is not closed yet
+        result = self.handler_loop.run_until_complete(compact_telemetry_to_hourly_bundles(
+            telemetry_ds, device_prefix_depth(self.telemetry_key), now_ms=timestamps[-1] + 60000
+        ))
+        self.assertEqual(result["body"], {"devices": 1, "bundles": 2, "removed": 6})
+        self.assertEqual(telemetry_ds.list_objects(), [
+            f"{device_prefix}/2023/05/09/{timestamps[2]}{BUNDLE_SUFFIX}",
+            f"{device_prefix}/2023/05/09/{timestamps[5]}{BUNDLE_SUFFIX}",
+        ] + [f"{device_prefix}/2023/05/09/{ts}" for ts in timestamps[6:]])
+        # bundles are expanded in the raw keys order
+        records = self.handler_loop.run_until_complete(collect_telemetry_records(telemetry_ds, telemetry_ds.list_objects()))
+        self.assertEqual([v[1]["mqtt_timestamp"] for v in records], timestamps)
+        # aggregation of bundles keeps the watermark at the raw key (bundle is never aggregated twice)
+        for _ in range(2):
+            self.assertEqual(self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key), remove_aggregated=False
+            ))["statusCode"], 200)
+        manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+        self.assertEqual(manifest.count, len(timestamps))
+        self.assertEqual(manifest.watermark.last_key, f"{device_prefix}/2023/05/09/{timestamps[-1]}")
+        # bundles are removed with the aggregated telemetry
+        history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history_removed"})
+        self.assertEqual(self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+            telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key), max_objects_per_group=2
+        ))["statusCode"], 200)
+        self.assertEqual(telemetry_ds.list_objects(), [])
+        self.assertEqual(HistoryManifest.load(history_ds, device_prefix, 2023).count, len(timestamps))
+
+    def test_streaming_aggregation(self):
+        ''' telemetry streamed by small chunks gives the same history and rollups '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        histories = []
+        for chunk_size in [100, 2]:
+            telemetry_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": f"telemetry{chunk_size}"})
+            history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": f"history{chunk_size}"})
+            # the last message is redelivered (the same timestamp and topic)
+            for i, ts in enumerate([1683599820000 + i*1000 for i in range(11)] + [1683599830000]):
+                telemetry_ds.put_object(f"{device_prefix}/2023/05/09/{1683599900000 + i}",
+                                        json.dumps({"mqtt_timestamp": ts, "mqtt_topic": "dt/diyiot/thing01", "t|C|int": i}))
+            self.assertEqual(self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key), chunk_size=chunk_size
+            ))["statusCode"], 200)
+            manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+            # 6 chunk segments of the day are merged into one
+            self.assertEqual([(v.count, v.sorted) for v in manifest.segments], [(11, True)])
+            self.assertEqual(len(history_ds.list_objects(prefix=f"{manifest.folder}segments/")), 1)
+            self.assertEqual(manifest.watermark.last_key, f"{device_prefix}/2023/05/09/{1683599900011}")
+            histories.append((
+                history_ds.get_object(manifest.folder + manifest.segments[0].key),
+                history_ds.get_object(f"{manifest.folder}rollups/1d/2023.json")
+            ))
+        self.assertEqual(histories[0], histories[1])
+
+    def test_aggregation_benchmark(self):
+        ''' synthetic telemetry has the key layout of the IoT Rule and benchmark reports all phases '''
+        self.assertEqual(
+            render_telemetry_key(self.telemetry_key, "dt/diyiot/b01/l01/diy/DiyThing/thing01", 1683599820642),
+            "dt/diyiot/DiyThing/thing01/2023/05/09/1683599820642"
+        )
+        report = run_benchmark(devices=2, days=1, interval_s=3600, seed=1, max_concurrent_groups=1)
+        self.assertEqual(report["objects"], 48)
+        self.assertEqual(report["result"]["statusCode"], 200)
+        self.assertEqual(set(report["phases_s"].keys()), {"list", "fetch", "merge", "write", "delete"})
+        self.assertGreater(report["objects_per_s"], 0)
+
+    @unittest.skipUnless(RollupBatch.numpy() is not None, "numpy is not installed")
+    def test_rollup_engines(self):
+        ''' vectorized (numpy) and pure Python rollup statistics are the same '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        # 2023-05-09 23:00:00 UTC (the batch covers two days), samples are not in the keys order within a key
+        start_ts = 1683673200000
+        records = [(f"{device_prefix}/2023/05/09/{start_ts + i*7000:015d}", {
+            "mqtt_timestamp": start_ts + i*7000 - (i % 3)*1000, "t|C|float": f"{(i*37) % 101 / 7:.3f}", "p|hPa|int": str(1000 + i % 5),
+            "s|na|str": "on", "x|na|float": None if i % 4 else "bad"
+        }) for i in range(1200)]
+        serialized = []
+        for use_numpy in [True, False]:
+            history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": f"history{use_numpy}"})
+            # the second batch overlaps the first one (already applied records are skipped)
+            self.assertTrue(update_rollups(history_ds, device_prefix, 2023, records[:700], use_numpy=use_numpy))
+            self.assertTrue(update_rollups(history_ds, device_prefix, 2023, records[500:], use_numpy=use_numpy))
+            # NOTE that numpy sums in other order so sums are compared rounded
+            serialized.append(json.loads(
+                json.dumps({k: history_ds.get_object(k) for k in history_ds.list_objects()}),
+                parse_float=lambda v: round(float(v), 6)
+            ))
+        self.assertEqual(len(serialized[0]), 4)
+        self.assertEqual(serialized[0], serialized[1])
+        rollup = Rollup("", "1d", serialized[0][f"{device_prefix}/2023/rollups/1d/2023.json"])
+        self.assertEqual(sum(v for _, v in rollup.rows("p|hPa|int", "count")), 1200)
+        self.assertEqual(sorted(rollup.buckets.keys()), ["p|hPa|int", "t|C|float"])
+
+    def test_telemetry_range(self):
+        ''' telemetry of the range is listed and collected only (raw telemetry and bundles) '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        bucket_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry_range"})
+        # 2023-05-09 00:00:00 UTC, one message every 10 minutes for 3 days
+        start_ts = 1683590400000
+        timestamps = [start_ts + i*10*60*1000 for i in range(3*24*6)]
+        for ts in timestamps:
+            day = 9 + (ts - start_ts)//(24*60*60*1000)
+            bucket_ds.put_object(f"{device_prefix}/2023/05/{day:02d}/{ts}", json.dumps({"mqtt_timestamp": ts, "t|C|float": "1.5"}))
+        # telemetry before 2023-05-10 12:00:00 UTC is bundled
+        self.handler_loop.run_until_complete(bundle_hours(bucket_ds, device_prefix, start_ts + 36*60*60*1000, grace_ms=0))
+        device_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry_range", "key_prefix": device_prefix})
+
+        def collect(from_ts, to_ts, records_cache=None):
+            device_ds.stats["requests"] = 0
+            result, _ = self.handler_loop.run_until_complete(collect_telemetry_for_device(
+                device_telemetry_ds=device_ds, attributes=["t|C|float"], from_ts=from_ts, to_ts=to_ts, records_cache=records_cache
+            ))
+            return [v["label"] for v in result], device_ds.stats["requests"]
+
+        # the last hour - one listing and 6 raw objects
+        labels, requests = collect(timestamps[-1] - 59*60*1000, timestamps[-1])
+        self.assertEqual((labels, requests), (timestamps[-6:], 1 + 6))
+        # cold cache is seeded with the range only (the same requests as without the cache)
+        records_cache = TelemetryRecordsCache()
+        labels, requests = collect(timestamps[-1] - 59*60*1000, timestamps[-1], records_cache)
+        self.assertEqual((labels, requests), (timestamps[-6:], 1 + 6))
+        # the following request of the seeded range - first key check and listing after the last key
+        labels, requests = collect(timestamps[-1] - 30*60*1000, None, records_cache)
+        self.assertEqual((labels, requests), (timestamps[-4:], 1 + 1))
+        # range inside bundles (2023-05-10 03:15:00 - 04:05:00 UTC) - one listing and 2 bundles
+        from_ts = start_ts + (24 + 3)*60*60*1000 + 15*60*1000
+        labels, requests = collect(from_ts, from_ts + 50*60*1000)
+        self.assertEqual((labels, requests), ([v for v in timestamps if from_ts <= v <= from_ts + 50*60*1000], 1 + 2))
+        self.assertEqual(len(labels), 5)
+        records_cache = TelemetryRecordsCache()
+        self.assertEqual(collect(from_ts, from_ts + 50*60*1000, records_cache), (labels, 1 + 2))
+        # range before the seed is listed without the cache
+        self.assertEqual(collect(from_ts - 60*60*1000, from_ts, records_cache)[0], collect(from_ts - 60*60*1000, from_ts)[0])
+        # telemetry after the seed range is collected by the next refresh
+        self.assertEqual(collect(from_ts, None, records_cache)[0], collect(from_ts, None)[0])
+        # range over days is listed day by day
+        labels, requests = collect(timestamps[100], timestamps[300])
+        self.assertEqual(labels, timestamps[100:301])
+        # 3 days listings, 8 + 12 bundles and 72 + 13 raw objects
+        self.assertEqual(requests, 3 + 8 + 12 + 72 + 13)
+        # long range and no range
+        self.assertEqual(collect(0, timestamps[-1]*2)[0], timestamps)
+        self.assertEqual(collect(None, None)[0], timestamps)
+        self.assertEqual(collect(timestamps[-1] + 1, None)[0], [])
+        # pages (bundles are split between pages) cover the range exactly once (the last page is never empty)
+        for from_ts, to_ts, limit in [(None, None, 54), (timestamps[100], timestamps[300], 7), (timestamps[100], None, 201)]:
+            pages, cursor = [], None
+            while cursor is not None or len(pages) == 0:
+                result, cursor = self.handler_loop.run_until_complete(collect_telemetry_for_device(
+                    device_telemetry_ds=device_ds, attributes="t|C|float", from_ts=from_ts, to_ts=to_ts, limit=limit, cursor=cursor
+                ))
+                self.assertLessEqual(len(result), limit)
+                pages.append([int(v["label"]) for v in result])
+            self.assertEqual([v for page in pages for v in page], collect(from_ts, to_ts)[0])
+            self.assertTrue(all(len(page) == limit for page in pages[:-1]))
+            self.assertGreater(len(pages[-1]), 0)
+        with self.assertRaises(ValueError):
+            self.handler_loop.run_until_complete(collect_telemetry_for_device(device_telemetry_ds=device_ds, attributes=None, cursor="bad"))
+
+    def test_downsampling(self):
+        ''' chart objects are downsampled (LTTB) to the number of points keeping peaks '''
+        xs = [float(i) for i in range(1000)]
+        ys = [100.0 if i == 500 else -50.0 if i == 777 else (i % 10)/10 for i in range(1000)]
+        selected = lttb_indices(xs, ys, 50)
+        self.assertEqual(len(selected), 50)
+        self.assertEqual((selected[0], selected[-1]), (0, 999))
+        self.assertEqual(selected, sorted(set(selected)))
+        self.assertIn(500, selected)
+        self.assertIn(777, selected)
+        self.assertEqual(lttb_indices(xs[:10], ys[:10], 50), list(range(10)))
+        # single attribute (labels are timestamps as strings)
+        objects = [{"label": str(1683590400000 + i*1000), "value": y} for i, y in enumerate(ys)]
+        result = downsample_objects(objects, 100)
+        self.assertEqual(len(result), 100)
+        self.assertIn(objects[500], result)
+        self.assertIs(downsample_objects(objects, None), objects)
+        self.assertEqual(downsample_objects(objects[:10], 100), objects[:10])
+        # every numeric attribute has its share of points (non-numeric and missing values are ignored)
+        objects = [{"label": 1683590400000 + i*1000, "a|C|float": y, "b|C|int": None if i % 2 else i, "s|na|str": "on"} for i, y in enumerate(ys)]
+        result = downsample_objects(objects, 100)
+        self.assertLessEqual(len(result), 100)
+        self.assertIn(objects[777], result)
+        self.assertEqual(result, sorted(result, key=lambda v: v["label"]))
+        # no more than points objects for any number of attributes
+        objects = [{"label": 1683590400000 + i*1000, **{f"f{j}|C|float": (i*(j + 1)) % 17 for j in range(10)}} for i in range(1000)]
+        for points in [3, 6, 20, 31]:
+            result = downsample_objects(objects, points)
+            self.assertLessEqual(len(result), points)
+            self.assertEqual((result[0], result[-1]), (objects[0], objects[-1]))
+        # objects without numeric attributes are selected evenly
+        result = downsample_objects([{"label": "x", "value": "on"}]*1000, 10)
+        self.assertEqual(len(result), 10)
+
+    def test_telemetry_cache(self):
+        ''' cached telemetry is refreshed with new telemetry only and gives the same results '''
+        device_prefix = "dt/diyiot/DiyThing/thing01"
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        bucket_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry_cache"})
+        device_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry_cache", "key_prefix": device_prefix})
+        # 2023-05-09 00:00:00 UTC, one message every 10 minutes
+        start_ts = 1683590400000
+        timestamps = [start_ts + i*10*60*1000 for i in range(60)]
+
+        def add_telemetry(tss):
+            for ts in tss:
+                bucket_ds.put_object(f"{device_prefix}/2023/05/09/{ts}", json.dumps({"mqtt_timestamp": ts, "t|C|float": str(ts % 7)}))
+
+        def collect(records_cache, **kwargs):
+            device_ds.stats["requests"] = 0
+            result = self.handler_loop.run_until_complete(collect_telemetry_for_device(
+                device_telemetry_ds=device_ds, attributes="t|C|float", records_cache=records_cache, **kwargs
+            ))
+            return result, device_ds.stats["requests"]
+
+        records_cache = TelemetryRecordsCache()
+        add_telemetry(timestamps[:50])
+        # page of the cold cache - one listing and limit objects (cache is not seeded)
+        result, requests = collect(records_cache, limit=5)
+        self.assertEqual((result, requests), (collect(None, limit=5)[0], 1 + 5))
+        self.assertTrue(records_cache.is_empty())
+        self.assertEqual(collect(records_cache), collect(None))
+        # refresh - first key check, listing after the last key and 2 new objects
+        add_telemetry(timestamps[50:52])
+        result, requests = collect(records_cache)
+        self.assertEqual((result, requests), (collect(None)[0], 1 + 1 + 2))
+        self.assertEqual(collect(records_cache, from_ts=timestamps[40], limit=5)[0], collect(None, from_ts=timestamps[40], limit=5)[0])
+        # bundled hours are not collected again
+        self.handler_loop.run_until_complete(bundle_hours(bucket_ds, device_prefix, timestamps[-1], grace_ms=0))
+        add_telemetry(timestamps[52:])
+        result, requests = collect(records_cache)
+        self.assertEqual((result, requests), (collect(None)[0], 1 + 1 + 8))
+        self.assertEqual(len(result[0]), 60)
+        # telemetry removed by aggregation is removed from the cache
+        self.handler_loop.run_until_complete(bucket_ds.remove_objects(keys=bucket_ds.list_objects()[:3]))
+        self.assertEqual(collect(records_cache)[0], collect(None)[0])
+        self.assertEqual(records_cache.stats["removed"], 18)
+        # evicted telemetry is collected without the cache
+        records_cache = TelemetryRecordsCache({"max_records": 10})
+        self.assertEqual(collect(records_cache), collect(None))
+        self.assertEqual(len(records_cache.records), 10)
+        result, requests = collect(records_cache, from_ts=timestamps[-5])
+        self.assertEqual((result, requests), (collect(None, from_ts=timestamps[-5])[0], 1 + 1))
+        result, requests = collect(records_cache, from_ts=timestamps[-20])
+        self.assertEqual(result, collect(None, from_ts=timestamps[-20])[0])
+        self.assertGreater(requests, 2)
+
+    def test_batch_telemetry(self):
+        ''' telemetry of multiple devices is collected by one request (with the same results as device by device) '''
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        bucket_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry_batch"})
+        device_prefixes = {f"thing{i:02d}": f"dt/diyiot/DiyThing/thing{i:02d}" for i in range(5)}
+        # 2023-05-09 00:00:00 UTC, one message every 10 minutes
+        start_ts = 1683590400000
+        for i, device_prefix in enumerate(device_prefixes.values()):
+            for ts in [start_ts + j*10*60*1000 for j in range(10 + i)]:
+                bucket_ds.put_object(f"{device_prefix}/2023/05/09/{ts}", json.dumps({"mqtt_timestamp": ts, "t|C|float": str(ts % 7 + i), "h|%|int": str(i)}))
+        devices = [
+            {"device_id": "thing00", "values": "t|C|float", "format": "line"},
+            {"device_id": "thing01", "values": ["t|C|float", "h|%|int"]},
+            {"device_id": "thing04"},
+            {"device_id": "unknown", "values": ["t|C|float"]},
+        ]
+
+        def resolve_prefix(device_id):
+            if device_id not in device_prefixes:
+                raise RuntimeError("FAIL to collect device info")
+            return device_prefixes[device_id]
+
+        for _ in range(2):
+            # the second request is served from the cache
+            result = self.handler_loop.run_until_complete(collect_telemetry_for_devices(
+                telemetry_ds=bucket_ds, devices=devices, resolve_prefix=resolve_prefix, from_ts=start_ts + 20*60*1000
+            ))
+            self.assertEqual(sorted(result["results"].keys()), ["thing00", "thing01", "thing04"])
+            self.assertEqual(list(result["errors"].keys()), ["unknown"])
+            for request in devices[:3]:
+                device_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory,
+                                                            config={"store_name": "telemetry_batch", "key_prefix": device_prefixes[request["device_id"]]})
+                expected, _ = self.handler_loop.run_until_complete(collect_telemetry_for_device(
+                    device_telemetry_ds=device_ds, from_ts=start_ts + 20*60*1000,
+                    attributes=request.get("values", None) if request.get("format", None) is None else request["values"]
+                ))
+                self.assertEqual(result["results"][request["device_id"]], expected)
+        self.assertEqual(len(result["results"]["thing04"]), 12)
+        # cold caches are seeded with the range only (the same requests as without the cache)
+        records_caches, telemetry_post.telemetry_records_caches = telemetry_post.telemetry_records_caches, TelemetryRecordsCaches()
+        requests = []
+        for use_cache in [False, True]:
+            bucket_ds.stats["requests"] = 0
+            result = self.handler_loop.run_until_complete(collect_telemetry_for_devices(
+                telemetry_ds=bucket_ds, devices=devices[:3], resolve_prefix=resolve_prefix, from_ts=start_ts + 90*60*1000, use_cache=use_cache
+            ))
+            self.assertEqual([len(result["results"][v["device_id"]]) for v in devices[:3]], [1, 2, 5])
+            requests.append(bucket_ds.stats["requests"])
+        self.assertEqual(requests, [3 + 8, 3 + 8])
+        telemetry_post.telemetry_records_caches = records_caches
+        # cache of the least recently requested device is dropped
+        records_caches = TelemetryRecordsCaches(max_devices=2)
+        cache_a, cache_b = records_caches.for_device("a"), records_caches.for_device("b")
+        self.assertIs(records_caches.for_device("a"), cache_a)
+        records_caches.for_device("c")
+        self.assertIs(records_caches.for_device("a"), cache_a)
+        self.assertIsNot(records_caches.for_device("b"), cache_b)
+        # downsampling is applied to every device
+        result = self.handler_loop.run_until_complete(collect_telemetry_for_devices(
+            telemetry_ds=bucket_ds, devices=devices[:3], resolve_prefix=resolve_prefix, points=5
+        ))
+        self.assertTrue(all(len(v) <= 5 for v in result["results"].values()))
+
+    def test_aggregation_deadline(self):
+        ''' run stops before the deadline and the next run continues pending groups first '''
+        telemetry_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "telemetry"})
+        history_ds = ObjectsDatasourceFactory.create(provider_name=ObjectsDatasourceType.Memory, config={"store_name": "history"})
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        devices = [f"dt/diyiot/DiyThing/thing{i:02d}" for i in range(3)]
+        for device_prefix in devices:
+            for ts in range(1683599820000, 1683599820005):
+                telemetry_ds.put_object(f"{device_prefix}/2023/05/09/{ts}", json.dumps({"mqtt_timestamp": ts}))
+        def aggregate(**kwargs):
+            return self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key),
+                max_concurrent_groups=1, max_objects_per_group=2, **kwargs
+            ))
+        # budget is enough for 2 waves only (every group is aggregated by 2 objects per wave)
+        remaining = iter([100000, 100000, 0])
+        result = aggregate(remaining_time_ms=lambda: next(remaining))
+        self.assertEqual(result["statusCode"], 200)
+        self.assertEqual(result["body"]["pending"], 3)
+        self.assertEqual(history_ds.get_object(CONTINUATION_KEY)["pending"], [[v, "2023"] for v in devices[2:] + devices[:2]])
+        self.assertEqual(len(telemetry_ds.list_objects()), 11)
+        # next run completes everything without duplicates
+        result = aggregate()
+        self.assertEqual(result["body"]["pending"], 0)
+        self.assertEqual(history_ds.list_objects(prefix=CONTINUATION_KEY), [])
+        self.assertEqual(telemetry_ds.list_objects(), [])
+        for device_prefix in devices:
+            manifest = HistoryManifest.load(history_ds, device_prefix, 2023)
+            self.assertEqual([v.count for v in manifest.segments], [2, 2, 1])
+
+    def test_aggregation_workers(self):
+        ''' coordinator distributes groups between worker processes and reconciles results '''
+        if self.handler_loop.is_closed():
+            self.handler_loop = asyncio.new_event_loop()
+        with tempfile.TemporaryDirectory() as folder:
+            telemetry_spec = {"provider_name": ObjectsDatasourceType.LocalFolder, "config": {"folder_path": Path(folder) / "telemetry"}}
+            history_spec = {"provider_name": ObjectsDatasourceType.LocalFolder, "config": {"folder_path": Path(folder) / "history"}}
+            telemetry_ds = ObjectsDatasourceFactory.create(**telemetry_spec)
+            history_ds = ObjectsDatasourceFactory.create(**history_spec)
+            devices = [f"dt/diyiot/DiyThing/thing{i:02d}" for i in range(6)]
+            for device_prefix in devices:
+                for ts in range(1683599820000, 1683599820003):
+                    telemetry_ds.put_object(f"{device_prefix}/2023/05/09/{ts}", json.dumps({"mqtt_timestamp": ts}))
+            workers = ProcessPoolWorkers(telemetry_spec, history_spec, number_of_workers=2)
+            try:
+                result = self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                    telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key), workers=workers
+                ))
+            finally:
+                workers.shutdown()
+            self.assertEqual(result["statusCode"], 200)
+            self.assertEqual(result["body"]["pending"], 0)
+            self.assertEqual(telemetry_ds.list_objects(), [])
+            for device_prefix in devices:
+                self.assertEqual(HistoryManifest.load(history_ds, device_prefix, 2023).count, 3)
+
+            # groups of the failed worker are left for the next run
+            for device_prefix in devices[:2]:
+                telemetry_ds.put_object(f"{device_prefix}/2023/05/10/1683686220000", json.dumps({"mqtt_timestamp": 1683686220000}))
+            def failed_worker(groups, run_id, deadline_ms):
+                raise RuntimeError("worker failed")
+            failed_worker.number_of_workers = 2
+            result = self.handler_loop.run_until_complete(aggregate_telemetry_to_annual_history(
+                telemetry_ds, history_ds, group_prefix=telemetry_key_grouping_components(self.telemetry_key), workers=failed_worker
+            ))
+            self.assertEqual(result["statusCode"], 400)
+            self.assertEqual(history_ds.get_object(CONTINUATION_KEY)["pending"], [[v, "2023"] for v in devices[:2]])
+
     def test_cloud_aggregate_telemetry_to_annual_history(self):
         '''  '''
         grouping_key_prefix = telemetry_key_grouping_components(self.telemetry_key)
@@ -101,5 +733,6 @@ class TestScheduledTelemetryAggregation(unittest.TestCase):
 
     def tearDown(self):
         # TODO: cleanup create test telemetry and history data
+        Memory.clear()
         if not self.handler_loop.is_closed():
             self.handler_loop.close()